@@ -0,0 +1,131 @@
+"""
+Compare how long loading the classifiers takes and how much memory it
+costs with the different loading settings in rootsage.clf.
+
+Every setting runs in a fresh interpreter. The "forked" settings preload
+the models in a parent process and fork workers afterwards, like a
+pre-forking server does, and report each worker's unique and proportional
+set size to show how much of the models the workers share.
+
+Run it from the repository root (Linux only, it reads /proc):
+
+    python benchmarks/clf_loading.py [--workers 4]
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+
+
+CHILD = r"""
+import os
+import sys
+import json
+import time
+
+def memory(pid="self"):
+    # rss, pss and uss (private pages) in MiB
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                fields[parts[0][:-1]] = int(parts[1])
+    return {
+        "rss": fields["Rss"] / 1024,
+        "pss": fields["Pss"] / 1024,
+        "uss": (fields["Private_Clean"] + fields["Private_Dirty"]) / 1024,
+    }
+
+mmap_mode, compiled, workers = json.loads(sys.argv[1])
+
+start = time.perf_counter()
+from rootsage import clf
+import_time = time.perf_counter() - start
+
+clf.configure(mmap_mode=mmap_mode, compiled=compiled)
+start = time.perf_counter()
+clf.preload()
+load_time = time.perf_counter() - start
+
+result = {
+    "import_s": import_time,
+    "load_s": load_time,
+    "memory_mib": memory(),
+}
+
+if workers:
+    pids = []
+    r, w = os.pipe()
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(w)
+            # touch the models like a request would, then wait to be measured
+            for nutrient in ("N", "P", "K"):
+                clf.get_predictor(nutrient)
+            os.read(r, 1)
+            os._exit(0)
+        pids.append(pid)
+    time.sleep(1)
+    result["workers_memory_mib"] = [memory(pid) for pid in pids]
+    os.close(w)
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+print(json.dumps(result))
+"""
+
+
+SETTINGS = {
+    "sklearn": (None, False),
+    "sklearn, mmap": ("r", False),
+    "compiled": (None, True),
+    "compiled, mmap": ("r", True),
+}
+
+
+def run(mmap_mode, compiled, workers=0):
+    """
+    Run the measurement in a fresh interpreter.
+
+    :param mmap_mode: the mmap_mode passed to clf.configure
+    :param compiled: whether the models are compiled
+    :param workers: the number of workers to fork after loading
+    :return: the measurements
+    """
+
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD, json.dumps([mmap_mode, compiled, workers])],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4, help="workers to fork for the forked runs")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for name, (mmap_mode, compiled) in SETTINGS.items():
+        results[name] = run(mmap_mode, compiled)
+        results[f"{name}, forked"] = run(mmap_mode, compiled, args.workers)
+
+    print(f"{'setting':<26}{'load (s)':>10}{'rss (MiB)':>11}{'worker uss (MiB)':>18}")
+    for name, result in results.items():
+        workers = result.get("workers_memory_mib")
+        uss = f"{sum(w['uss'] for w in workers) / len(workers):.1f}" if workers else "-"
+        print(f"{name:<26}{result['load_s']:>10.2f}{result['memory_mib']['rss']:>11.1f}{uss:>18}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+Benchmark the hot paths of rootsage against a temporary SQLite file:
+
+- db.add_npk_data one reading at a time vs db.add_npk_data_batch
+- db.get_latest_npk_data_df as npk_data grows (10k, 1M and 10M rows)
+- clf.classify one reading at a time vs clf.classify_frame
+- the whole /app/reports/ pipeline, through the Flask test client, and
+  its statistics-only report off the rollups
+
+The results are written as JSON, and can be compared against a baseline
+from an earlier run, in which case the exit status is non-zero if any
+benchmark got slower than the tolerance allows. Run it from the
+repository root:
+
+    python benchmarks/hot_paths.py --output results.json
+    python benchmarks/hot_paths.py --baseline results.json
+
+Filling npk_data up to 10M rows takes a few minutes and a couple of GB
+of disk, use --sizes to pick smaller tables.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# rootsage.app loads its settings from rootsage/config.py as "config"
+sys.path[:0] = [ROOT, os.path.join(ROOT, "rootsage")]
+
+import numpy as np
+import pandas as pd
+
+from flask import Flask
+from rootsage import db, clf
+
+
+SENSORS = 10
+
+
+def measure(func, repeat):
+    """
+    Run a function a number of times.
+
+    :param func: the function to run
+    :param repeat: how many times to run it
+    :return: the median and the fastest run time, in seconds
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"seconds": statistics.median(times), "min_seconds": min(times), "repeat": repeat}
+
+
+def result(timing, rows=None):
+    if rows is not None:
+        timing["rows"] = rows
+        timing["rows_per_second"] = rows / timing["seconds"] if timing["seconds"] else None
+    return timing
+
+
+def random_rows(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        (float(n), float(p), float(k), int(sensor_id), None, None, None, None, None)
+        for n, p, k, sensor_id in zip(
+            rng.uniform(0, 150, count),
+            rng.uniform(0, 150, count),
+            rng.uniform(0, 200, count),
+            rng.integers(1, SENSORS + 1, count)
+        )
+    ]
+
+
+def seed_database(conn):
+    db.create_tables(conn)
+    with open(os.path.join(ROOT, "config.json")) as f:
+        crops = json.load(f)["CROPS"]
+    for crop in crops:
+        db.add_crop(conn, crop)
+    for i in range(SENSORS):
+        db.add_sensor(conn, f"sensor-{i + 1}", "benchmark", i % 22 + 1, 1)
+
+
+def fill_npk_data(conn, rows):
+    """
+    Grow npk_data to the given number of rows, one reading a
+    minute per sensor, generated inside SQLite to keep it quick.
+    """
+
+    current = conn.execute("SELECT count(*) FROM npk_data;").fetchone()[0]
+    if current >= rows:
+        return
+
+    with conn:
+        conn.execute("""
+            WITH RECURSIVE seq(i) AS (
+                SELECT ? UNION ALL SELECT i + 1 FROM seq WHERE i < ?
+            )
+            INSERT INTO npk_data (n, p, k, sensor_id, created_at, clf_n, clf_p, clf_k, clf_version)
+                SELECT
+                    abs(random()) % 150,
+                    abs(random()) % 150,
+                    abs(random()) % 200,
+                    i % ? + 1,
+                    datetime('2020-01-01', '+' || (i / ?) || ' minutes'),
+                    'Okay', 'Okay', 'Okay', 'benchmark'
+                FROM seq;
+        """, (current, rows - 1, SENSORS, SENSORS))
+
+
+def bench_ingestion(path, rows, repeat):
+    conn = db.connect(path)
+    data = random_rows(rows)
+    results = {}
+
+    def one_by_one():
+        for row in data:
+            db.add_npk_data(conn, *row[:4])
+
+    def batched():
+        for i in range(0, len(data), 500):
+            db.add_npk_data_batch(conn, data[i:i + 500])
+
+    results["add_npk_data (one by one)"] = result(measure(one_by_one, repeat), rows)
+    results["add_npk_data_batch (500 per batch)"] = result(measure(batched, repeat), rows)
+    conn.close()
+    return results
+
+
+def bench_latest(path, sizes, repeat):
+    conn = db.connect(path)
+    results = {}
+    for size in sorted(sizes):
+        fill_npk_data(conn, size)
+        timing = measure(lambda: db.get_latest_npk_data_df(conn, "sensor-1", n=10), repeat)
+        results[f"get_latest_npk_data_df ({size} rows)"] = result(timing)
+    conn.close()
+    return results
+
+
+def bench_classify(rows, repeat):
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({
+        "N": rng.uniform(0, 150, rows),
+        "P": rng.uniform(0, 150, rows),
+        "K": rng.uniform(0, 200, rows),
+        "label": rng.integers(0, clf.NUM_LABELS, rows),
+    })
+    single = [data.iloc[[i]] for i in range(min(rows, 1000))]
+
+    clf.preload()
+    results = {}
+    results["classify (one by one)"] = result(
+        measure(lambda: [clf.classify(row) for row in single], repeat), len(single)
+    )
+    results["classify_frame (batched)"] = result(
+        measure(lambda: clf.classify_frame(data), repeat), rows
+    )
+    return results
+
+
+def bench_report(workdir, rows, repeat):
+    """
+    Time /app/reports/ end to end: query, classification of
+    stale rows, statistics and writing the workbook.
+    """
+
+    path = os.path.join(workdir, "report.db")
+    os.environ.update({
+        "ROOTSAGE_DB_NAME": path,
+        "ROOTSAGE_LOGS_DIR": os.path.join(workdir, "logs"),
+        "ROOTSAGE_INGEST_SPOOL_DIR": os.path.join(workdir, "spool"),
+        "ROOTSAGE_ARCHIVE_DIR": os.path.join(workdir, "archive"),
+        "ROOTSAGE_SECRET_KEY": "benchmark",
+        "ROOTSAGE_API_KEY": "benchmark",
+        "ROOTSAGE_ADMINS": '["benchmark"]',
+        "ROOTSAGE_BACKGROUND_JOBS": "false",
+        "ROOTSAGE_LOG_LEVEL": "30",
+    })
+
+    with Flask("benchmark").app_context():
+        conn = db.connect(path)
+        seed_database(conn)
+        fill_npk_data(conn, rows)
+        # the statistics-only report reads the rollups
+        while db.roll_up_npk_data(conn, 50_000):
+            pass
+        conn.close()
+
+    from rootsage.app import app, hasher, conn as app_conn
+
+    with app.app_context():
+        db.add_user(app_conn(), "benchmark", hasher.hash("benchmark"))
+    client = app.test_client()
+    client.post("/app/login/", data={"user": "benchmark", "pass": "benchmark"})
+
+    form = {
+        "start_date": "2000-01-01",
+        "end_date": "2100-01-01",
+        "sensor-selector": "any",
+        "crop-selector": "any",
+    }
+
+    def report(detail):
+        response = client.post("/app/reports/", data={**form, "detail-selector": detail})
+        assert response.status_code == 200, response.status_code
+        response.get_data()
+
+    return {
+        f"/app/reports/ ({rows} rows)": result(measure(lambda: report("readings"), repeat), rows),
+        f"/app/reports/ stats only ({rows} rows)": result(measure(lambda: report("stats"), repeat), rows),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print how each benchmark did against the baseline.
+
+    :return: the names of the benchmarks that regressed
+    """
+
+    regressed = []
+    print(f"\n{'benchmark':<48}{'baseline (s)':>14}{'now (s)':>12}{'change':>10}")
+    for name, timing in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:<48}{'-':>14}{timing['seconds']:>12.4f}{'new':>10}")
+            continue
+        change = timing["seconds"] / before["seconds"] - 1
+        flag = ""
+        if change > tolerance:
+            regressed.append(name)
+            flag = "  REGRESSED"
+        print(f"{name:<48}{before['seconds']:>14.4f}{timing['seconds']:>12.4f}{change:>+10.1%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,1000000,10000000",
+                        help="comma separated npk_data sizes for get_latest_npk_data_df")
+    parser.add_argument("--ingest-rows", type=int, default=5000, help="readings to insert per run")
+    parser.add_argument("--classify-rows", type=int, default=100_000, help="readings to classify per batched run")
+    parser.add_argument("--report-rows", type=int, default=100_000, help="readings in the report")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark, the median is kept")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="how much slower than the baseline is a regression (default: 0.2, 20%%)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rootsage-bench-")
+    results = {}
+    try:
+        app = Flask("benchmark")
+        app.logger.setLevel("WARNING")
+        with app.app_context():
+            for name in ["ingest.db", "latest.db"]:
+                conn = db.connect(os.path.join(workdir, name))
+                seed_database(conn)
+                conn.close()
+
+            results.update(bench_ingestion(os.path.join(workdir, "ingest.db"), args.ingest_rows, args.repeat))
+            results.update(bench_latest(
+                os.path.join(workdir, "latest.db"),
+                [int(size) for size in args.sizes.split(",")],
+                max(args.repeat, 20)
+            ))
+            results.update(bench_classify(args.classify_rows, args.repeat))
+        results.update(bench_report(workdir, args.report_rows, args.repeat))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for name, timing in results.items():
+        rate = f"{timing['rows_per_second']:>14,.0f} rows/s" if timing.get("rows_per_second") else ""
+        print(f"{name:<48}{timing['seconds']:>12.4f} s{rate}")
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+
+    output = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": commit or None,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,516 @@
+"""
+Load test a running rootsage node with a synthetic sensor fleet, to find
+out how many sensors at what reporting rate one node can sustain.
+
+The harness adds the crops in config.json and the fleet's sensors through
+/api/crops/ and /api/sensors/, then has every sensor post a reading to
+/api/data/ once per interval (or, with --batch-size, gateways of that many
+sensors post to /api/data/batch/) while logged in users watch the dashboard
+and generate reports. Readings are sent on schedule no matter how slow the
+node answers, so a node that can't keep up shows as a growing send lag
+instead of a quietly lower rate.
+
+Each sensor's readings come from its crop's levels as the classifiers see
+them: the widest range of each nutrient classified 'Okay' for the crop.
+Each field sits somewhere around those levels and its readings vary around
+that, with a share of readings (--off-target) anywhere from 0 to twice the
+levels, to exercise the Low and High classes too.
+
+Crops are numbered by their position in config.json's CROPS list, the
+same way the app numbers them when it loads them at startup, so the node
+should have been started with the same config.json. Run it from the
+repository root against a node with a user to log in as:
+
+    python benchmarks/load_test.py --url http://127.0.0.1:5000 \\
+        --api-key KEY --user admin --password PASS \\
+        --sensors 1000 --interval 10 --duration 120
+
+Throughput, p50/p95/p99 latency and error rates are printed per operation,
+and written as JSON with --output.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import heapq
+import queue
+import argparse
+import threading
+import http.client
+import urllib.parse
+
+from http.cookies import SimpleCookie
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+
+from rootsage import clf
+
+
+NUTRIENTS = ["N", "P", "K"]
+
+
+class Stats:
+    """
+    Latencies and statuses of every request, by operation.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}  # operation -> [(latency, status)]
+        self.lags = []
+        self.readings = 0
+
+    def record(self, operation, latency, status):
+        with self.lock:
+            self.samples.setdefault(operation, []).append((latency, status))
+
+    def record_lag(self, lag):
+        with self.lock:
+            self.lags.append(lag)
+
+    def add_readings(self, count):
+        with self.lock:
+            self.readings += count
+
+    def summary(self, elapsed):
+        """
+        :param elapsed: how long the test ran, in seconds
+        :return: the throughput, latency percentiles (in milliseconds)
+                 and error rate of each operation
+        """
+
+        summary = {}
+        with self.lock:
+            for operation, samples in sorted(self.samples.items()):
+                latencies = np.array([latency for latency, _ in samples]) * 1000
+                statuses = [status for _, status in samples]
+                errors = sum(1 for status in statuses if status is None or status >= 400)
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+                summary[operation] = {
+                    "requests": len(samples),
+                    "per_second": len(samples) / elapsed,
+                    "errors": errors,
+                    "error_rate": errors / len(samples),
+                    "throttled": statuses.count(429),
+                    "failed_connections": statuses.count(None),
+                    "p50_ms": p50,
+                    "p95_ms": p95,
+                    "p99_ms": p99,
+                    "max_ms": latencies.max(),
+                }
+            if self.lags:
+                lags = np.array(self.lags) * 1000
+                summary["send lag"] = {
+                    "readings_stored_per_second": self.readings / elapsed,
+                    "p50_ms": np.percentile(lags, 50),
+                    "p99_ms": np.percentile(lags, 99),
+                    "max_ms": lags.max(),
+                }
+        return summary
+
+
+class Client:
+    """
+    A kept alive connection to the node, with the session cookie of
+    the logged in user if there is one. Each thread has its own.
+    """
+
+    def __init__(self, url, headers=None, timeout=60):
+        """
+        :param url: the node's base URL
+        :param headers: headers to send with every request
+        :param timeout: how long to wait for a response, in seconds
+        """
+
+        parts = urllib.parse.urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip("/")
+        self.headers = dict(headers or {})
+        self.timeout = timeout
+        self.cookies = SimpleCookie()
+        self.conn = None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        :return: the status, headers and body of the response
+        """
+
+        headers = dict(self.headers, **(headers or {}))
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{name}={morsel.value}" for name, morsel in self.cookies.items())
+
+        while True:
+            reused = self.conn is not None
+            if not reused:
+                self.conn = self.connection_class(self.host, timeout=self.timeout)
+            try:
+                self.conn.request(method, self.prefix + path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # the server closed the kept alive connection, try a new one
+                self.close()
+                if not reused:
+                    raise
+
+        for cookie in response.headers.get_all("Set-Cookie") or []:
+            self.cookies.load(cookie)
+        if response.will_close:
+            self.close()
+        return response.status, response.headers, data
+
+
+def timed(stats, operation, request):
+    """
+    Send a request and record how long it took.
+
+    :param request: a function that sends it and returns the response
+    :return: the response, None if the request failed
+    """
+
+    start = time.perf_counter()
+    try:
+        response = request()
+    except (OSError, http.client.HTTPException):
+        response = None
+    stats.record(operation, time.perf_counter() - start, response[0] if response else None)
+    return response
+
+
+def crop_profiles(crops):
+    """
+    Get the levels each crop does well with, as the classifiers see
+    them: for each nutrient, the middle and a quarter of the width of
+    the widest range classified 'Okay'.
+
+    :param crops: every crop name, in config.json's order
+    :return: crop name -> nutrient -> (mean, standard deviation)
+    """
+
+    okay = next(label for label, name in clf.clf_mapping.items() if name == "Okay")
+    forests = {nutrient: clf.CompiledForest(clf.get_model(nutrient)) for nutrient in NUTRIENTS}
+
+    profiles = {}
+    for label, crop in enumerate(crops[:clf.NUM_LABELS]):
+        profiles[crop] = {}
+        for nutrient, forest in forests.items():
+            edges = np.concatenate(([0], forest.breakpoints[label], [np.inf]))
+            ranges = []
+            for i, cls in enumerate(forest.classes[label]):
+                low, high = max(edges[i], 0), edges[i + 1]
+                if cls == okay and high > low:
+                    # open ended, assume it's as wide again as where it starts
+                    ranges.append((low, high if np.isfinite(high) else low * 2 + 1))
+            if not ranges:
+                ranges = [(0, max(edges[-2], 1))]
+            low, high = max(ranges, key=lambda r: r[1] - r[0])
+            profiles[crop][nutrient] = ((low + high) / 2, (high - low) / 4)
+    return profiles
+
+
+class Sensor:
+    def __init__(self, sensor_id, name, profile, rng):
+        """
+        :param sensor_id: the sensor's ID
+        :param name: the sensor's name
+        :param profile: the levels of its crop, from crop_profiles
+        :param rng: the random number generator
+        """
+
+        self.id = sensor_id
+        self.name = name
+        self.profile = profile
+        # where this sensor's field sits around the crop's levels
+        self.levels = {
+            nutrient: max(rng.normal(mean, std), 0)
+            for nutrient, (mean, std) in profile.items()
+        }
+
+    def reading(self, rng, off_target):
+        reading = {"sensor_id": self.id}
+        wild = rng.random() < off_target
+        for nutrient, (mean, std) in self.profile.items():
+            if wild:
+                value = rng.uniform(0, 2 * mean)
+            else:
+                value = rng.normal(self.levels[nutrient], std / 4)
+            reading[nutrient.lower()] = round(max(value, 0), 1)
+        return reading
+
+
+def seed(args, crops, profiles, rng):
+    """
+    Add the crops and the fleet's sensors, spread evenly over the crops.
+
+    :return: the sensors
+    """
+
+    client = Client(args.url, {"X-API-KEY": args.api_key, "Content-Type": "application/json"})
+    all_crops = json.load(open(os.path.join(ROOT, "config.json")))["CROPS"]
+
+    for crop in all_crops:
+        status, _, body = client.request("POST", "/api/crops/", json.dumps({"name": crop}))
+        if status != 201:
+            sys.exit(f"Could not add crop '{crop}': {status} {body[:200]!r}")
+
+    fleet = []
+    for i in range(args.sensors):
+        crop = crops[i % len(crops)]
+        name = f"{args.prefix}{i + 1}"
+        status, _, body = client.request("POST", "/api/sensors/", json.dumps({
+            "name": name,
+            "desc": "load test",
+            "crop": all_crops.index(crop) + 1,
+            "status": 1
+        }))
+        if status != 201:
+            sys.exit(f"Could not add sensor '{name}': {status} {body[:200]!r}")
+        fleet.append(Sensor(json.loads(body)["id"], name, profiles[crop], rng))
+
+    client.close()
+    return fleet
+
+
+def send_readings(args, fleet, stats, stop, rng):
+    """
+    Schedule every sensor's (or gateway's) readings once per interval
+    and hand them to the sender threads, until the test is over.
+    """
+
+    senders = queue.Queue()
+    threads = [
+        threading.Thread(target=sender, args=(args, senders, stats), daemon=True)
+        for _ in range(args.workers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    groups = [fleet[i:i + args.batch_size] for i in range(0, len(fleet), args.batch_size)]
+    # spread the first readings over an interval, like a fleet that's been running
+    start = time.monotonic()
+    schedule = [(start + rng.uniform(0, args.interval), i) for i in range(len(groups))]
+    heapq.heapify(schedule)
+
+    while not stop.is_set():
+        due, i = heapq.heappop(schedule)
+        if stop.wait(max(due - time.monotonic(), 0)):
+            break
+        senders.put((due, [sensor.reading(rng, args.off_target) for sensor in groups[i]]))
+        heapq.heappush(schedule, (due + args.interval, i))
+
+    for _ in threads:
+        senders.put(None)
+    for thread in threads:
+        thread.join()
+
+
+def sender(args, senders, stats):
+    client = Client(args.url, {"X-API-KEY": args.api_key, "Content-Type": "application/json"})
+
+    while (item := senders.get()) is not None:
+        due, readings = item
+        stats.record_lag(time.monotonic() - due)
+
+        if args.batch_size == 1:
+            operation, path, body = "POST /api/data/", "/api/data/", readings[0]
+        else:
+            operation, path, body = "POST /api/data/batch/", "/api/data/batch/", readings
+        response = timed(stats, operation, lambda: client.request("POST", path, json.dumps(body)))
+        if response and response[0] in (201, 202):
+            stored = len(readings)
+            if args.batch_size > 1:
+                stored = len(readings) - len(json.loads(response[2]).get("errors", []))
+            stats.add_readings(stored)
+
+    client.close()
+
+
+def login(args, client, stats):
+    response = timed(stats, "POST /app/login/", lambda: client.request(
+        "POST", "/app/login/",
+        urllib.parse.urlencode({"user": args.user, "pass": args.password}),
+        {"Content-Type": "application/x-www-form-urlencoded"}
+    ))
+    return response is not None and response[0] == 200 and "HX-Redirect" in response[1]
+
+
+def dashboard_user(args, fleet, stats, stop, seed):
+    """
+    Open the dashboard and keep switching between the fleet's sensors.
+    """
+
+    rng = np.random.default_rng(seed)
+    client = Client(args.url)
+    if not login(args, client, stats):
+        print("Dashboard user could not log in", file=sys.stderr)
+        return
+
+    response = timed(stats, "GET /app/dashboard/", lambda: client.request("GET", "/app/dashboard/"))
+    if response is None or response[0] != 200:
+        return
+
+    # the sensors the dashboard lets users pick from
+    page = response[2].decode()
+    selector = page[page.find('id="sensor-selector"'):]
+    names = re.findall(r'value="([^"]*)"', selector[:selector.find("</select>")])
+    fleet_names = {sensor.name for sensor in fleet}
+    watched = [name for name in names if name in fleet_names] or names
+
+    while watched and not stop.is_set():
+        path = "/app/dashboard/update/?" + urllib.parse.urlencode({"current_sensor": rng.choice(watched)})
+        timed(stats, "GET /app/dashboard/update/", lambda: client.request("GET", path))
+        stop.wait(args.dashboard_interval * rng.uniform(0.5, 1.5))
+
+    client.close()
+
+
+def report_user(args, stats, stop, seed):
+    """
+    Keep generating reports over the last days of data.
+    """
+
+    rng = np.random.default_rng(seed)
+    client = Client(args.url)
+    if not login(args, client, stats):
+        print("Report user could not log in", file=sys.stderr)
+        return
+
+    body = urllib.parse.urlencode({
+        "start_date": (date.today() - timedelta(days=args.report_days)).isoformat(),
+        "end_date": (date.today() + timedelta(days=1)).isoformat(),
+        "sensor-selector": "any",
+        "crop-selector": "any",
+        "detail-selector": args.report_detail,
+    })
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+    while not stop.wait(args.report_interval * rng.uniform(0.5, 1.5)):
+        timed(stats, "POST /app/reports/", lambda: client.request("POST", "/app/reports/", body, headers))
+
+    client.close()
+
+
+def print_summary(summary):
+    print(f"\n{'operation':<28}{'requests':>10}{'per s':>10}{'errors':>9}{'429':>7}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for operation, row in summary.items():
+        if operation == "send lag":
+            continue
+        print(f"{operation:<28}{row['requests']:>10}{row['per_second']:>10.1f}"
+              f"{row['error_rate']:>9.2%}{row['throttled']:>7}"
+              f"{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}")
+
+    lag = summary.get("send lag")
+    if lag:
+        print(f"\nreadings stored: {lag['readings_stored_per_second']:.1f}/s, send lag "
+              f"p50 {lag['p50_ms']:.1f} ms, p99 {lag['p99_ms']:.1f} ms, max {lag['max_ms']:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="the node's base URL")
+    parser.add_argument("--api-key", default=os.environ.get("ROOTSAGE_API_KEY"),
+                        help="the node's API key (default: $ROOTSAGE_API_KEY)")
+    parser.add_argument("--user", help="the user the dashboard and report users log in as")
+    parser.add_argument("--password", default=os.environ.get("ROOTSAGE_LOAD_TEST_PASSWORD"),
+                        help="the user's password (default: $ROOTSAGE_LOAD_TEST_PASSWORD)")
+    parser.add_argument("--sensors", type=int, default=100, help="sensors in the fleet")
+    parser.add_argument("--interval", type=float, default=10, help="seconds between each sensor's readings")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="sensors per gateway posting to /api/data/batch/ (default: 1, each "
+                             "sensor posts to /api/data/ on its own)")
+    parser.add_argument("--crops", help="comma separated crops to spread the sensors over (default: all)")
+    parser.add_argument("--off-target", type=float, default=0.1,
+                        help="share of readings anywhere from 0 to twice the crop's levels")
+    parser.add_argument("--prefix", default=f"load-{int(time.time())}-", help="the sensors' name prefix")
+    parser.add_argument("--workers", type=int, default=32, help="threads sending readings")
+    parser.add_argument("--dashboard-users", type=int, default=5, help="logged in users on the dashboard")
+    parser.add_argument("--dashboard-interval", type=float, default=5, help="seconds between dashboard updates")
+    parser.add_argument("--report-users", type=int, default=1, help="logged in users generating reports")
+    parser.add_argument("--report-interval", type=float, default=30, help="seconds between reports")
+    parser.add_argument("--report-days", type=int, default=1, help="days of data in each report")
+    parser.add_argument("--report-detail", default="readings", choices=["readings", "hourly", "daily"])
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run the test for")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated readings")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--max-error-rate", type=float,
+                        help="exit with a non-zero status if any operation's error rate is higher")
+    args = parser.parse_args()
+
+    if not args.api_key:
+        parser.error("--api-key or $ROOTSAGE_API_KEY is required")
+    users = args.dashboard_users + args.report_users
+    if users and not (args.user and args.password):
+        print("No --user and --password, only sending readings", file=sys.stderr)
+        args.dashboard_users = args.report_users = 0
+
+    rng = np.random.default_rng(args.seed)
+    all_crops = json.load(open(os.path.join(ROOT, "config.json")))["CROPS"][:clf.NUM_LABELS]
+    crops = all_crops
+    if args.crops:
+        unknown = set(args.crops.split(",")) - set(crops)
+        if unknown:
+            parser.error(f"unknown crops: {', '.join(sorted(unknown))}")
+        crops = [crop for crop in crops if crop in args.crops.split(",")]
+
+    print(f"Adding {args.sensors} sensors over {len(crops)} crops...", file=sys.stderr)
+    fleet = seed(args, crops, crop_profiles(all_crops), rng)
+
+    stats = Stats()
+    stop = threading.Event()
+    threads = [threading.Thread(target=send_readings, args=(args, fleet, stats, stop, rng))]
+    threads += [
+        threading.Thread(target=dashboard_user, args=(args, fleet, stats, stop, args.seed + i + 1), daemon=True)
+        for i in range(args.dashboard_users)
+    ]
+    threads += [
+        threading.Thread(target=report_user, args=(args, stats, stop, args.seed + 1000 + i), daemon=True)
+        for i in range(args.report_users)
+    ]
+
+    print(f"Offering {args.sensors / args.interval:.1f} readings/s for {args.duration:g}s...", file=sys.stderr)
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    try:
+        stop.wait(args.duration)
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    # don't wait for in flight reports, they're not part of the run
+    threads[0].join()
+    elapsed = time.monotonic() - start
+
+    summary = stats.summary(elapsed)
+    print_summary(summary)
+
+    if args.output:
+        settings = {name: value for name, value in vars(args).items() if name not in ("api_key", "password")}
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {"date": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "elapsed": elapsed, "args": settings},
+                "results": summary,
+            }, f, indent=2, default=float)
+
+    if args.max_error_rate is not None and any(
+        row.get("error_rate", 0) > args.max_error_rate for row in summary.values()
+    ):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
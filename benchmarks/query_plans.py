@@ -0,0 +1,105 @@
+"""
+Check that the hot nutrient data queries in rootsage.db are answered from
+the indexes created by the schema migrations, without scanning npk_data
+or sorting it in a temporary b-tree (beyond ordering readings of the
+same second by id). The queries are captured as db.py
+runs them, so they can't drift from what the app actually executes.
+
+Exits with a non-zero status if any of the plans is not the expected one.
+Run it from the repository root:
+
+    python benchmarks/query_plans.py
+"""
+
+import os
+import sys
+import sqlite3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from rootsage import db
+
+
+def capture_query(conn, call):
+    """
+    Run a db function and get the SELECT statement it executed.
+
+    :param conn: the database connection
+    :param call: a function that calls into rootsage.db
+    :return: the statement, with its parameters filled in
+    """
+
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        conn.set_trace_callback(None)
+    return next(s for s in statements if s.lstrip().upper().startswith("SELECT"))
+
+
+def main():
+    app = Flask(__name__)
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+
+    # query name -> (call, index its plan must read from, whether it covers the query)
+    checks = {
+        "get_latest_npk_data": (
+            lambda: db.get_latest_npk_data(conn, 10),
+            "idx_npk_data_created", True
+        ),
+        "get_latest_npk_data_df": (
+            lambda: db.get_latest_npk_data_df(conn, "sensor", n=1),
+            "idx_npk_data_sensor_created", True
+        ),
+        "get_npk_data_df (any sensor)": (
+            lambda: db.get_npk_data_df(conn, "2024-01-01", "2024-12-31", "any", "any"),
+            "idx_npk_data_created", True
+        ),
+        "get_npk_data_df (one sensor)": (
+            lambda: db.get_npk_data_df(conn, "2024-01-01", "2024-12-31", "sensor", "any"),
+            "idx_npk_data_sensor_created", True
+        ),
+        "get_npk_data_page (any sensor)": (
+            lambda: list(db.get_npk_data_page(conn, 10, after=("2024-01-01", 1))),
+            "idx_npk_data_created", True
+        ),
+        "get_npk_data_page (one sensor)": (
+            lambda: list(db.get_npk_data_page(conn, 10, sensor_id=1, after=("2024-01-01", 1))),
+            "idx_npk_data_sensor_created", True
+        ),
+        # a partial index of only the unclassified rows, the rest is read from the table
+        "get_unclassified_npk_data": (
+            lambda: db.get_unclassified_npk_data(conn, 1),
+            "idx_npk_data_unclassified", False
+        ),
+    }
+
+    failed = False
+    with app.app_context():
+        db.create_tables(conn)
+        db.add_crop(conn, "rice")
+        db.add_sensor(conn, "sensor", "", 1, 1)
+
+        for name, (call, index, covering) in checks.items():
+            query = capture_query(conn, call)
+            plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query)]
+
+            ok = (
+                any(f"{'COVERING ' if covering else ''}INDEX {index}" in step for step in plan)
+                # ties on created_at are fine to sort by id as they're read
+                and not any("TEMP B-TREE" in step and "RIGHT PART" not in step for step in plan)
+            )
+            failed = failed or not ok
+
+            print(f"{'ok' if ok else 'FAIL'}: {name} (expected {index})")
+            for step in plan:
+                print(f"    {step}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,8 @@ import json
 from dotenv import load_dotenv
 from logging.handlers import RotatingFileHandler
 from flask import Flask
+from flask.logging import default_handler
+from rootsage.logs import BackgroundHandler, SamplingFilter
 
 
 def create_app(config):
@@ -29,6 +31,10 @@ def create_app(config):
     log_level = app.config["LOG_LEVEL"]
     if "LOGS_DIR" in app.config:
         setup_file_logs(app, log_level)
+    app.logger.addFilter(SamplingFilter(
+        app.config.get("LOG_SAMPLE_RATES"),
+        app.config.get("LOG_RATE_LIMITS")
+    ))
 
     # init sessions
     app.secret_key = app.config["SECRET_KEY"]
@@ -39,7 +45,8 @@ def create_app(config):
 
 def setup_file_logs(app, level=logging.INFO):
     """
-    Sets up logging using a file handler.
+    Sets up logging using a file handler. The file, and Flask's
+    console output, are written by a background thread.
 
     :param app: the Flask app object
     :param level: the logger's default level
@@ -59,5 +66,10 @@ def setup_file_logs(app, level=logging.INFO):
     formatter = logging.Formatter(fmt)
     formatter.datefmt = "%Y-%m-%d %H:%M:%S"
     handler.setFormatter(formatter)
-    app.logger.addHandler(handler)
+
+    handlers = [handler]
+    if default_handler in app.logger.handlers:
+        app.logger.removeHandler(default_handler)
+        handlers.append(default_handler)
+    app.logger.addHandler(BackgroundHandler(handlers, app.config.get("LOG_QUEUE_SIZE", 10000)))
     app.logger.setLevel(level)
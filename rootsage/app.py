@@ -1,11 +1,20 @@
+import os
+import json
+import time
+import base64
+import atexit
+import hashlib
 import sqlite3
+import tempfile
+import importlib.util
+import threading
 import argon2
+import concurrent.futures
 import pandas as pd
-import numpy as np
 
 from html import escape
-from flask import request, jsonify, render_template, g, url_for, make_response, redirect, send_from_directory
-from rootsage import create_app, db, clf
+from flask import request, jsonify, render_template, url_for, make_response, redirect, send_file, Response, stream_with_context, g
+from rootsage import create_app, db, clf, reporting, ingest, jobs, events, metrics, registry, cache, compression
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from functools import wraps
 from datetime import datetime, timezone
@@ -17,37 +26,321 @@ login_manager = LoginManager()
 
 login_manager.init_app(app)
 
+clf.configure(
+    mmap_mode=app.config["CLASSIFIERS_MMAP_MODE"],
+    compiled=app.config["COMPILE_CLASSIFIERS"]
+)
+metrics.configure(app.config["METRICS_ENABLED"])
+if app.config["PRELOAD_CLASSIFIERS"]:
+    # load before the server forks its workers so they share the models
+    clf.preload()
+
+
+"""
+each thread keeps its own database connection open and reuses it across
+requests. sqlite connections can't be shared between threads, and the ones
+opened before a fork can't be used by the child, hence the pid check
+"""
+db_local = threading.local()
+
+
+def connect_db():
+    """
+    Open a new database connection using the app's settings.
+    """
+
+    return db.connect(
+        app.config["DB_NAME"],
+        journal_mode=app.config["DB_JOURNAL_MODE"],
+        synchronous=app.config["DB_SYNCHRONOUS"],
+        busy_timeout=app.config["DB_BUSY_TIMEOUT"],
+        mmap_size=app.config["DB_MMAP_SIZE"],
+        cache_size=app.config["DB_CACHE_SIZE"]
+    )
+
 
 def conn():
     """
-    Create a new database connection for each request.
+    Get this thread's database connection, opening it if needed.
+    """
+
+    if getattr(db_local, "pid", None) != os.getpid():
+        db_local.conn = connect_db()
+        db_local.pid = os.getpid()
+    return db_local.conn
+
+
+# each process gets its own ingestion queue and writer thread, started on
+# first use since threads don't survive a pre-forking server's fork
+ingest_state = {"pid": None, "queue": None}
+ingest_lock = threading.Lock()
+
+
+def ingest_queue():
+    """
+    Get this process' ingestion queue, starting it if needed.
+    """
+
+    if ingest_state["pid"] != os.getpid():
+        with ingest_lock:
+            if ingest_state["pid"] != os.getpid():
+                queue = ingest.IngestQueue(
+                    app,
+                    connect_db,
+                    app.config["INGEST_SPOOL_DIR"],
+                    max_rows=app.config["INGEST_QUEUE_SIZE"],
+                    batch_size=app.config["INGEST_BATCH_SIZE"],
+                    flush_interval=app.config["INGEST_FLUSH_INTERVAL"],
+                    fsync=app.config["INGEST_SPOOL_FSYNC"],
+                    spool_max_size=app.config["INGEST_SPOOL_MAX_SIZE"],
+                    on_commit=refresh_latest_readings
+                )
+                queue.start()
+                atexit.register(queue.stop)
+                ingest_state["queue"] = queue
+                ingest_state["pid"] = os.getpid()
+    return ingest_state["queue"]
+
+
+@app.before_request
+def start_request_timer():
+    if metrics.enabled:
+        g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request_time(response):
+    start = g.pop("request_start", None)
+    if start is not None:
+        metrics.REQUEST_SECONDS.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            # the route, not the path, so there's one series per view
+            route=request.url_rule.rule if request.url_rule is not None else "unmatched",
+            status=response.status_code
+        )
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    if app.config["COMPRESS_RESPONSES"]:
+        compression.compress_response(
+            response,
+            request.accept_encodings,
+            min_size=app.config["COMPRESS_MIN_SIZE"],
+            level=app.config["COMPRESS_LEVEL"]
+        )
+    return response
+
+
+def make_etag(*versions):
+    """
+    Make the ETag of a response to this request out of the versions of the
+    data it shows, e.g. cache versions or the id of the last reading. It's
+    the same in every process for as long as none of them change.
+
+    :param versions: JSON serializable version markers
+    :return: the ETag
     """
 
-    if "conn" not in g:
-        g.conn = sqlite3.connect(app.config["DB_NAME"])
-        g.conn.row_factory = sqlite3.Row
-        # create tables if needed. this is fine here as it is idempotent
-        db.create_tables(g.conn)
-    return g.conn
+    key = json.dumps([request.path, sorted(request.args.items(multi=True)), *versions])
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
 
 
-@app.teardown_appcontext
-def teardown_db_conn(exception):
+def conditional(etag, render):
     """
-    Close the database connection after each request.
+    Answer a request with 304 Not Modified if the client has the version
+    of the response with the given ETag already, so nothing is queried or
+    rendered, or with the response render makes otherwise. Get the
+    versions the ETag is made of before the data, so the ETag is never
+    newer than the response.
+
+    :param etag: the ETag of the current version of the response
+    :param render: a function that makes the response
+    :return: the response
     """
-    conn = g.pop("conn", None)
 
-    if conn is not None:
-        conn.close()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+        if response.status_code != 200:
+            return response
+
+    # weak, compressing the body doesn't change what it means
+    response.set_etag(etag, weak=True)
+    # browsers keep the response, but check it's still current every time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+# the active sensors, for the dashboard and API lookups. each process keeps
+# its own copy and checks the database for changes once per interval
+sensor_registry = registry.SensorRegistry(app.config["SENSOR_REGISTRY_CHECK_INTERVAL"])
+
+
+# the logged in users, so the user loader doesn't query the database on
+# every request. other processes' changes to a user show once it expires
+user_cache = cache.TTLCache(app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL"])
+
+
+# passwords are hashed and checked by a small pool of threads per process.
+# argon2 releases the GIL while it works, so a slow hash only holds up its
+# own request, and a burst of logins can't take more CPU and memory (argon2
+# uses a lot of it on purpose) than the pool's workers
+password_state = {"pid": None, "pool": None}
+password_lock = threading.Lock()
+
+
+def password_pool():
+    """
+    Get this process' password hashing pool, starting it if needed.
+    """
+
+    if password_state["pid"] != os.getpid():
+        with password_lock:
+            if password_state["pid"] != os.getpid():
+                pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=app.config["PASSWORD_HASH_WORKERS"],
+                    thread_name_prefix="password"
+                )
+                atexit.register(pool.shutdown, wait=False, cancel_futures=True)
+                password_state["pool"] = pool
+                password_state["pid"] = os.getpid()
+    return password_state["pool"]
+
+
+def run_in_password_pool(func, *args):
+    """
+    Run a hasher function in the password pool and wait for it.
+
+    :raises TimeoutError: if the pool was too busy to run it in time
+    """
+
+    future = password_pool().submit(func, *args)
+    try:
+        return future.result(timeout=app.config["PASSWORD_HASH_TIMEOUT"])
+    except TimeoutError:
+        future.cancel()
+        raise
+
+
+def verify_password(phash, password):
+    """
+    Check a password against its hash.
+
+    :return: True if it matches, False otherwise
+    :raises TimeoutError: if the password pool was too busy
+    """
+
+    try:
+        return run_in_password_pool(hasher.verify, phash, password)
+    except argon2.exceptions.VerifyMismatchError:
+        return False
+
+
+def hash_password(password):
+    """
+    Hash a password.
+
+    :return: the hash
+    :raises TimeoutError: if the password pool was too busy
+    """
+
+    return run_in_password_pool(hasher.hash, password)
+
+
+def password_pool_busy():
+    """
+    Tell the client to try again once the password pool catches up.
+    """
+
+    response = make_response("""
+        <div class="alert alert-danger w-100" role="alert">
+            Too many logins at once, try again in a moment
+        </div>
+    """, 503)
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+# the hub pushing live dashboard metrics is per process as well
+hub_state = {"pid": None, "hub": None}
+hub_lock = threading.Lock()
+
+
+def metrics_hub():
+    """
+    Get this process' dashboard metrics hub, starting it if needed.
+    """
+
+    if hub_state["pid"] != os.getpid():
+        with hub_lock:
+            if hub_state["pid"] != os.getpid():
+                hub = events.MetricsHub(
+                    app,
+                    connect_db,
+                    render_dashboard_metrics,
+                    poll_interval=app.config["DASHBOARD_POLL_INTERVAL"]
+                )
+                hub.start()
+                atexit.register(hub.stop)
+                hub_state["hub"] = hub
+                hub_state["pid"] = os.getpid()
+    return hub_state["hub"]
+
+
+# background jobs are started per process too, and hold a lease in the
+# database while they run so only one process does each job's work
+jobs_state = {"pid": None, "jobs": []}
+jobs_lock = threading.Lock()
+
+
+@app.before_request
+def start_background_jobs():
+    if not app.config["BACKGROUND_JOBS"] or jobs_state["pid"] == os.getpid():
+        return
+
+    with jobs_lock:
+        if jobs_state["pid"] != os.getpid():
+            jobs_state["jobs"] = [
+                jobs.BackgroundJob(
+                    app,
+                    connect_db,
+                    "reclassify",
+                    lambda conn, job: jobs.reclassify(conn, job, app.config["RECLASSIFY_CHUNK_SIZE"]),
+                    app.config["RECLASSIFY_INTERVAL"]
+                ),
+                jobs.BackgroundJob(
+                    app,
+                    connect_db,
+                    "rollup",
+                    lambda conn, job: jobs.roll_up(conn, job, app.config["ROLLUP_CHUNK_SIZE"]),
+                    app.config["ROLLUP_INTERVAL"]
+                ),
+            ]
+            if app.config["RETENTION_DAYS"] and app.config["ARCHIVE_DIR"]:
+                jobs_state["jobs"].append(jobs.BackgroundJob(
+                    app,
+                    connect_db,
+                    "archive",
+                    lambda conn, job: jobs.archive(
+                        conn, job, app.config["ARCHIVE_DIR"],
+                        app.config["RETENTION_DAYS"], app.config["ARCHIVE_CHUNK_SIZE"]
+                    ),
+                    app.config["ARCHIVE_INTERVAL"]
+                ))
+            for job in jobs_state["jobs"]:
+                job.start()
+                atexit.register(job.stop)
+            jobs_state["pid"] = os.getpid()
 
 
 with app.app_context():
-    # this is used for the dashboard sensor selector
-    active_sensors = {}
-    for row in db.get_active_sensors(conn()):
-        active_sensors[row["name"]] = row
-    default_sensor = active_sensors[next(iter(active_sensors))]
+    # create tables and apply migrations once at startup
+    db.create_tables(conn())
 
     # load crops from config.json (if any)
     for crop in app.config["CROPS"]:
@@ -59,11 +352,239 @@ def check_is_admin():
         return redirect(url_for("dashboard"))
 
 
-def get_current_nutrient_levels(data):
+def send_temp_file(write, download_name, mimetype):
+    """
+    Write a file only this request uses and send it.
+    The file is deleted once it's sent.
+
+    :param write: a function that writes the file's contents
+                  to the binary file object it takes
+    :param download_name: the name the client saves the file as
+    :param mimetype: the file's mimetype
+    :return: the response
+    """
+
+    file = tempfile.TemporaryFile()
+    try:
+        write(file)
+    except BaseException:
+        file.close()
+        raise
+    file.seek(0)
+
+    return send_file(
+            file,
+            as_attachment=True,
+            download_name=download_name,
+            mimetype=mimetype
+    )
+
+
+def get_report_stats(start_date, end_date, sensor, crop):
+    """
+    Get the statistics of the nutrient data matching the given filters,
+    summed up by the database, or read off the data in one pass if the
+    range has archived months.
+
+    :return: the NutrientStats and the count of each class
+    """
+
+    totals = db.get_npk_data_stats(
+        conn(), start_date, end_date, sensor, crop,
+        archive_dir=app.config["ARCHIVE_DIR"],
+        sample_size=app.config["REPORT_STATS_SAMPLE_SIZE"]
+    )
+    if totals is not None:
+        return reporting.stats_from_totals(totals)
+
+    chunks = db.get_npk_data_chunks(
+        conn(), start_date, end_date, sensor, crop,
+        chunksize=app.config["REPORT_CHUNK_SIZE"],
+        archive_dir=app.config["ARCHIVE_DIR"]
+    )
+    return reporting.stats_from_chunks(chunks)
+
+
+def export_csv(start_date, end_date, sensor, crop):
+    """
+    Stream the nutrient data matching the given filters as CSV.
+    Rows are read and sent in chunks, never all at once.
+
+    :return: the streamed response
+    """
+
+    chunks = db.get_npk_data_chunks(
+        conn(), start_date, end_date, sensor, crop,
+        chunksize=app.config["REPORT_CHUNK_SIZE"],
+        archive_dir=app.config["ARCHIVE_DIR"]
+    )
+    response = Response(stream_with_context(reporting.iter_csv(chunks)), mimetype="text/csv")
+    response.headers["Content-Disposition"] = "attachment; filename=npk_data.csv"
+    return response
+
+
+def export_parquet(start_date, end_date, sensor, crop):
+    """
+    Send the nutrient data matching the given filters as a Parquet file,
+    written one row group per chunk of rows.
+
+    :return: the response, or an error if pyarrow isn't installed
+    """
+
+    if importlib.util.find_spec("pyarrow") is None:
+        return jsonify({"error": "Parquet exports need pyarrow installed"}), 501
+
+    chunks = db.get_npk_data_chunks(
+        conn(), start_date, end_date, sensor, crop,
+        chunksize=app.config["REPORT_CHUNK_SIZE"],
+        archive_dir=app.config["ARCHIVE_DIR"]
+    )
+    return send_temp_file(
+        lambda file: reporting.write_parquet(chunks, file),
+        "npk_data.parquet",
+        reporting.PARQUET_MIMETYPE
+    )
+
+
+def refresh_latest_readings(sensor_ids):
+    """
+    Classify the latest reading of the given sensors
+    and cache it for the dashboard.
+
+    :param sensor_ids: the sensors' ids
+    :return: how many of them had a reading to cache
+    """
+
+    rows = db.get_latest_npk_data_by_sensor(conn(), sensor_ids)
+    if not rows:
+        return 0
+
+    # readings are classified when stored, this only catches the odd stale one
+    data = clf.classify_stale(pd.DataFrame([dict(row) for row in rows]))
+    data = data.rename(columns={
+        "N": "n", "P": "p", "K": "k",
+        "clf_N": "clf_n", "clf_P": "clf_p", "clf_K": "clf_k"
+    })
+    db.set_latest_readings(conn(), data.drop(columns=["label"]).to_dict("records"))
+    metrics_hub().notify(data["sensor_id"].tolist())
+    return len(rows)
+
+
+def render_dashboard_metrics(sensor_name):
+    """
+    Render a sensor's dashboard metrics fragment.
+
+    :param sensor_name: the sensor's name
+    :return: the HTML
+    """
+
+    return render_template(
+        "dashboard-metrics.html",
+        current_sensor=sensor_registry.get(conn(), sensor_name),
+        **get_dashboard_metrics(sensor_name))
+
+
+def get_dashboard_metrics(sensor_name):
+    """
+    Get a sensor's latest nutrient levels and their classifications
+    from the latest readings cache, filling it in on a miss.
+
+    :param sensor_name: the sensor's name
+    :return: the values used by dashboard-metrics.html
+    """
+
+    reading = db.get_latest_reading(conn(), sensor_name)
+    if reading is None:
+        sensor = sensor_registry.get(conn(), sensor_name)
+        if sensor is not None:
+            refresh_latest_readings([sensor["id"]])
+            reading = db.get_latest_reading(conn(), sensor_name)
+
+    if reading is None:
+        # the sensor hasn't sent any data yet
+        return dict.fromkeys(["crop", "n", "p", "k", "clf_N", "clf_P", "clf_K"], "-")
+
     return {
-        "n": data.N.iat[0],
-        "p": data.P.iat[0],
-        "k": data.K.iat[0] 
+        "crop": reading["crop_name"],
+        "n": reading["n"],
+        "p": reading["p"],
+        "k": reading["k"],
+        "clf_N": reading["clf_n"],
+        "clf_P": reading["clf_p"],
+        "clf_K": reading["clf_k"]
+    }
+
+
+def get_fleet_overview():
+    """
+    Get the latest reading, its classifications and how stale it is for
+    every active sensor, and the same summed up per crop. It all comes
+    from the latest readings cache, filling in the sensors missing from
+    it with one more query for all of them.
+
+    :return: a dict with a 'sensors' and a 'crops' list
+    """
+
+    rows = db.get_fleet_readings(conn()) or []
+    missing = [row["sensor_id"] for row in rows if row["npk_id"] is None]
+    # sensors that never sent any data stay missing, which costs
+    # an indexed lookup each, like the dashboard does for one sensor
+    if missing and refresh_latest_readings(missing):
+        rows = db.get_fleet_readings(conn()) or []
+
+    stale_after = app.config["FLEET_STALE_AFTER"]
+    sensors = []
+    crops = {}
+    for row in rows:
+        reading = None
+        if row["npk_id"] is not None:
+            reading = {
+                "id": row["npk_id"],
+                "n": row["n"],
+                "p": row["p"],
+                "k": row["k"],
+                "clf_n": row["clf_n"],
+                "clf_p": row["clf_p"],
+                "clf_k": row["clf_k"],
+                "created_at": row["created_at"],
+                "age": row["age"]
+            }
+        stale = reading is None or reading["age"] > stale_after
+        sensors.append({
+            "id": row["sensor_id"],
+            "name": row["name"],
+            "desc": row["desc"],
+            "crop": row["crop_name"],
+            "reading": reading,
+            "stale": stale
+        })
+
+        crop = crops.setdefault(row["crop_name"], {
+            "crop": row["crop_name"],
+            "sensors": 0,
+            "stale": 0,
+            "reporting": 0,
+            "totals": {"n": 0, "p": 0, "k": 0},
+            "clf_n": {}, "clf_p": {}, "clf_k": {}
+        })
+        crop["sensors"] += 1
+        crop["stale"] += stale
+        if reading is not None:
+            crop["reporting"] += 1
+            for nutrient in ("n", "p", "k"):
+                crop["totals"][nutrient] += reading[nutrient]
+                counts = crop[f"clf_{nutrient}"]
+                counts[reading[f"clf_{nutrient}"]] = counts.get(reading[f"clf_{nutrient}"], 0) + 1
+
+    for crop in crops.values():
+        totals = crop.pop("totals")
+        for nutrient in ("n", "p", "k"):
+            crop[f"mean_{nutrient}"] = totals[nutrient] / crop["reporting"] if crop["reporting"] else None
+
+    return {
+        "stale_after": stale_after,
+        "sensors": sensors,
+        "crops": sorted(crops.values(), key=lambda crop: crop["crop"])
     }
 
 
@@ -74,9 +595,18 @@ def unauthorized():
 
 @login_manager.user_loader
 def load_user(user_id):
-    if user_id is not None:
-        return db.get_user(conn(), user_id)
-    return None
+    if user_id is None:
+        return None
+
+    # keyed on the users' version too, so a user changed or deleted by any
+    # process is read again, the way the other cross-process caches are
+    key = (user_id, db.get_cache_version(conn(), "users"))
+    user = user_cache.get(key)
+    if user is None:
+        user = db.get_user(conn(), user_id)
+        if user is not None:
+            user_cache.set(key, user)
+    return user
 
 
 @app.route("/app/login/", methods=["GET", "POST"])
@@ -100,28 +630,34 @@ def login():
         """
 
     try:
-        hasher.verify(user.phash, password)
-
-        if hasher.check_needs_rehash(user.phash):
-            user.phash = hasher.hash(password)
-            db.update_user(conn(), user.phash)
-
-        login_user(user)
-
-        user.last_login = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-        db.update_user(conn(), user)
+        verified = verify_password(user.phash, password)
+    except TimeoutError:
+        return password_pool_busy()
 
-        app.logger.info(f"Logged in user '{username}'")
-
-        response = make_response()
-        response.headers["HX-Redirect"] = url_for("dashboard")
-        return response
-    except argon2.exceptions.VerifyMismatchError:
+    if not verified:
         return """
             <div class="alert alert-danger w-100" role="alert">
                 Invalid username or password
             </div>
         """
+
+    if hasher.check_needs_rehash(user.phash):
+        try:
+            user.phash = hash_password(password)
+        except TimeoutError:
+            pass  # rehash on a later login
+
+    # the new hash (if any) and the login time in a single write
+    user.last_login = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    db.update_user(conn(), user)
+
+    login_user(user)
+
+    app.logger.info("Logged in user '%s'", username)
+
+    response = make_response()
+    response.headers["HX-Redirect"] = url_for("dashboard")
+    return response
     
 
 @app.route("/app/logout")
@@ -154,6 +690,7 @@ def sensors():
             """
         
         db.add_sensor(conn(), name, desc, crop, status)
+        sensor_registry.invalidate()
         return """
             <div class="alert alert-success w-100" role="alert">
                 Sensor registered successfully
@@ -161,17 +698,40 @@ def sensors():
         """
 
 
-@app.route("/app/sensors/search/", methods=["POST"])
+def render_search_page(search, name):
+    """
+    Render a page of search results: the whole table for the first page,
+    only its rows for the next ones, which are loaded as the last row
+    scrolls into view.
+
+    :param search: db.search_sensors or db.search_users
+    :param name: 'sensors' or 'users', as the templates call them
+    :return: the HTML
+    """
+
+    after = request.args.get("after", default=0, type=int)
+    page_size = app.config["SEARCH_PAGE_SIZE"]
+
+    def render():
+        # one more than a page tells if there's another one
+        rows = search(conn(), request.args.get("search", ""), after, page_size + 1)
+        more = rows is not None and len(rows) > page_size
+        if more:
+            rows = rows[:page_size]
+
+        template = f"{name}-table.html" if after == 0 else f"{name}-rows.html"
+        return render_template(template, **{name: rows}, more=more)
+
+    # the tables' names are their cache versions' too
+    return conditional(make_etag(db.get_cache_version(conn(), name), page_size), render)
+
+
+@app.route("/app/sensors/search/", methods=["GET"])
 @login_required
 def search_sensors():
     check_is_admin()
 
-    search = request.form["search"]
-    if (search is None or search == ""):
-        sensors = db.get_all_sensors(conn())
-    else:
-        sensors = db.search_sensors(conn(), search)
-    return render_template("sensors-table.html", sensors=sensors)
+    return render_search_page(db.search_sensors, "sensors")
 
 
 @app.route("/app/reports/", methods=["GET", "POST"])
@@ -187,36 +747,51 @@ def reports():
         end_date = data["end_date"]
         sensor = data["sensor-selector"]
         crop = data["crop-selector"]
+        # readings, a row per sensor and hour or day from the rollups, or only the statistics
+        detail = data.get("detail-selector", "readings")
+
+        if detail == "stats":
+            stats, classes = get_report_stats(start_date, end_date, sensor, crop)
+            write = lambda file: reporting.write_stats_xlsx(stats, classes, file)
+        elif detail in db.ROLLUPS:
+            chunks = db.get_npk_rollup_chunks(
+                conn(), detail, start_date, end_date, sensor, crop,
+                chunksize=app.config["REPORT_CHUNK_SIZE"]
+            )
+            write = lambda file: reporting.write_rollup_xlsx(chunks, file)
+        else:
+            chunks = db.get_npk_data_chunks(
+                conn(), start_date, end_date, sensor, crop,
+                chunksize=app.config["REPORT_CHUNK_SIZE"],
+                archive_dir=app.config["ARCHIVE_DIR"]
+            )
+            write = lambda file: reporting.write_xlsx(chunks, file)
+
+        return send_temp_file(
+            write,
+            "report.xlsx",
+            reporting.XLSX_MIMETYPE
+        )
 
-        df = db.get_npk_data_df(conn(), start_date, end_date, sensor, crop)
-        
-        def classify_row(row):
-            result = clf.classify(row.to_frame().T)
-            return pd.Series({
-                "clf_N": result["clf_N"],
-                "clf_P": result["clf_P"],
-                "clf_K": result["clf_K"]
-            })
-
-        df[["clf_N", "clf_P", "clf_K"]] = df.apply(classify_row, axis=1)
-        df = df.drop(columns=["label"])
-        
-        stats = df[["N", "P", "K"]].describe()
 
-        mean_N, mean_P, mean_K = stats.loc["mean", ["N", "P", "K"]]
+@app.route("/app/reports/csv/", methods=["POST"])
+@login_required
+def export_report_csv():
+    data = request.form
+    return export_csv(
+        data["start_date"], data["end_date"],
+        data.get("sensor-selector", "any"), data.get("crop-selector", "any")
+    )
 
-        stats.loc["N:P ratio"] = [mean_N / mean_P if mean_P else np.nan, np.nan, np.nan]
-        stats.loc["N:K ratio"] = [mean_N / mean_K if mean_K else np.nan, np.nan, np.nan]
-        stats.loc["P:K ratio"] = [np.nan, mean_P / mean_K if mean_K else np.nan, np.nan]
 
-        with pd.ExcelWriter("report.xlsx") as writer:
-            df.to_excel(writer, sheet_name="Data", index=False)
-            stats.to_excel(writer, sheet_name="Stats")
-        return send_from_directory(
-                "../", "report.xlsx", 
-                as_attachment=True, 
-                mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+@app.route("/app/reports/parquet/", methods=["POST"])
+@login_required
+def export_report_parquet():
+    data = request.form
+    return export_parquet(
+        data["start_date"], data["end_date"],
+        data.get("sensor-selector", "any"), data.get("crop-selector", "any")
+    )
 
 
 @app.route("/app/users/", methods=["GET", "POST"])
@@ -247,7 +822,12 @@ def users():
                 </div>
             """
         
-        db.add_user(conn(), username, hasher.hash(password))
+        try:
+            phash = hash_password(password)
+        except TimeoutError:
+            return password_pool_busy()
+
+        db.add_user(conn(), username, phash)
         return """
             <div class="alert alert-success w-100" role="alert">   
                 User registered successfully
@@ -255,18 +835,12 @@ def users():
         """
 
 
-@app.route("/app/users/search/", methods=["POST"])
+@app.route("/app/users/search/", methods=["GET"])
 @login_required
 def search_users():
     check_is_admin()
 
-    search = request.form["search"]
-    if (search is None or search == ""):
-        users = db.get_all_users(conn())
-    else:
-        users = db.search_users(conn(), search)
-
-    return render_template("users-table.html", users=users)
+    return render_search_page(db.search_users, "users")
 
 @app.route("/app/users/delete/", methods=["DELETE"])
 @login_required
@@ -300,33 +874,86 @@ def delete_user():
 @app.route("/app/dashboard/", methods=["GET"])
 @login_required
 def dashboard():
-    data = db.get_latest_npk_data_df(conn(), default_sensor["name"], n=1)
-    nutrient_levels = get_current_nutrient_levels(data)
-    classifications = clf.classify(data)
+    default_sensor = sensor_registry.default(conn())
     return render_template(
         "dashboard.html",
         username = current_user.username,
-        sensors=active_sensors.keys(),
+        sensors=sensor_registry.names(conn()),
         current_sensor=default_sensor,
-        crop=data.crop_name.iat[0],
-        **nutrient_levels,
-        **classifications
+        **(get_dashboard_metrics(default_sensor["name"]) if default_sensor is not None else {})
     )
 
 
 @app.route("/app/dashboard/update/", methods=["GET"])
 @login_required
 def update_dashboard():
-    current_sensor_name = request.args.get("current_sensor", default_sensor["name"])
-    data = db.get_latest_npk_data_df(conn(), current_sensor_name, n=1)
-    nutrient_levels = get_current_nutrient_levels(data)
-    classifications = clf.classify(data)
-    return render_template(
-        "dashboard-metrics.html",
-        current_sensor=active_sensors[current_sensor_name],
-        crop=data.crop_name.iat[0],
-        **nutrient_levels,
-        **classifications)
+    current_sensor_name = request.args.get("current_sensor")
+    if current_sensor_name is None:
+        current_sensor = sensor_registry.default(conn())
+    else:
+        current_sensor = sensor_registry.get(conn(), current_sensor_name)
+    if current_sensor is None:
+        return jsonify({"error": "Unknown sensor"}), 404
+
+    etag = make_etag(
+        current_sensor["id"],
+        sensor_registry.version,
+        db.get_latest_reading_id(conn(), current_sensor["id"])
+    )
+    return conditional(etag, lambda: render_template(
+        "dashboard-live.html",
+        current_sensor=current_sensor,
+        **get_dashboard_metrics(current_sensor["name"])))
+
+
+@app.route("/app/fleet/", methods=["GET"])
+@login_required
+def fleet():
+    return render_template("fleet.html", **get_fleet_overview())
+
+
+@app.route("/app/fleet/update/", methods=["GET"])
+@login_required
+def update_fleet():
+    return render_template("fleet-tables.html", **get_fleet_overview())
+
+
+@app.route("/app/dashboard/events/", methods=["GET"])
+@login_required
+def dashboard_events():
+    """
+    Stream a sensor's dashboard metrics as Server-Sent Events,
+    a 'metrics' event with the rendered fragment per new reading.
+    """
+
+    current_sensor_name = request.args.get("current_sensor")
+    if current_sensor_name is None:
+        current_sensor = sensor_registry.default(conn())
+    else:
+        current_sensor = sensor_registry.get(conn(), current_sensor_name)
+    if current_sensor is None:
+        return jsonify({"error": "Unknown sensor"}), 404
+
+    hub = metrics_hub()
+    subscription = hub.subscribe(current_sensor["id"], current_sensor["name"])
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                fragment = subscription.get(timeout=app.config["DASHBOARD_KEEPALIVE"])
+                if fragment is None:
+                    # finds out about clients that went away
+                    yield ": keepalive\n\n"
+                    continue
+                yield "event: metrics\n" + "".join(f"data: {line}\n" for line in fragment.splitlines()) + "\n"
+        finally:
+            hub.unsubscribe(subscription)
+
+    return Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
 
 
 def require_api_key(view_function):
@@ -390,24 +1017,385 @@ def add_npk_data():
     except (KeyError, ValueError):
         return jsonify({"error": "Invalid data format"}), 400
 
-    db.add_npk_data(conn(), n, p, k, sensor_id)
+    if not app.config["INGEST_WRITE_BEHIND"]:
+        classified = ingest.classify_rows(conn(), [(n, p, k, sensor_id, None)])[0]
+        db.add_npk_data(conn(), n, p, k, sensor_id, *classified[5:])
+        metrics.INGESTED_ROWS.inc(path="sync")
+        refresh_latest_readings([sensor_id])
+        return jsonify({"message": "Data stored successfully", "data": data}), 201
+
+    # the writer commits later, so catch readings it would have to drop now
+    if sensor_id not in db.get_sensor_ids(conn(), [sensor_id]):
+        return jsonify({"error": "Unknown sensor"}), 400
+
+    try:
+        ingest_queue().put([(n, p, k, sensor_id, utc_now())])
+    except ingest.QueueFull:
+        return queue_full()
+
+    return jsonify({"message": "Data queued successfully", "data": data}), 202
 
-    return jsonify({"message": "Data stored successfully", "data": data}), 201
+
+def utc_now():
+    """
+    Get the current time the way SQLite's CURRENT_TIMESTAMP formats it.
+    Queued readings are stamped when they arrive, not when committed.
+    """
+
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def queue_full():
+    """
+    Tell the client to back off while the ingestion queue is full.
+    """
+
+    response = jsonify({"error": "Too many readings waiting to be stored, try again later"})
+    response.headers["Retry-After"] = "1"
+    return response, 429
+
+
+def parse_timestamp(value):
+    """
+    Parse a reading's timestamp into the format SQLite's
+    CURRENT_TIMESTAMP uses (UTC, 'YYYY-MM-DD HH:MM:SS').
+
+    :param value: an ISO 8601 string or a unix timestamp
+    :return: the formatted timestamp
+    """
+
+    if isinstance(value, bool):
+        raise ValueError("Invalid timestamp")
+    if isinstance(value, (int, float)):
+        ts = datetime.fromtimestamp(value, timezone.utc)
+    else:
+        ts = datetime.fromisoformat(str(value))
+        if ts.tzinfo is not None:
+            ts = ts.astimezone(timezone.utc)
+    return ts.strftime("%Y-%m-%d %H:%M:%S")
+
+
+@app.route("/api/data/batch/", methods=["POST"])
+@require_api_key
+def add_npk_data_batch():
+    """
+    Add many nutrient readings to the database at once.
+    Every valid reading is stored in a single transaction,
+    invalid ones are reported back by their index.
+
+    :return: success response with the number of stored readings
+             and the errors of the invalid ones, or error if
+             none of them are valid
+    """
+
+    if not request.is_json:
+        return jsonify({"error": "Must be a JSON request"}), 400
+
+    data = request.get_json()
+    if not isinstance(data, list):
+        return jsonify({"error": "Must be a JSON array of readings"}), 400
+    if len(data) > app.config["MAX_BATCH_SIZE"]:
+        return jsonify({"error": f"At most {app.config['MAX_BATCH_SIZE']} readings per batch"}), 413
+
+    rows = []
+    indexes = []
+    errors = []
+    for i, item in enumerate(data):
+        try:
+            n = float(item["n"])
+            p = float(item["p"])
+            k = float(item["k"])
+            sensor_id = int(item["sensor_id"])
+            timestamp = item.get("timestamp")
+            if timestamp is not None:
+                timestamp = parse_timestamp(timestamp)
+        except (KeyError, ValueError, TypeError, AttributeError, OverflowError, OSError):
+            errors.append({"index": i, "error": "Invalid data format"})
+            continue
+        rows.append((n, p, k, sensor_id, timestamp))
+        indexes.append(i)
+
+    # check all the sensors with a single query
+    try:
+        sensor_ids = db.get_sensor_ids(conn(), [row[3] for row in rows])
+    except sqlite3.Error:
+        return jsonify({"error": "Could not store data"}), 503
+
+    valid = []
+    for i, row in zip(indexes, rows):
+        if row[3] in sensor_ids:
+            valid.append(row)
+        else:
+            errors.append({"index": i, "error": "Unknown sensor"})
+    errors.sort(key=lambda error: error["index"])
+
+    if len(valid) == 0:
+        return jsonify({"error": "No valid readings", "errors": errors}), 400
+
+    if app.config["INGEST_WRITE_BEHIND"]:
+        now = utc_now()
+        try:
+            ingest_queue().put([
+                (n, p, k, sensor_id, timestamp or now)
+                for n, p, k, sensor_id, timestamp in valid
+            ])
+        except ingest.QueueFull:
+            return queue_full()
+
+        return jsonify({
+            "message": "Data queued successfully",
+            "queued": len(valid),
+            "errors": errors
+        }), 202
+
+    try:
+        db.add_npk_data_batch(conn(), ingest.classify_rows(conn(), valid))
+    except sqlite3.Error:
+        metrics.INGEST_FAILURES.inc(len(valid), reason="database")
+        return jsonify({"error": "Could not store data"}), 503
+    metrics.INGESTED_ROWS.inc(len(valid), path="sync")
+    refresh_latest_readings({row[3] for row in valid})
+
+    return jsonify({
+        "message": "Data stored successfully",
+        "stored": len(valid),
+        "errors": errors
+    }), 201
+
+
+@app.route("/api/ingest/metrics/", methods=["GET"])
+@require_api_key
+def get_ingest_metrics():
+    """
+    Get this process' ingestion queue metrics: queue depth,
+    accepted, rejected and committed readings, and commit latency.
+
+    :return: the metrics
+    """
+
+    if not app.config["INGEST_WRITE_BEHIND"]:
+        return jsonify({"error": "Write-behind ingestion is disabled"}), 404
+
+    return jsonify(dict(ingest_queue().metrics, pid=os.getpid()))
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Get this process' metrics in the Prometheus text format.
+    """
+
+    if not metrics.enabled:
+        return jsonify({"error": "Metrics are disabled"}), 404
+
+    if ingest_state["pid"] == os.getpid():
+        metrics.INGEST_QUEUE_DEPTH.set(ingest_state["queue"].metrics["queue_depth"])
+
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def parse_query_timestamp(value):
+    """
+    Parse a timestamp from a query string, where unix
+    timestamps come as strings too.
+
+    :return: the formatted timestamp, None if there's none
+    """
+
+    if not value:
+        return None
+    try:
+        return parse_timestamp(float(value))
+    except ValueError:
+        return parse_timestamp(value)
+
+
+def encode_cursor(order, row):
+    """
+    Make the cursor of the page after the given row.
+
+    :param order: 'asc' or 'desc'
+    :param row: the last row of the page
+    :return: the cursor, an opaque string to clients
+    """
+
+    key = json.dumps([order, row["created_at"], row["id"]])
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, order):
+    """
+    Get the (created_at, id) the page after a cursor starts after.
+
+    :raises ValueError: if the cursor is invalid or for another order
+    """
+
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        cursor_order, created_at, row_id = key
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if cursor_order != order or not isinstance(created_at, str) or not isinstance(row_id, int):
+        raise ValueError("Invalid cursor")
+    return created_at, row_id
 
 
 @app.route("/api/data/", methods=["GET"])
 @require_api_key
 def get_latest_data():
     """
-    Get the latest N rows of sensor data from the database.
+    Get nutrient data one page at a time, newest first by default.
+    Query parameters, all optional:
+
+    - n: rows per page (default 10, at most MAX_PAGE_SIZE)
+    - sensor_id, crop: only the data of this sensor id or crop name
+    - start, end: only the data created at or after start and before
+      end, as ISO 8601 strings or unix timestamps
+    - order: 'desc' (default) or 'asc'
+    - cursor: the previous page's next_cursor, with the same filters
+
+    :return: the streamed JSON, an object with the page's rows in 'data'
+             and the cursor of the next page in 'next_cursor' (null
+             on the last page)
+    """
+
+    try:
+        n = min(int(request.args.get("n", 10)), app.config["MAX_PAGE_SIZE"])
+        sensor_id = request.args.get("sensor_id")
+        sensor_id = int(sensor_id) if sensor_id is not None else None
+        start = parse_query_timestamp(request.args.get("start"))
+        end = parse_query_timestamp(request.args.get("end"))
+        order = request.args.get("order", "desc")
+        if order not in ("asc", "desc") or n < 1:
+            raise ValueError
+    except (ValueError, OverflowError, OSError):
+        return jsonify({"error": "Invalid parameters"}), 400
+
+    after = None
+    if "cursor" in request.args:
+        try:
+            after = decode_cursor(request.args["cursor"], order)
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+
+    # new readings raise the last id, or the version of their sensor's
+    # readings so other sensors' don't change the pages of one. reclassifying
+    # and archiving them bump npk_data's version, and the crop filter
+    # depends on the sensors' crops
+    if sensor_id is not None:
+        readings_version = db.get_readings_version(conn(), sensor_id)
+    else:
+        readings_version = db.get_last_npk_data_id(conn())
+    etag = make_etag(
+        readings_version,
+        db.get_cache_version(conn(), "npk_data"),
+        db.get_cache_version(conn(), "sensors"),
+        app.config["MAX_PAGE_SIZE"]
+    )
+
+    def stream():
+        yield '{"data": ['
+        count = 0
+        last = None
+        chunks = db.get_npk_data_page(
+            conn(), n, sensor_id, request.args.get("crop"), start, end,
+            after, descending=order == "desc"
+        )
+        for rows in chunks:
+            yield ("," if count else "") + ",".join(json.dumps(dict(row)) for row in rows)
+            count += len(rows)
+            last = rows[-1]
+        # a full page may be followed by more
+        next_cursor = encode_cursor(order, last) if count == n else None
+        yield '], "next_cursor": ' + json.dumps(next_cursor) + "}"
+
+    return conditional(etag, lambda: Response(stream_with_context(stream()), mimetype="application/json"))
+
+
+@app.route("/api/fleet/", methods=["GET"])
+@require_api_key
+def get_fleet():
+    """
+    Get the latest reading of every active sensor and the per crop totals.
 
-    :return: the data
+    :return: the JSON of the fleet overview, 'sensors' with each active
+             sensor's latest reading (null if it never sent any) and
+             whether it's stale, and 'crops' with each crop's sensor,
+             stale and reporting counts, mean levels and the counts of
+             each classification
     """
 
-    n = request.args.get("n", default=10, type=int)
-    rows = db.get_latest_npk_data(conn(), n)
-    data = [dict(row) for row in rows]
-    return jsonify(data)
+    return jsonify(get_fleet_overview())
+
+
+@app.route("/api/data/export/csv/", methods=["GET"])
+@require_api_key
+def export_data_csv():
+    """
+    Export the nutrient data in a date range as CSV, optionally
+    filtered by sensor and crop name ('any' by default).
+
+    :return: the streamed CSV
+    """
+
+    try:
+        start_date = request.args["start_date"]
+        end_date = request.args["end_date"]
+    except KeyError:
+        return jsonify({"error": "start_date and end_date are required"}), 400
+
+    return export_csv(
+        start_date, end_date,
+        request.args.get("sensor", "any"), request.args.get("crop", "any")
+    )
+
+
+@app.route("/api/data/stats/", methods=["GET"])
+@require_api_key
+def get_data_stats():
+    """
+    Get the statistics of the nutrient data in a date range, optionally
+    filtered by sensor and crop name ('any' by default), without the data.
+
+    :return: the JSON of the count, each nutrient's count, mean, std, min,
+             percentiles and max, how many readings fell in each class by
+             their stored classifications, and the N:P, N:K and P:K
+             ratios of the means
+    """
+
+    try:
+        start_date = request.args["start_date"]
+        end_date = request.args["end_date"]
+    except KeyError:
+        return jsonify({"error": "start_date and end_date are required"}), 400
+
+    stats, classes = get_report_stats(
+        start_date, end_date,
+        request.args.get("sensor", "any"), request.args.get("crop", "any")
+    )
+    return jsonify(reporting.stats_to_dict(stats, classes))
+
+
+@app.route("/api/data/export/parquet/", methods=["GET"])
+@require_api_key
+def export_data_parquet():
+    """
+    Export the nutrient data in a date range as Parquet, optionally
+    filtered by sensor and crop name ('any' by default).
+
+    :return: the Parquet file
+    """
+
+    try:
+        start_date = request.args["start_date"]
+        end_date = request.args["end_date"]
+    except KeyError:
+        return jsonify({"error": "start_date and end_date are required"}), 400
+
+    return export_parquet(
+        start_date, end_date,
+        request.args.get("sensor", "any"), request.args.get("crop", "any")
+    )
 
 
 @app.route("/api/sensors/", methods=["POST"])
@@ -435,11 +1423,12 @@ def add_sensor():
         return jsonify({"error": "Invalid data format"}), 400
     
     try:
-        db.add_sensor(conn(), name, desc, crop, status)
+        sensor_id = db.add_sensor(conn(), name, desc, crop, status)
     except sqlite3.IntegrityError:
         return jsonify({"error": "Sensor already exists"}), 409
+    sensor_registry.invalidate()
 
-    return jsonify({"message": "Sensor registered successfully", "data": data}), 201
+    return jsonify({"message": "Sensor registered successfully", "id": sensor_id, "data": data}), 201
 
 
 @app.route("/favicon.ico/")
@@ -459,7 +1448,7 @@ def handle_exception(e):
     :return: the error response
     """
 
-    app.logger.error(f"Unhandled Exception: {str(e)}", exc_info=True)
+    app.logger.error("Unhandled Exception: %s", e, exc_info=True)
 
     return jsonify({"error": "Internal server error"}), 500
 
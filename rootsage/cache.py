@@ -0,0 +1,64 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+
+"""
+A small in-memory cache for values that are read on almost every request
+and rarely change, like the logged in user. Each process keeps its own, so
+changes made by other processes only show once their entries expire, unless
+the keys include a version that those changes bump.
+"""
+
+
+class TTLCache:
+    """
+    A thread-safe cache that holds at most maxsize entries, dropping the
+    least recently used one when full, each for at most ttl seconds.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        """
+        :param maxsize: the most entries kept
+        :param ttl: how long an entry is kept, in seconds
+        """
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires at, value)
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        :return: the cached value, default if there's none or it expired
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        """
+        Drop an entry, after the value it holds changed.
+        """
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -1,11 +1,19 @@
+import os
+import time
+import hashlib
+import logging
+import threading
 import joblib
+import numpy as np
+import pandas as pd
 
-from numpy import vectorize
+from rootsage import metrics
 
 
-clf_N = joblib.load("rootsage/classifiers/N.joblib")
-clf_P = joblib.load("rootsage/classifiers/P.joblib")
-clf_K = joblib.load("rootsage/classifiers/K.joblib")
+logger = logging.getLogger(__name__)
+
+# the models were trained on 22 crops, labeled 0 to 21
+NUM_LABELS = 22
 
 clf_mapping = {
     0: "Low",
@@ -13,7 +21,331 @@ clf_mapping = {
     2: "Okay"
 }
 
+"""
+clf_mapping as an array, where the label of class i is at index i.
+indexing it with an array of predictions maps all of them at once,
+which is a lot cheaper than calling clf_mapping.get once per value
+"""
+clf_labels = np.array([clf_mapping[i] for i in sorted(clf_mapping)], dtype=object)
+
+
+class CompiledForest:
+    """
+    A tree ensemble compiled into per-crop lookup tables.
+
+    The models only take two inputs: a nutrient value and a crop label.
+    For a fixed crop, every tree (and so the whole forest) is a piecewise
+    constant function of the nutrient that can only change at one of the
+    split thresholds on it. Predicting once for each interval between those
+    thresholds gives a sorted breakpoint array and the class of each
+    interval, so classifying a value is a binary search instead of a walk
+    down hundreds of trees.
+    """
+
+    def __init__(self, model, num_labels=NUM_LABELS):
+        """
+        :param model: the fitted tree ensemble (or single tree)
+        :param num_labels: the number of crop labels the model knows
+        """
+
+        if getattr(model, "n_features_in_", None) != 2:
+            raise ValueError("Only models with a nutrient and a label input can be compiled")
+
+        self.model = model
+        self.num_labels = num_labels
+
+        # the nutrient is the input that isn't the label
+        names = list(getattr(model, "feature_names_in_", []))
+        self.feature = 1 - names.index("label") if "label" in names else 0
+
+        thresholds = self._thresholds()
+        labels = np.arange(num_labels)
+        points = self._interval_points(thresholds)
+        pred = self._predict_model(np.tile(points, num_labels), np.repeat(labels, len(points)))
+        pred = pred.reshape(num_labels, len(points))
+
+        # only keep the thresholds where the class actually changes
+        self.breakpoints = []
+        self.classes = []
+        for row in pred:
+            change = row[1:] != row[:-1]
+            self.breakpoints.append(thresholds[change])
+            self.classes.append(np.concatenate((row[:1], row[1:][change])))
+
+        self.dtype = pred.dtype
+
+    def _thresholds(self):
+        """
+        Get the sorted, unique split thresholds on the nutrient
+        across all the trees.
+        """
+
+        estimators = getattr(self.model, "estimators_", [self.model])
+        thresholds = [np.empty(0)]
+        for estimator in estimators:
+            tree = estimator.tree_
+            # leaves have a negative feature so they're left out here
+            thresholds.append(tree.threshold[tree.feature == self.feature])
+        return np.unique(np.concatenate(thresholds))
+
+    @staticmethod
+    def _interval_points(thresholds):
+        """
+        Get a value inside each interval split by the given thresholds.
+
+        The trees check 'x <= threshold' on float32 inputs, so the value
+        for the interval ending at a threshold is the largest float32 not
+        above it, and the last interval gets the smallest float32 above
+        the last threshold.
+        """
+
+        if len(thresholds) == 0:
+            return np.zeros(1, dtype=np.float32)
+
+        points = thresholds.astype(np.float32)
+        over = points.astype(np.float64) > thresholds
+        points[over] = np.nextafter(points[over], np.float32(-np.inf))
+
+        last = np.float32(thresholds[-1])
+        if last <= thresholds[-1]:
+            last = np.nextafter(last, np.float32(np.inf))
+        return np.append(points, last)
+
+    def _predict_model(self, values, labels):
+        """
+        Run the underlying model on the given nutrient values and labels.
+        """
+
+        X = np.empty((len(values), 2))
+        X[:, self.feature] = values
+        X[:, 1 - self.feature] = labels
+
+        names = getattr(self.model, "feature_names_in_", None)
+        if names is not None:
+            # avoid sklearn's warning about missing feature names
+            X = pd.DataFrame(X, columns=names)
+        return self.model.predict(X)
+
+    def predict(self, data):
+        """
+        Predict the classes of the given data using the lookup tables.
+        Rows the tables can't answer (missing values or unknown crops)
+        are passed on to the underlying model.
+
+        :param data: the nutrient and label columns, in the same order
+                     the model was trained with
+        :return: the predicted classes
+        """
+
+        X = np.asarray(data, dtype=np.float64)
+        # the trees compare float32 inputs, so round the same way
+        values = X[:, self.feature].astype(np.float32).astype(np.float64)
+        labels = X[:, 1 - self.feature]
+
+        known = (
+            ~np.isnan(values)
+            & (labels >= 0)
+            & (labels < self.num_labels)
+            & (labels == np.floor(labels))
+        )
+        labels = np.where(known, labels, 0).astype(np.intp)
+
+        pred = np.empty(len(X), dtype=self.dtype)
+        for label in np.unique(labels[known]):
+            rows = known & (labels == label)
+            idx = np.searchsorted(self.breakpoints[label], values[rows], side="left")
+            pred[rows] = self.classes[label][idx]
+
+        if not known.all():
+            pred[~known] = self.model.predict(data[~known])
+        return pred
+
+    def verify(self):
+        """
+        Check that the lookup tables agree with the underlying model over
+        the full input range: every threshold, the values right next to
+        it, the midpoints between thresholds and every whole number from
+        below the first threshold to above the last one, for every crop.
+
+        :return: True if every prediction matches, False otherwise
+        """
+
+        thresholds = self._thresholds()
+        if len(thresholds) > 0:
+            t32 = thresholds.astype(np.float32)
+            values = np.concatenate((
+                thresholds,
+                self._interval_points(thresholds),
+                np.nextafter(t32, np.float32(np.inf)),
+                np.nextafter(t32, np.float32(-np.inf)),
+                (thresholds[1:] + thresholds[:-1]) / 2,
+                np.arange(np.floor(thresholds[0]) - 1, np.ceil(thresholds[-1]) + 2),
+            ))
+        else:
+            values = np.arange(-1, 2)
+        values = np.unique(values.astype(np.float32))
+
+        labels = np.repeat(np.arange(self.num_labels), len(values))
+        values = np.tile(values, self.num_labels)
+
+        X = np.empty((len(values), 2))
+        X[:, self.feature] = values
+        X[:, 1 - self.feature] = labels
+
+        return np.array_equal(self.predict(X), self._predict_model(values, labels))
+
+
+def compile_model(model):
+    """
+    Compile the given model into lookup tables, falling back to the
+    model itself if it can't be compiled or the tables don't match
+    its predictions.
+
+    :param model: the fitted sklearn model
+    :return: an object with a predict method
+    """
+
+    try:
+        compiled = CompiledForest(model)
+        if compiled.verify():
+            return compiled
+        logger.warning("Compiled model does not match %s, using it as is", type(model).__name__)
+    except (AttributeError, ValueError):
+        logger.warning("Could not compile %s, using it as is", type(model).__name__, exc_info=True)
+    return model
+
+
+"""
+the models are loaded the first time they're needed instead of at import
+time. a lock makes sure concurrent requests load each of them only once.
+servers that fork their workers can call preload() before forking so all
+of them share the parent's copy instead of loading their own
+"""
+settings = {
+    "classifiers_dir": os.path.join(os.path.dirname(__file__), "classifiers"),
+    "mmap_mode": None,
+    "compiled": True,
+}
+models = {}
+predictors = {}
+versions = {}
+load_lock = threading.Lock()
+
+
+def configure(classifiers_dir=None, mmap_mode=None, compiled=True):
+    """
+    Set how the models are loaded. Models that were
+    already loaded are dropped and loaded again on demand.
+
+    :param classifiers_dir: the directory with the N, P and K .joblib
+                            files (defaults to rootsage/classifiers)
+    :param mmap_mode: passed to joblib.load, e.g. 'r' to memory map
+                      the models' arrays instead of reading them
+    :param compiled: whether to compile the models into lookup tables
+    """
+
+    with load_lock:
+        if classifiers_dir is not None:
+            settings["classifiers_dir"] = classifiers_dir
+        settings["mmap_mode"] = mmap_mode
+        settings["compiled"] = compiled
+        models.clear()
+        predictors.clear()
+        versions.clear()
+
+
+def get_model(nutrient):
+    """
+    Get the sklearn model for the given nutrient, loading it if needed.
+
+    :param nutrient: 'N', 'P' or 'K'
+    :return: the fitted model
+    """
+
+    model = models.get(nutrient)
+    if model is None:
+        with load_lock:
+            model = models.get(nutrient)
+            if model is None:
+                path = os.path.join(settings["classifiers_dir"], f"{nutrient}.joblib")
+                start = time.perf_counter()
+                model = joblib.load(path, mmap_mode=settings["mmap_mode"])
+                models[nutrient] = model
+                logger.info(
+                    "Loaded %s model in %.2fs (mmap_mode=%s)",
+                    nutrient, time.perf_counter() - start, settings["mmap_mode"]
+                )
+    return model
+
+
+def get_predictor(nutrient):
+    """
+    Get what should be used to predict the given nutrient's classes:
+    the compiled lookup tables if possible, the sklearn model otherwise.
+
+    :param nutrient: 'N', 'P' or 'K'
+    :return: an object with a predict method
+    """
+
+    predictor = predictors.get(nutrient)
+    if predictor is None:
+        model = get_model(nutrient)
+        with load_lock:
+            predictor = predictors.get(nutrient)
+            if predictor is None:
+                predictor = compile_model(model) if settings["compiled"] else model
+                predictors[nutrient] = predictor
+    return predictor
+
+
+def model_version():
+    """
+    Get a short hash of the N, P and K model files. Classifications
+    stored with any other version were made by other models.
+
+    :return: the version
+    """
+
+    version = versions.get("models")
+    if version is None:
+        digest = hashlib.sha256()
+        for nutrient in ("N", "P", "K"):
+            path = os.path.join(settings["classifiers_dir"], f"{nutrient}.joblib")
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        version = digest.hexdigest()[:16]
+        versions["models"] = version
+    return version
+
+
+def preload():
+    """
+    Load (and compile) all the models right away.
+    """
+
+    for nutrient in ("N", "P", "K"):
+        get_predictor(nutrient)
+
 
+def __getattr__(name):
+    # keep clf.clf_N and friends working now that loading is lazy
+    if name in ("clf_N", "clf_P", "clf_K"):
+        return get_model(name[-1])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def to_labels(pred):
+    """
+    Map an array of predicted classes to their labels.
+
+    :param pred: the predicted classes
+    :return: an array with 'Low', 'High' or 'Okay' for each class
+    """
+
+    return clf_labels[np.asarray(pred, dtype=np.intp)]
+
+
+@metrics.timed(metrics.CLASSIFY_SECONDS)
 def classify_N(data):
     """
     Classify the given nitrogen levels depending on
@@ -22,15 +354,11 @@ def classify_N(data):
     :param data: the data to be classified
     """
 
-    pred = clf_N.predict(data)
-    """
-    vectorize(clf_mapping.get) returns a function
-    that behaves like dict.get but takes a numpy array
-    so all 0s will become 'low', 1s to 'high', and so on
-    """
-    return vectorize(clf_mapping.get)(pred)
+    pred = get_predictor("N").predict(data)
+    return to_labels(pred)
 
 
+@metrics.timed(metrics.CLASSIFY_SECONDS)
 def classify_P(data):
     """
     Classify the given phosphorus levels depending on
@@ -39,10 +367,11 @@ def classify_P(data):
     :param data: the data to be classified
     """
 
-    pred = clf_P.predict(data)
-    return vectorize(clf_mapping.get)(pred)
+    pred = get_predictor("P").predict(data)
+    return to_labels(pred)
 
 
+@metrics.timed(metrics.CLASSIFY_SECONDS)
 def classify_K(data):
     """
     Classify the given potassium levels depending on
@@ -51,13 +380,58 @@ def classify_K(data):
     :param data: the data to be classified
     """
 
-    pred = clf_K.predict(data)
-    return vectorize(clf_mapping.get)(pred)
+    pred = get_predictor("K").predict(data)
+    return to_labels(pred)
 
 
+@metrics.timed(metrics.CLASSIFY_SECONDS)
 def classify(data):
     return {
-        "clf_N": classify_N(data[["N", "label"]])[0], 
-        "clf_P": classify_P(data[["P", "label"]])[0], 
+        "clf_N": classify_N(data[["N", "label"]])[0],
+        "clf_P": classify_P(data[["P", "label"]])[0],
         "clf_K": classify_K(data[["K", "label"]])[0]
-    }
\ No newline at end of file
+    }
+
+
+@metrics.timed(metrics.CLASSIFY_SECONDS)
+def classify_frame(data):
+    """
+    Classify every row of the given data in one go. Each model
+    is called once for the whole frame instead of once per row.
+
+    :param data: a DataFrame with N, P, K and label columns
+    :return: a copy of the data with clf_N, clf_P and clf_K columns
+    """
+
+    if len(data) == 0:
+        empty = np.empty(0, dtype=object)
+        return data.assign(clf_N=empty, clf_P=empty, clf_K=empty)
+
+    return data.assign(
+        clf_N=classify_N(data[["N", "label"]]),
+        clf_P=classify_P(data[["P", "label"]]),
+        clf_K=classify_K(data[["K", "label"]])
+    )
+
+
+@metrics.timed(metrics.CLASSIFY_SECONDS)
+def classify_stale(data):
+    """
+    Like classify_frame, but for data that may already have classifications
+    stored along with the clf_version of the models that made them. Only
+    rows without them, or made by other models, are classified.
+
+    :param data: a DataFrame with N, P, K, label, clf_N, clf_P,
+                 clf_K and clf_version columns
+    :return: a copy of the data with all rows classified
+    """
+
+    stale = data["clf_version"].ne(model_version()) | data["clf_N"].isna()
+    if not stale.any():
+        return data
+
+    data = data.copy()
+    columns = ["clf_N", "clf_P", "clf_K"]
+    data[columns] = data[columns].astype(object)
+    data.loc[stale, columns] = classify_frame(data[stale])[columns]
+    return data
@@ -0,0 +1,108 @@
+import gzip
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+"""
+Compression of JSON and HTML responses, for field tablets on slow links.
+Brotli is used when the optional brotli package is installed and the
+client takes it, gzip otherwise. Bodies under a size threshold aren't
+worth the CPU and are sent as they are, streamed ones are compressed as
+they're sent since their size isn't known up front.
+"""
+
+
+COMPRESSIBLE = {"application/json", "text/html"}
+
+
+def choose_encoding(accept_encodings):
+    """
+    :param accept_encodings: the request's parsed Accept-Encoding
+    :return: 'br', 'gzip' or None if the client takes neither
+    """
+
+    if brotli is not None and accept_encodings["br"]:
+        return "br"
+    if accept_encodings["gzip"]:
+        return "gzip"
+    return None
+
+
+def compress(data, encoding, level):
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_stream(chunks, encoding, level):
+    """
+    Compress a streamed body chunk by chunk.
+
+    :param chunks: the body's chunks, str or bytes
+    :param encoding: 'br' or 'gzip'
+    :param level: the brotli quality or gzip level
+    :return: a generator of compressed chunks
+    """
+
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=level)
+        process, finish = compressor.process, compressor.finish
+    else:
+        # wbits 31 writes a gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+
+    try:
+        for chunk in chunks:
+            data = process(chunk.encode() if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        # the generator it wraps may have cleanup to do too
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response, accept_encodings, min_size=1024, level=6):
+    """
+    Compress a JSON or HTML response if the client takes it and the
+    body is large enough. Anything else is left as it is.
+
+    :param response: the response
+    :param accept_encodings: the request's parsed Accept-Encoding
+    :param min_size: the smallest body worth compressing, in bytes
+    :param level: the brotli quality (0-11) or gzip level (1-9)
+    :return: the response
+    """
+
+    if (
+        response.mimetype not in COMPRESSIBLE
+        or response.status_code < 200
+        or response.status_code in (204, 304)
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding(accept_encodings)
+    if encoding is None:
+        return response
+    level = min(level, 9) if encoding == "gzip" else level
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, level)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compress(data, encoding, level))
+
+    response.headers["Content-Encoding"] = encoding
+    return response
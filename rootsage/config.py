@@ -3,16 +3,71 @@ import logging
 
 class Config(object):
     TESTING = False
+    CLASSIFIERS_MMAP_MODE = None
+    COMPILE_CLASSIFIERS = True
+    PRELOAD_CLASSIFIERS = False
+    MAX_BATCH_SIZE = 1000
+    MAX_PAGE_SIZE = 10000
+    FLEET_STALE_AFTER = 900
+    FLEET_REFRESH_INTERVAL = 30
+    COMPRESS_RESPONSES = True
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_LEVEL = 6
+    REPORT_CHUNK_SIZE = 10000
+    REPORT_STATS_SAMPLE_SIZE = 1000
+    INGEST_WRITE_BEHIND = False
+    INGEST_QUEUE_SIZE = 10000
+    INGEST_BATCH_SIZE = 500
+    INGEST_FLUSH_INTERVAL = 0.05  # seconds
+    INGEST_SPOOL_FSYNC = False
+    INGEST_SPOOL_MAX_SIZE = 16 * 2**20  # bytes
+    BACKGROUND_JOBS = True
+    RECLASSIFY_INTERVAL = 60  # seconds
+    RECLASSIFY_CHUNK_SIZE = 5000
+    ROLLUP_INTERVAL = 60  # seconds
+    ROLLUP_CHUNK_SIZE = 5000
+    METRICS_ENABLED = False
+    DASHBOARD_POLL_INTERVAL = 1.0  # seconds
+    DASHBOARD_KEEPALIVE = 15  # seconds
+    SENSOR_REGISTRY_CHECK_INTERVAL = 1.0  # seconds
+    USER_CACHE_SIZE = 1024
+    SEARCH_PAGE_SIZE = 50
+    USER_CACHE_TTL = 60  # seconds
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_TIMEOUT = 10  # seconds
+    RETENTION_DAYS = None  # keep every reading in the database
+    ARCHIVE_DIR = None
+    ARCHIVE_INTERVAL = 3600  # seconds
+    ARCHIVE_CHUNK_SIZE = 5000
+    DB_JOURNAL_MODE = "WAL"
+    DB_SYNCHRONOUS = "NORMAL"
+    DB_BUSY_TIMEOUT = 5000  # ms
+    DB_MMAP_SIZE = 256 * 1024 * 1024  # 256 MB
+    DB_CACHE_SIZE = -64 * 1024  # 64 MB (negative means KiB)
+    LOG_QUEUE_SIZE = 10000
+    LOG_SAMPLE_RATES = {}
+    # per second, for the messages logged once per stored reading or batch
+    LOG_RATE_LIMITS = {
+        "add_npk_data": 10,
+        "add_npk_data_batch": 10,
+        "add_spooled_npk_data": 10,
+        "add_spooled_npk_data_each": 10,
+        "get_latest_npk_data_by_sensor": 10,
+    }
 
 
 class DevelopmentConfig(Config):
     DEBUG = True
     DB_NAME = "rootsage/app.db"
     LOGS_DIR = "rootsage/logs/"
+    INGEST_WRITE_BEHIND = True
+    INGEST_SPOOL_DIR = "rootsage/spool/"
+    ARCHIVE_DIR = "rootsage/archive/"
     LOG_LEVEL = logging.DEBUG
 
 
 class TestingConfig(Config):
     TESTING = True
     DB_NAME = ":memory:"
+    BACKGROUND_JOBS = False
     LOG_LEVEL = logging.WARNING
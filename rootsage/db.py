@@ -1,8 +1,15 @@
+import os
+import re
+import json
+import time
 import sqlite3
 
 from flask import current_app
-from pandas import read_sql_query
+from datetime import datetime, timedelta
+from urllib.request import pathname2url
+from pandas import read_sql_query, concat
 from flask_login import UserMixin
+from rootsage import metrics
 
 
 """
@@ -13,6 +20,397 @@ more types of measurements can be added, support for crop rotation, and more.
 """
 
 
+@metrics.timed(metrics.DB_SECONDS)
+def connect(db_name, journal_mode="WAL", synchronous="NORMAL",
+            busy_timeout=5000, mmap_size=0, cache_size=-2000):
+    """
+    Open a database connection and tune it. The connection is meant
+    to be kept open and reused, so this only runs once per connection.
+
+    :param db_name: the database file
+    :param journal_mode: the journal mode, WAL lets readers and the writer
+                         work at the same time
+    :param synchronous: when to sync to disk, NORMAL is safe with WAL
+    :param busy_timeout: how long to wait for a lock, in milliseconds
+    :param mmap_size: how many bytes of the database to memory map
+    :param cache_size: the page cache size, in pages or in KiB if negative
+    :return: the connection
+    """
+
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA foreign_keys = ON;")
+    cursor.execute(f"PRAGMA busy_timeout = {int(busy_timeout)};")
+    cursor.execute(f"PRAGMA journal_mode = {journal_mode};")
+    cursor.execute(f"PRAGMA synchronous = {synchronous};")
+    cursor.execute(f"PRAGMA mmap_size = {int(mmap_size)};")
+    cursor.execute(f"PRAGMA cache_size = {int(cache_size)};")
+    return conn
+
+
+"""
+Schema migrations, applied in order on top of the tables below. The
+database's user_version pragma holds how many of them have been applied,
+so each one runs exactly once. Only ever append to this list.
+"""
+MIGRATIONS = [
+    # 1: covering indexes for the nutrient data queries. the latest readings
+    # of a sensor and date ranges of a sensor are read off the first one,
+    # date ranges across sensors and the latest readings overall off the
+    # second one, already sorted by created_at and without touching the table
+    [
+        """
+        CREATE INDEX IF NOT EXISTS idx_npk_data_sensor_created
+            ON npk_data (sensor_id, created_at, n, p, k);
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_npk_data_created
+            ON npk_data (created_at, sensor_id, n, p, k);
+        """,
+    ],
+    # 2: the latest reading of each sensor, already classified, so the
+    # dashboard can show it without a join or running the classifiers.
+    # it's shared by all the workers and dropped when the sensor's crop changes
+    [
+        """
+        CREATE TABLE IF NOT EXISTS latest_readings (
+            sensor_id INTEGER PRIMARY KEY,
+            npk_id INTEGER NOT NULL,
+            n NUMERIC NOT NULL,
+            p NUMERIC NOT NULL,
+            k NUMERIC NOT NULL,
+            crop_name TEXT NOT NULL,
+            clf_n TEXT NOT NULL,
+            clf_p TEXT NOT NULL,
+            clf_k TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            FOREIGN KEY (sensor_id) REFERENCES sensors (id) ON DELETE CASCADE
+        );
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS latest_readings_crop_changed
+            AFTER UPDATE OF crop ON sensors
+            WHEN NEW.crop IS NOT OLD.crop
+        BEGIN
+            DELETE FROM latest_readings WHERE sensor_id = NEW.id;
+        END;
+        """,
+    ],
+    # 3: how far each ingestion spool has been committed, updated in the
+    # same transaction as the readings so a replay never repeats them
+    [
+        """
+        CREATE TABLE IF NOT EXISTS ingest_checkpoints (
+            spool TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL
+        );
+        """,
+    ],
+    # 4: the classifications of each reading, made once when it's stored,
+    # and the version of the models that made them. the date range index
+    # gets them too so reports are still read off the index alone. also
+    # leases, so only one process at a time runs each background job
+    [
+        "ALTER TABLE npk_data ADD COLUMN clf_n TEXT;",
+        "ALTER TABLE npk_data ADD COLUMN clf_p TEXT;",
+        "ALTER TABLE npk_data ADD COLUMN clf_k TEXT;",
+        "ALTER TABLE npk_data ADD COLUMN clf_version TEXT;",
+        "DROP INDEX IF EXISTS idx_npk_data_created;",
+        """
+        CREATE INDEX idx_npk_data_created
+            ON npk_data (created_at, sensor_id, n, p, k, clf_n, clf_p, clf_k, clf_version);
+        """,
+        "DROP INDEX IF EXISTS idx_npk_data_sensor_created;",
+        """
+        CREATE INDEX idx_npk_data_sensor_created
+            ON npk_data (sensor_id, created_at, n, p, k, clf_n, clf_p, clf_k, clf_version);
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS job_leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        """,
+    ],
+    # 5: hourly and daily rollups of the nutrient data of each sensor, so
+    # long reports are answered from a row per bucket instead of every
+    # reading. a job keeps them up to date, and job_checkpoints holds how
+    # far into npk_data it got
+    [
+        """
+        CREATE TABLE IF NOT EXISTS npk_rollups_hourly (
+            bucket TEXT NOT NULL,
+            sensor_id INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            n_sum REAL NOT NULL,
+            n_sumsq REAL NOT NULL,
+            n_min REAL NOT NULL,
+            n_max REAL NOT NULL,
+            n_low INTEGER NOT NULL,
+            n_okay INTEGER NOT NULL,
+            n_high INTEGER NOT NULL,
+            p_sum REAL NOT NULL,
+            p_sumsq REAL NOT NULL,
+            p_min REAL NOT NULL,
+            p_max REAL NOT NULL,
+            p_low INTEGER NOT NULL,
+            p_okay INTEGER NOT NULL,
+            p_high INTEGER NOT NULL,
+            k_sum REAL NOT NULL,
+            k_sumsq REAL NOT NULL,
+            k_min REAL NOT NULL,
+            k_max REAL NOT NULL,
+            k_low INTEGER NOT NULL,
+            k_okay INTEGER NOT NULL,
+            k_high INTEGER NOT NULL,
+            PRIMARY KEY (bucket, sensor_id)
+        ) WITHOUT ROWID;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS npk_rollups_daily (
+            bucket TEXT NOT NULL,
+            sensor_id INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            n_sum REAL NOT NULL,
+            n_sumsq REAL NOT NULL,
+            n_min REAL NOT NULL,
+            n_max REAL NOT NULL,
+            n_low INTEGER NOT NULL,
+            n_okay INTEGER NOT NULL,
+            n_high INTEGER NOT NULL,
+            p_sum REAL NOT NULL,
+            p_sumsq REAL NOT NULL,
+            p_min REAL NOT NULL,
+            p_max REAL NOT NULL,
+            p_low INTEGER NOT NULL,
+            p_okay INTEGER NOT NULL,
+            p_high INTEGER NOT NULL,
+            k_sum REAL NOT NULL,
+            k_sumsq REAL NOT NULL,
+            k_min REAL NOT NULL,
+            k_max REAL NOT NULL,
+            k_low INTEGER NOT NULL,
+            k_okay INTEGER NOT NULL,
+            k_high INTEGER NOT NULL,
+            PRIMARY KEY (bucket, sensor_id)
+        ) WITHOUT ROWID;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS job_checkpoints (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL
+        );
+        """,
+    ],
+    # 6: a version counter per cached table, bumped by triggers on every
+    # change to it, so each worker can tell its in-memory copy is stale
+    # with a single lookup no matter who made the change
+    [
+        """
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        );
+        """,
+        "INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('sensors', 0);",
+        """
+        CREATE TRIGGER IF NOT EXISTS sensors_version_insert AFTER INSERT ON sensors
+        BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'sensors';
+        END;
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS sensors_version_update AFTER UPDATE ON sensors
+        BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'sensors';
+        END;
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS sensors_version_delete AFTER DELETE ON sensors
+        BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'sensors';
+        END;
+        """,
+    ],
+    # 7: full text indexes of the sensors' and their crops' names and of the
+    # usernames, so searching is an index lookup instead of a scan. the rowid
+    # of each entry is the sensor's or user's id, and triggers keep them in sync
+    [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS sensors_fts USING fts5(name, crop_name);",
+        """
+        INSERT INTO sensors_fts (rowid, name, crop_name)
+            SELECT s.id, s.name, c.name FROM sensors s JOIN crops c ON s.crop = c.id;
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS sensors_fts_insert AFTER INSERT ON sensors
+        BEGIN
+            INSERT INTO sensors_fts (rowid, name, crop_name)
+                VALUES (NEW.id, NEW.name, (SELECT name FROM crops WHERE id = NEW.crop));
+        END;
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS sensors_fts_update AFTER UPDATE OF name, crop ON sensors
+        BEGIN
+            UPDATE sensors_fts
+                SET name = NEW.name, crop_name = (SELECT name FROM crops WHERE id = NEW.crop)
+                WHERE rowid = NEW.id;
+        END;
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS sensors_fts_delete AFTER DELETE ON sensors
+        BEGIN
+            DELETE FROM sensors_fts WHERE rowid = OLD.id;
+        END;
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS crops_fts_update AFTER UPDATE OF name ON crops
+        BEGIN
+            UPDATE sensors_fts SET crop_name = NEW.name
+                WHERE rowid IN (SELECT id FROM sensors WHERE crop = NEW.id);
+        END;
+        """,
+        "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(username);",
+        "INSERT INTO users_fts (rowid, username) SELECT id, username FROM users;",
+        """
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO users_fts (rowid, username) VALUES (NEW.id, NEW.username);
+        END;
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username ON users
+        BEGIN
+            UPDATE users_fts SET username = NEW.username WHERE rowid = NEW.id;
+        END;
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users
+        BEGIN
+            DELETE FROM users_fts WHERE rowid = OLD.id;
+        END;
+        """,
+    ],
+    # 8: versions of the users and the nutrient data, for conditional requests.
+    # new readings show as a higher max(id), ids are never reused, so only
+    # updates and deletes of npk_data bump its version and inserts, the hot
+    # path, don't run a trigger. sensors show their crop's name, renaming
+    # a crop bumps the sensors' version
+    [
+        "INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('users', 0);",
+        "INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('npk_data', 0);",
+        """
+        CREATE TRIGGER IF NOT EXISTS users_version_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'users';
+        END;
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_version_update AFTER UPDATE ON users
+        BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'users';
+        END;
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_version_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'users';
+        END;
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS npk_data_version_update AFTER UPDATE ON npk_data
+        BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'npk_data';
+        END;
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS npk_data_version_delete AFTER DELETE ON npk_data
+        BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'npk_data';
+        END;
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS crops_version_update AFTER UPDATE OF name ON crops
+        BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'sensors';
+        END;
+        """,
+    ],
+    # 9: a sensor changing crops makes the classifications of its readings
+    # stale too, not only its cached latest one. they're marked unclassified,
+    # keeping their old labels until they're replaced, and the reclassify job
+    # finds them through an index of only those. its checkpoint is only good
+    # for the models it was made with, so job checkpoints get a version
+    [
+        "DROP TRIGGER IF EXISTS latest_readings_crop_changed;",
+        """
+        CREATE TRIGGER IF NOT EXISTS sensors_crop_changed
+            AFTER UPDATE OF crop ON sensors
+            WHEN NEW.crop IS NOT OLD.crop
+        BEGIN
+            DELETE FROM latest_readings WHERE sensor_id = NEW.id;
+            UPDATE npk_data SET clf_version = NULL
+                WHERE sensor_id = NEW.id AND clf_version IS NOT NULL;
+        END;
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_npk_data_unclassified ON npk_data (id) WHERE clf_version IS NULL;",
+        "ALTER TABLE job_checkpoints ADD COLUMN version TEXT;",
+    ],
+    # 10: npk_data's version is bumped once per transaction by the functions
+    # that update or delete readings in bulk, instead of once per row by a
+    # trigger. and a version of each sensor's readings, bumped every time
+    # its latest reading is refreshed, which every commit of new readings of
+    # it does, for conditional requests of a single sensor's readings
+    [
+        "DROP TRIGGER IF EXISTS npk_data_version_update;",
+        "DROP TRIGGER IF EXISTS npk_data_version_delete;",
+        "DROP TRIGGER IF EXISTS sensors_crop_changed;",
+        """
+        CREATE TRIGGER IF NOT EXISTS sensors_crop_changed
+            AFTER UPDATE OF crop ON sensors
+            WHEN NEW.crop IS NOT OLD.crop
+        BEGIN
+            DELETE FROM latest_readings WHERE sensor_id = NEW.id;
+            UPDATE npk_data SET clf_version = NULL
+                WHERE sensor_id = NEW.id AND clf_version IS NOT NULL;
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'npk_data';
+        END;
+        """,
+        "ALTER TABLE latest_readings ADD COLUMN version INTEGER NOT NULL DEFAULT 0;",
+    ],
+]
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def migrate(conn):
+    """
+    Apply the schema migrations the database doesn't have yet.
+
+    :param conn: the database connection
+    """
+
+    try:
+        cursor = conn.cursor()
+        if cursor.execute("PRAGMA user_version;").fetchone()[0] >= len(MIGRATIONS):
+            return
+
+        with conn:
+            # sqlite3 doesn't open transactions for DDL on its own. take the
+            # write lock right away so concurrent workers migrate one at a time
+            cursor.execute("BEGIN IMMEDIATE;")
+            version = cursor.execute("PRAGMA user_version;").fetchone()[0]
+            for i, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(f"PRAGMA user_version = {i};")
+                current_app.logger.info("Applied schema migration %s", i)
+    except sqlite3.Error:
+        current_app.logger.exception("Error migrating database")
+
+
+@metrics.timed(metrics.DB_SECONDS)
 def create_tables(conn):
     """
     Create tables if they don't exist already.
@@ -69,169 +467,1500 @@ def create_tables(conn):
     except sqlite3.Error:
         current_app.logger.exception("Error initializing database")
 
+    migrate(conn)
 
+
+@metrics.timed(metrics.DB_SECONDS)
 def add_crop(conn, name):
     """
-    Add a crop to the database.
+    Add a crop to the database.
+
+    :param conn: the database connection
+    :param name: the crop's name
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO crops (name) VALUES (?) 
+                ON CONFLICT(name) DO NOTHING;
+            """, (name,))
+            if (cursor.rowcount > 0):
+                current_app.logger.info("Inserted crop '%s'", name)
+    except sqlite3.Error:
+        current_app.logger.exception("Error inserting crop")
+        raise # catch integrity error
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_all_crops(conn):
+    """
+    Get all crops from the crops table.
+
+    :param conn: the database connection
+    """  
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM crops;")
+            rows = cursor.fetchall()
+            current_app.logger.info("Fetched all crops: %s row(s)", len(rows))
+            return rows
+    except sqlite3.Error:
+        current_app.logger.exception("Error fetching crops")
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def add_npk_data(conn, n, p, k, sensor_id, clf_n=None, clf_p=None, clf_k=None, clf_version=None):
+    """
+    Add sensor nutrient data to the database.
+
+    :param conn: the database connection
+    :param n: nitrogen concentration
+    :param p: phosphorus concentration
+    :param k: potassium concentration
+    :param sensor_id: the id of the sensor that generated the data
+    :param clf_n: the nitrogen classification (optional)
+    :param clf_p: the phosphorus classification (optional)
+    :param clf_k: the potassium classification (optional)
+    :param clf_version: the version of the models that classified it (optional)
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO npk_data (n, p, k, sensor_id, clf_n, clf_p, clf_k, clf_version) 
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+            """, (n, p, k, sensor_id, clf_n, clf_p, clf_k, clf_version))
+            current_app.logger.info("Inserted nutrient data of sensor '%s'", sensor_id)
+    except sqlite3.Error:
+        current_app.logger.exception("Error inserting nutrient data")
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def add_npk_data_batch(conn, rows):
+    """
+    Add many rows of sensor nutrient data in a single transaction.
+
+    :param conn: the database connection
+    :param rows: (n, p, k, sensor_id, created_at, clf_n, clf_p, clf_k,
+                 clf_version) tuples, where created_at can be None to use
+                 the current time and the classifications None if unknown
+    :return: the number of inserted rows
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                INSERT INTO npk_data (n, p, k, sensor_id, created_at, clf_n, clf_p, clf_k, clf_version)
+                    VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?, ?, ?);
+            """, rows)
+            current_app.logger.info("Inserted %s row(s) of nutrient data", len(rows))
+            return len(rows)
+    except sqlite3.Error:
+        current_app.logger.exception("Error inserting nutrient data")
+        raise # let the caller report the failure
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def add_spooled_npk_data(conn, rows, spool, seq):
+    """
+    Add many rows of sensor nutrient data that came through an ingestion
+    spool, and record how far the spool is committed, in one transaction.
+
+    :param conn: the database connection
+    :param rows: the rows, like add_npk_data_batch takes them
+    :param spool: the spool's name
+    :param seq: the sequence number of the spool's last entry in rows
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                INSERT INTO npk_data (n, p, k, sensor_id, created_at, clf_n, clf_p, clf_k, clf_version)
+                    VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?, ?, ?);
+            """, rows)
+            cursor.execute("""
+                INSERT INTO ingest_checkpoints (spool, seq) VALUES (?, ?)
+                ON CONFLICT(spool) DO UPDATE SET seq = excluded.seq;
+            """, (spool, seq))
+            current_app.logger.info("Inserted %s row(s) of nutrient data from spool '%s'", len(rows), spool)
+    except sqlite3.Error:
+        current_app.logger.exception("Error inserting nutrient data")
+        raise # the ingestion queue retries
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def add_spooled_npk_data_each(conn, rows, spool, seq):
+    """
+    Like add_spooled_npk_data, but skip the rows the database won't take
+    instead of failing all of them. The rest and the spool's progress are
+    still committed in one transaction.
+
+    :param conn: the database connection
+    :param rows: the rows, like add_npk_data_batch takes them
+    :param spool: the spool's name
+    :param seq: the sequence number of the spool's last entry in rows
+    :return: the rows that were skipped
+    """
+
+    skipped = []
+    try:
+        with conn:
+            cursor = conn.cursor()
+            for row in rows:
+                # a savepoint per row, so a bad one only undoes itself
+                cursor.execute("SAVEPOINT npk_row;")
+                try:
+                    cursor.execute("""
+                        INSERT INTO npk_data (n, p, k, sensor_id, created_at, clf_n, clf_p, clf_k, clf_version)
+                            VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?, ?, ?);
+                    """, row)
+                except sqlite3.IntegrityError:
+                    cursor.execute("ROLLBACK TO npk_row;")
+                    skipped.append(row)
+                cursor.execute("RELEASE npk_row;")
+            cursor.execute("""
+                INSERT INTO ingest_checkpoints (spool, seq) VALUES (?, ?)
+                ON CONFLICT(spool) DO UPDATE SET seq = excluded.seq;
+            """, (spool, seq))
+            current_app.logger.info("Inserted %s row(s) of nutrient data from spool '%s', skipped %s",
+                                    len(rows) - len(skipped), spool, len(skipped))
+            return skipped
+    except sqlite3.Error:
+        current_app.logger.exception("Error inserting nutrient data")
+        raise # the ingestion queue retries
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_ingest_checkpoint(conn, spool):
+    """
+    Get the sequence number of the last committed entry of a spool.
+
+    :param conn: the database connection
+    :param spool: the spool's name
+    :return: the sequence number, 0 if nothing was committed
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT seq FROM ingest_checkpoints WHERE spool = ?;", (spool,))
+            row = cursor.fetchone()
+            return row[0] if row is not None else 0
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting ingestion checkpoint")
+        raise
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def delete_ingest_checkpoint(conn, spool):
+    """
+    Forget a spool that was fully committed and removed.
+
+    :param conn: the database connection
+    :param spool: the spool's name
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM ingest_checkpoints WHERE spool = ?;", (spool,))
+    except sqlite3.Error:
+        current_app.logger.exception("Error deleting ingestion checkpoint")
+        raise
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_sensor_labels(conn, sensor_ids):
+    """
+    Get the label the ML models know each of the given sensors' crops by.
+
+    :param conn: the database connection
+    :param sensor_ids: the sensor ids to look for
+    :return: a dict from sensor id to label, for the sensors that exist
+    """
+
+    sensor_ids = list(set(sensor_ids))
+    if len(sensor_ids) == 0:
+        return {}
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT id, crop - 1 FROM sensors WHERE id IN (SELECT value FROM json_each(?));",
+                (json.dumps(sensor_ids),)
+            )
+            return {row[0]: row[1] for row in cursor.fetchall()}
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting sensor data")
+        raise
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_stale_npk_data(conn, clf_version, after_id=0, until_id=None, n=5000):
+    """
+    Get rows of nutrient data that weren't classified by the given
+    version of the models, in id order, ready to be classified.
+
+    :param conn: the database connection
+    :param clf_version: the current version of the models
+    :param after_id: only get rows after this id
+    :param until_id: only get rows up to this id (optional)
+    :param n: the most rows to get
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT
+                    npk.id,
+                    npk.n as N,
+                    npk.p as P,
+                    npk.k as K,
+                    s.crop - 1 as label
+                FROM npk_data npk
+                JOIN sensors s ON npk.sensor_id = s.id
+                WHERE npk.id > ? AND npk.id <= coalesce(?, npk.id)
+                    AND (npk.clf_version IS NULL OR npk.clf_version != ?)
+                ORDER BY npk.id
+                LIMIT ?;
+            """, (after_id, until_id, clf_version, n))
+            return cursor.fetchall()
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting nutrient data")
+        raise
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_unclassified_npk_data(conn, after_id=0, n=5000):
+    """
+    Get rows of nutrient data without a classification, or whose sensor's
+    crop changed since, in id order, ready to be classified. Unlike
+    get_stale_npk_data this only reads an index of those rows.
+
+    :param conn: the database connection
+    :param after_id: only get rows after this id
+    :param n: the most rows to get
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT
+                    npk.id,
+                    npk.n as N,
+                    npk.p as P,
+                    npk.k as K,
+                    s.crop - 1 as label
+                FROM npk_data npk
+                JOIN sensors s ON npk.sensor_id = s.id
+                WHERE npk.clf_version IS NULL AND npk.id > ?
+                ORDER BY npk.id
+                LIMIT ?;
+            """, (after_id, n))
+            return cursor.fetchall()
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting nutrient data")
+        raise
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def set_npk_data_classifications(conn, rows):
+    """
+    Store the classifications of existing rows of nutrient data, and move
+    the ones already rolled up from their old classes to their new ones in
+    the rollups, in one transaction.
+
+    :param conn: the database connection
+    :param rows: (clf_n, clf_p, clf_k, clf_version, id) tuples
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            # so the rollup checkpoint can't move until this is committed
+            cursor.execute("BEGIN IMMEDIATE;")
+            cursor.execute("SELECT last_id FROM job_checkpoints WHERE name = 'rollup';")
+            row = cursor.fetchone()
+            rolled_up_id = row[0] if row is not None else 0
+
+            if rolled_up_id > 0:
+                for table, bucket in ROLLUPS.values():
+                    cursor.execute(
+                        RECLASSIFY_ROLLUP_STATEMENT.format(table=table, bucket=bucket),
+                        (json.dumps(rows), rolled_up_id)
+                    )
+            cursor.executemany("""
+                UPDATE npk_data
+                SET clf_n=?,
+                    clf_p=?,
+                    clf_k=?,
+                    clf_version=?
+                WHERE id=?;
+            """, rows)
+            cursor.execute("UPDATE cache_versions SET version = version + 1 WHERE name = 'npk_data';")
+            current_app.logger.info("Classified %s row(s) of nutrient data", len(rows))
+    except sqlite3.Error:
+        current_app.logger.exception("Error classifying nutrient data")
+        raise
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def acquire_lease(conn, name, owner, seconds):
+    """
+    Take or renew the lease on a background job, so only
+    one process at a time runs it.
+
+    :param conn: the database connection
+    :param name: the job's name
+    :param owner: who wants the lease, unique per process
+    :param seconds: how long the lease lasts unless renewed
+    :return: True if the owner holds the lease now, False otherwise
+    """
+
+    now = time.time()
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO job_leases (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    owner = excluded.owner,
+                    expires_at = excluded.expires_at
+                WHERE job_leases.owner = excluded.owner OR job_leases.expires_at < ?;
+            """, (name, owner, now + seconds, now))
+            return cursor.rowcount > 0
+    except sqlite3.Error:
+        current_app.logger.exception("Error acquiring lease on job '%s'", name)
+        return False
+
+
+# the rollup tables, by the granularity of their buckets, and
+# the strftime format that turns a timestamp into its bucket
+ROLLUPS = {
+    "hourly": ("npk_rollups_hourly", "%Y-%m-%d %H:00:00"),
+    "daily": ("npk_rollups_daily", "%Y-%m-%d 00:00:00"),
+}
+
+ROLLUP_STATEMENT = """
+    INSERT INTO {table} (
+        bucket, sensor_id, count,
+        n_sum, n_sumsq, n_min, n_max, n_low, n_okay, n_high,
+        p_sum, p_sumsq, p_min, p_max, p_low, p_okay, p_high,
+        k_sum, k_sumsq, k_min, k_max, k_low, k_okay, k_high
+    )
+        SELECT
+            strftime('{bucket}', created_at), sensor_id, count(*),
+            sum(n), sum(n * n), min(n), max(n),
+            sum(clf_n IS 'Low'), sum(clf_n IS 'Okay'), sum(clf_n IS 'High'),
+            sum(p), sum(p * p), min(p), max(p),
+            sum(clf_p IS 'Low'), sum(clf_p IS 'Okay'), sum(clf_p IS 'High'),
+            sum(k), sum(k * k), min(k), max(k),
+            sum(clf_k IS 'Low'), sum(clf_k IS 'Okay'), sum(clf_k IS 'High')
+        FROM npk_data
+        WHERE id > ? AND id <= ?
+        GROUP BY 1, 2
+    ON CONFLICT(bucket, sensor_id) DO UPDATE SET
+        count = {table}.count + excluded.count,
+        n_sum = {table}.n_sum + excluded.n_sum,
+        n_sumsq = {table}.n_sumsq + excluded.n_sumsq,
+        n_min = min({table}.n_min, excluded.n_min),
+        n_max = max({table}.n_max, excluded.n_max),
+        n_low = {table}.n_low + excluded.n_low,
+        n_okay = {table}.n_okay + excluded.n_okay,
+        n_high = {table}.n_high + excluded.n_high,
+        p_sum = {table}.p_sum + excluded.p_sum,
+        p_sumsq = {table}.p_sumsq + excluded.p_sumsq,
+        p_min = min({table}.p_min, excluded.p_min),
+        p_max = max({table}.p_max, excluded.p_max),
+        p_low = {table}.p_low + excluded.p_low,
+        p_okay = {table}.p_okay + excluded.p_okay,
+        p_high = {table}.p_high + excluded.p_high,
+        k_sum = {table}.k_sum + excluded.k_sum,
+        k_sumsq = {table}.k_sumsq + excluded.k_sumsq,
+        k_min = min({table}.k_min, excluded.k_min),
+        k_max = max({table}.k_max, excluded.k_max),
+        k_low = {table}.k_low + excluded.k_low,
+        k_okay = {table}.k_okay + excluded.k_okay,
+        k_high = {table}.k_high + excluded.k_high;
+"""
+
+
+# moves rolled up rows that are classified again from their old classes
+# to their new ones, the rows' new classifications are a json array of
+# (clf_n, clf_p, clf_k, clf_version, id) arrays
+RECLASSIFY_ROLLUP_STATEMENT = """
+    UPDATE {table} SET
+        n_low = {table}.n_low + d.n_low,
+        n_okay = {table}.n_okay + d.n_okay,
+        n_high = {table}.n_high + d.n_high,
+        p_low = {table}.p_low + d.p_low,
+        p_okay = {table}.p_okay + d.p_okay,
+        p_high = {table}.p_high + d.p_high,
+        k_low = {table}.k_low + d.k_low,
+        k_okay = {table}.k_okay + d.k_okay,
+        k_high = {table}.k_high + d.k_high
+    FROM (
+        SELECT
+            strftime('{bucket}', npk.created_at) AS bucket,
+            npk.sensor_id,
+            sum(new.clf_n IS 'Low') - sum(npk.clf_n IS 'Low') AS n_low,
+            sum(new.clf_n IS 'Okay') - sum(npk.clf_n IS 'Okay') AS n_okay,
+            sum(new.clf_n IS 'High') - sum(npk.clf_n IS 'High') AS n_high,
+            sum(new.clf_p IS 'Low') - sum(npk.clf_p IS 'Low') AS p_low,
+            sum(new.clf_p IS 'Okay') - sum(npk.clf_p IS 'Okay') AS p_okay,
+            sum(new.clf_p IS 'High') - sum(npk.clf_p IS 'High') AS p_high,
+            sum(new.clf_k IS 'Low') - sum(npk.clf_k IS 'Low') AS k_low,
+            sum(new.clf_k IS 'Okay') - sum(npk.clf_k IS 'Okay') AS k_okay,
+            sum(new.clf_k IS 'High') - sum(npk.clf_k IS 'High') AS k_high
+        FROM (
+            SELECT
+                json_extract(value, '$[0]') AS clf_n,
+                json_extract(value, '$[1]') AS clf_p,
+                json_extract(value, '$[2]') AS clf_k,
+                json_extract(value, '$[4]') AS id
+            FROM json_each(?)
+        ) new
+        JOIN npk_data npk ON npk.id = new.id
+        WHERE npk.id <= ?
+        GROUP BY 1, 2
+    ) d
+    WHERE {table}.bucket = d.bucket AND {table}.sensor_id = d.sensor_id;
+"""
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_job_checkpoint(conn, name, version=None):
+    """
+    Get the id of the last row of nutrient data a background job processed.
+
+    :param conn: the database connection
+    :param name: the job's name
+    :param version: the version the checkpoint has to be made with, like
+                    that of the models, a different one counts as none
+    :return: the id, 0 if the job didn't process any rows yet
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT last_id FROM job_checkpoints WHERE name = ? AND version IS ?;", (name, version))
+            row = cursor.fetchone()
+            return row[0] if row is not None else 0
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting checkpoint of job '%s'", name)
+        raise
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def set_job_checkpoint(conn, name, last_id, version=None):
+    """
+    Set the id of the last row of nutrient data a background job processed.
+
+    :param conn: the database connection
+    :param name: the job's name
+    :param last_id: the id
+    :param version: the version the checkpoint is made with (optional)
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO job_checkpoints (name, last_id, version) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET last_id = excluded.last_id, version = excluded.version;
+            """, (name, last_id, version))
+    except sqlite3.Error:
+        current_app.logger.exception("Error setting checkpoint of job '%s'", name)
+        raise
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def roll_up_npk_data(conn, n=5000):
+    """
+    Add the next rows of nutrient data to the hourly and daily rollups and
+    move the rollup checkpoint past them, in one transaction. Rows are
+    rolled up in id order and only once they're classified, so a row that
+    isn't yet holds back the ones after it.
+
+    :param conn: the database connection
+    :param n: the most rows to roll up
+    :return: the number of rows rolled up
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            # read the checkpoint in the same transaction that moves it,
+            # so the same rows can never be added twice
+            cursor.execute("BEGIN IMMEDIATE;")
+            cursor.execute("SELECT last_id FROM job_checkpoints WHERE name = 'rollup';")
+            row = cursor.fetchone()
+            after_id = row[0] if row is not None else 0
+
+            cursor.execute("""
+                SELECT
+                    max(id),
+                    min(CASE WHEN clf_version IS NULL THEN id END)
+                FROM (SELECT id, clf_version FROM npk_data WHERE id > ? ORDER BY id LIMIT ?);
+            """, (after_id, n))
+            last_id, unclassified_id = cursor.fetchone()
+            if unclassified_id is not None:
+                last_id = unclassified_id - 1
+            if last_id is None or last_id <= after_id:
+                return 0
+
+            for table, bucket in ROLLUPS.values():
+                cursor.execute(ROLLUP_STATEMENT.format(table=table, bucket=bucket), (after_id, last_id))
+            cursor.execute("""
+                INSERT INTO job_checkpoints (name, last_id) VALUES ('rollup', ?)
+                ON CONFLICT(name) DO UPDATE SET last_id = excluded.last_id;
+            """, (last_id,))
+            cursor.execute("SELECT count(*) FROM npk_data WHERE id > ? AND id <= ?;", (after_id, last_id))
+            rows = cursor.fetchone()[0]
+            current_app.logger.info("Rolled up %s row(s) of nutrient data", rows)
+            return rows
+    except sqlite3.Error:
+        current_app.logger.exception("Error rolling up nutrient data")
+        raise
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_sensor_ids(conn, sensor_ids):
+    """
+    Get which of the given sensor ids exist.
+
+    :param conn: the database connection
+    :param sensor_ids: the sensor ids to look for
+    :return: a set with the ids that exist
+    """
+
+    sensor_ids = list(set(sensor_ids))
+    if len(sensor_ids) == 0:
+        return set()
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT id FROM sensors WHERE id IN (SELECT value FROM json_each(?));",
+                (json.dumps(sensor_ids),)
+            )
+            return {row[0] for row in cursor.fetchall()}
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting sensor data")
+        raise
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_latest_npk_data(conn, n=10):
+    """
+    Get the latest N rows from the nutrients data table.
+
+    :param conn: the database connection
+    :param n: an integer higher than zero
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT * FROM npk_data
+                    ORDER BY created_at DESC
+                    LIMIT ?;
+            """, (n,))
+            rows = cursor.fetchall()
+            current_app.logger.info("Fetched nutrient data: %s row(s)", len(rows))
+            return rows
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting nutrient data")
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_npk_data_page(conn, n=10, sensor_id=None, crop_name=None, start=None, end=None,
+                      after=None, descending=True, chunksize=1000):
+    """
+    Get a page of nutrient data, newest first or oldest first, optionally
+    of a single sensor and/or crop and in a time range. Pages are keyset
+    paginated on (created_at, id), each one starts right after the last row
+    of the previous one, so any page is as cheap as the first and readings
+    stored in between don't shift them.
+
+    :param conn: the database connection
+    :param n: the most rows in the page
+    :param sensor_id: only the rows of this sensor (optional)
+    :param crop_name: only the rows of sensors of this crop (optional)
+    :param start: only rows created at or after this timestamp (optional)
+    :param end: only rows created before this timestamp (optional)
+    :param after: the (created_at, id) of the last row of the previous page
+    :param descending: newest first if True, oldest first otherwise
+    :param chunksize: the most rows read at a time
+    :return: a generator of lists of rows
+    """
+
+    query = """
+        SELECT
+            npk.id, npk.n, npk.p, npk.k, npk.sensor_id, npk.created_at,
+            npk.clf_n, npk.clf_p, npk.clf_k, npk.clf_version
+        FROM npk_data npk
+    """
+    where = []
+    params = []
+    if crop_name is not None:
+        query += " JOIN sensors s ON s.id = npk.sensor_id JOIN crops c ON c.id = s.crop"
+        where.append("c.name = ?")
+        params.append(crop_name)
+    if sensor_id is not None:
+        where.append("npk.sensor_id = ?")
+        params.append(sensor_id)
+    if start is not None:
+        where.append("npk.created_at >= ?")
+        params.append(start)
+    if end is not None:
+        where.append("npk.created_at < ?")
+        params.append(end)
+    if after is not None:
+        where.append(f"(npk.created_at, npk.id) {'<' if descending else '>'} (?, ?)")
+        params.extend(after)
+    if where:
+        query += " WHERE " + " AND ".join(where)
+
+    # read off the created_at indexes, only readings stored in the
+    # same second are sorted by id as they come
+    direction = "DESC" if descending else "ASC"
+    query += f" ORDER BY npk.created_at {direction}, npk.id {direction} LIMIT ?;"
+    params.append(n)
+
+    try:
+        cursor = conn.execute(query, params)
+        total = 0
+        while rows := cursor.fetchmany(chunksize):
+            total += len(rows)
+            yield rows
+        current_app.logger.info("Fetched a page of nutrient data: %s row(s)", total)
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting nutrient data")
+        raise # a half sent page can't be passed off as complete
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_latest_npk_data_df(conn, sensor_name, n=10):
+    """
+    Get the latest N rows from the nutrient data table,
+    along with the crop associated with the sensor that
+    gathered the data. This data is meant to be input to
+    trained ML models for classification.
+
+    :param conn: the database connection
+    :param n: an integer higher than zero
+    """
+
+    try:
+        with conn:
+            """
+            some details here:
+             1. the column names for the nutrients need to come in uppercase
+             2. the crop IDs need to be decremented by 1
+
+            explanation:
+             1. the ML models were simply trained with uppercase column names
+                so they won't classify unless that's the case
+             2. the ML models can't take strings so the crop names were
+                mapped to their respective index during training... since
+                IDs start at 1 in the DB we just decrement by 1
+            """
+
+            return read_sql_query("""
+                SELECT 
+                    npk.n as N,
+                    npk.p as P,
+                    npk.k as K,
+                    npk.created_at,
+                    s.crop - 1 as label,
+                    c.name as crop_name
+                FROM npk_data npk
+                JOIN sensors s ON npk.sensor_id = s.id
+                JOIN crops c ON s.crop = c.id
+                WHERE s.name = ?
+                ORDER BY npk.created_at DESC
+                LIMIT ?;
+            """, conn, params=(sensor_name, n))
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting nutrient data")
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_latest_npk_data_by_sensor(conn, sensor_ids):
+    """
+    Get the latest row of nutrient data of each of the given sensors,
+    along with the crop associated with the sensor, ready to be classified.
+
+    :param conn: the database connection
+    :param sensor_ids: the sensors' ids
+    :return: one row per sensor that has any data
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT
+                    npk.id as npk_id,
+                    npk.n as N,
+                    npk.p as P,
+                    npk.k as K,
+                    npk.created_at,
+                    npk.clf_n as clf_N,
+                    npk.clf_p as clf_P,
+                    npk.clf_k as clf_K,
+                    npk.clf_version,
+                    s.id as sensor_id,
+                    s.crop - 1 as label,
+                    c.name as crop_name
+                FROM sensors s
+                JOIN crops c ON s.crop = c.id
+                JOIN npk_data npk ON npk.id = (
+                    SELECT id FROM npk_data
+                        WHERE sensor_id = s.id
+                        ORDER BY created_at DESC, id DESC
+                        LIMIT 1
+                )
+                WHERE s.id IN (SELECT value FROM json_each(?));
+            """, (json.dumps(list(set(sensor_ids))),))
+            rows = cursor.fetchall()
+            current_app.logger.info("Fetched latest nutrient data by sensor: %s row(s)", len(rows))
+            return rows
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting nutrient data")
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_latest_reading(conn, sensor_name):
+    """
+    Get the cached latest reading of a sensor, with its classifications.
+
+    :param conn: the database connection
+    :param sensor_name: the sensor's name
+    :return: the reading or None if it isn't cached
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT lr.* FROM latest_readings lr
+                JOIN sensors s ON lr.sensor_id = s.id
+                WHERE s.name = ?;
+            """, (sensor_name,))
+            return cursor.fetchone()
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting latest reading")
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def set_latest_readings(conn, readings):
+    """
+    Cache the latest readings of some sensors. A reading only replaces
+    the cached one if it's newer, so concurrent updates can't go back.
+    Either way the version of the sensors' readings is bumped, since
+    readings were stored, even if not newer ones.
 
     :param conn: the database connection
-    :param name: the crop's name
+    :param readings: dicts with sensor_id, npk_id, n, p, k, crop_name,
+                     clf_n, clf_p, clf_k and created_at
     """
 
     try:
         with conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO crops (name) VALUES (?) 
-                ON CONFLICT(name) DO NOTHING;
-            """, (name,))
-            if (cursor.rowcount > 0):
-                current_app.logger.info(f"Inserted crop '{name}'")
+            cursor.executemany("""
+                INSERT INTO latest_readings
+                    (sensor_id, npk_id, n, p, k, crop_name, clf_n, clf_p, clf_k, created_at)
+                    VALUES (:sensor_id, :npk_id, :n, :p, :k, :crop_name,
+                            :clf_n, :clf_p, :clf_k, :created_at)
+                ON CONFLICT(sensor_id) DO UPDATE SET
+                    npk_id = excluded.npk_id,
+                    n = excluded.n,
+                    p = excluded.p,
+                    k = excluded.k,
+                    crop_name = excluded.crop_name,
+                    clf_n = excluded.clf_n,
+                    clf_p = excluded.clf_p,
+                    clf_k = excluded.clf_k,
+                    created_at = excluded.created_at
+                WHERE excluded.created_at > latest_readings.created_at
+                    OR (excluded.created_at = latest_readings.created_at
+                        AND excluded.npk_id >= latest_readings.npk_id);
+            """, readings)
+            cursor.executemany(
+                "UPDATE latest_readings SET version = version + 1 WHERE sensor_id = :sensor_id;",
+                readings
+            )
     except sqlite3.Error:
-        current_app.logger.exception("Error inserting crop")
-        raise # catch integrity error
+        current_app.logger.exception("Error caching latest readings")
 
 
-def get_all_crops(conn):
+@metrics.timed(metrics.DB_SECONDS)
+def get_fleet_readings(conn):
     """
-    Get all crops from the crops table.
+    Get the cached latest reading of every active sensor, with how long
+    ago it was taken, in a single query.
 
     :param conn: the database connection
-    """  
+    :return: one row per active sensor, by id, with the reading's columns
+             NULL if it isn't cached or the sensor hasn't sent any
+    """
 
     try:
         with conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM crops;")
+            cursor.execute("""
+                SELECT
+                    s.id as sensor_id,
+                    s.name,
+                    s.desc,
+                    c.name as crop_name,
+                    lr.npk_id,
+                    lr.n,
+                    lr.p,
+                    lr.k,
+                    lr.clf_n,
+                    lr.clf_p,
+                    lr.clf_k,
+                    lr.created_at,
+                    CAST((julianday('now') - julianday(lr.created_at)) * 86400 AS INTEGER) as age
+                FROM sensors s
+                JOIN crops c ON s.crop = c.id
+                LEFT JOIN latest_readings lr ON lr.sensor_id = s.id
+                WHERE s.status = 1
+                ORDER BY s.id;
+            """)
             rows = cursor.fetchall()
-            current_app.logger.info(f"Fetched all crops: {len(rows)} row(s)")
+            current_app.logger.info("Fetched the fleet's latest readings: %s row(s)", len(rows))
             return rows
     except sqlite3.Error:
-        current_app.logger.exception("Error fetching crops")
+        current_app.logger.exception("Error getting the fleet's latest readings")
 
 
-def add_npk_data(conn, n, p, k, sensor_id):
+def npk_data_query(start_date, end_date, sensor_name=None, crop_name=None,
+                   after=None, before=None, archived=False):
     """
-    Add sensor nutrient data to the database.
+    Build the query for the nutrient data in a date range, optionally
+    of a single sensor and/or crop ('any' or None means all of them).
 
-    :param conn: the database connection
-    :param n: nitrogen concentration
-    :param p: phosphorus concentration
-    :param k: potassium concentration
-    :param sensor_id: the id of the sensor that generated the data
+    :param after: only rows created at or after this timestamp (optional)
+    :param before: only rows created before this timestamp (optional)
+    :param archived: whether to read the attached archive too
+    :return: the query and its parameters
+    """
+
+    select = """
+        SELECT
+            npk.n as N,
+            npk.p as P,
+            npk.k as K,
+            npk.created_at as created_at,
+            s.crop - 1 as label,
+            c.name as crop_name,
+            npk.sensor_id,
+            s.name as sensor_name,
+            npk.clf_n as clf_N,
+            npk.clf_p as clf_P,
+            npk.clf_k as clf_K,
+            npk.clf_version
+        FROM {table} npk
+        JOIN sensors s ON npk.sensor_id = s.id
+        JOIN crops c ON s.crop = c.id
+        WHERE npk.created_at BETWEEN ? AND ?
+    """
+
+    where = ""
+    params = [start_date, end_date]
+    if after is not None:
+        where += " AND npk.created_at >= ?"
+        params.append(after)
+    if before is not None:
+        where += " AND npk.created_at < ?"
+        params.append(before)
+    if sensor_name not in (None, "any"):
+        where += " AND s.name = ?"
+        params.append(sensor_name)
+    if crop_name not in (None, "any"):
+        where += " AND c.name = ?"
+        params.append(crop_name)
+
+    if not archived:
+        query = select.format(table="npk_data") + where + " ORDER BY npk.created_at ASC;"
+        return query, params
+
+    # both sides come sorted off their created_at index and are merged.
+    # rows being archived right now are in both for a moment, skip those
+    query = (
+        select.format(table="main.npk_data") + where
+        + " AND NOT EXISTS (SELECT 1 FROM archive.npk_data a WHERE a.id = npk.id)"
+        + " UNION ALL "
+        + select.format(table="archive.npk_data") + where
+        + " ORDER BY created_at ASC;"
+    )
+    return query, params + params
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_npk_data_df(conn, start_date, end_date, sensor_name=None, crop_name=None, archive_dir=None):
+    """
+    Get the nutrient data in a date range, from the database and
+    from the archives in archive_dir if it's given.
     """
 
+    if get_archives(archive_dir, start_date, end_date):
+        chunks = list(get_npk_data_chunks(conn, start_date, end_date, sensor_name, crop_name,
+                                          archive_dir=archive_dir))
+        return concat(chunks, ignore_index=True) if chunks else None
+
+    query, params = npk_data_query(start_date, end_date, sensor_name, crop_name)
+
     try:
         with conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO npk_data (n, p, k, sensor_id) 
-                    VALUES (?, ?, ?, ?);
-            """, (n, p, k, sensor_id))
-            current_app.logger.info(f"Inserted nutrient data of sensor '{sensor_id}'")
+            return read_sql_query(query, conn, params=params)
     except sqlite3.Error:
-        current_app.logger.exception("Error inserting nutrient data")
+        current_app.logger.exception("Error getting nutrient data")
 
 
-def get_latest_npk_data(conn, n=10):
+@metrics.timed(metrics.DB_SECONDS)
+def get_npk_data_chunks(conn, start_date, end_date, sensor_name=None, crop_name=None,
+                        chunksize=10000, archive_dir=None):
     """
-    Get the latest N rows from the nutrients data table.
+    Same as get_npk_data_df, but the data comes in DataFrames of
+    at most chunksize rows so it never has to be in memory all at once.
 
-    :param conn: the database connection
-    :param n: an integer higher than zero
+    :param chunksize: the most rows per DataFrame
+    :param archive_dir: the directory of the archives to read too (optional)
+    :return: a generator of DataFrames
     """
 
+    archives = get_archives(archive_dir, start_date, end_date)
+    if archives:
+        yield from get_archived_npk_data_chunks(
+            conn, archives, start_date, end_date, sensor_name, crop_name, chunksize
+        )
+        return
+
+    query, params = npk_data_query(start_date, end_date, sensor_name, crop_name)
+
     try:
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT * FROM npk_data
-                    ORDER BY created_at DESC
-                    LIMIT ?;
-            """, (n,))
-            rows = cursor.fetchall()
-            current_app.logger.info(f"Fetched nutrient data: {len(rows)} row(s)")
-            return rows
+        yield from read_sql_query(query, conn, params=params, chunksize=chunksize)
     except sqlite3.Error:
         current_app.logger.exception("Error getting nutrient data")
+        raise # the response may be half sent, so don't hide it
 
 
-def get_latest_npk_data_df(conn, sensor_name, n=10):
+"""
+Readings older than the retention period are moved out of npk_data into
+a database per month in the archive directory, named after the month
+(npk_data_2024_03.db). The archives are only written to by the archive
+job and attached read-only when a date range needs them, so npk_data and
+its indexes stay the size of the retention period.
+"""
+ARCHIVE_PATTERN = re.compile(r"^npk_data_(\d{4})_(\d{2})\.db$")
+
+ARCHIVE_SCHEMA = [
     """
-    Get the latest N rows from the nutrient data table,
-    along with the crop associated with the sensor that
-    gathered the data. This data is meant to be input to
-    trained ML models for classification.
+    CREATE TABLE IF NOT EXISTS archive.npk_data (
+        id INTEGER PRIMARY KEY,
+        n NUMERIC NOT NULL,
+        p NUMERIC NOT NULL,
+        k NUMERIC NOT NULL,
+        sensor_id INTEGER NOT NULL,
+        created_at TIMESTAMP,
+        clf_n TEXT,
+        clf_p TEXT,
+        clf_k TEXT,
+        clf_version TEXT
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS archive.idx_npk_data_created
+        ON npk_data (created_at, sensor_id, n, p, k, clf_n, clf_p, clf_k, clf_version);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS archive.idx_npk_data_sensor_created
+        ON npk_data (sensor_id, created_at, n, p, k, clf_n, clf_p, clf_k, clf_version);
+    """,
+]
+
+
+def next_month(month):
+    """
+    :param month: a month as 'YYYY-MM'
+    :return: the month after it, as 'YYYY-MM'
+    """
+
+    year, number = int(month[:4]), int(month[5:7])
+    return f"{year + number // 12:04d}-{number % 12 + 1:02d}"
+
+
+def get_archives(archive_dir, start_date=None, end_date=None):
+    """
+    Find the monthly archives of nutrient data, optionally
+    only the ones of the months in a date range.
+
+    :param archive_dir: the archive directory, None if there's none
+    :return: a dict from month ('YYYY-MM') to archive path, in month order
+    """
+
+    if archive_dir is None or not os.path.isdir(archive_dir):
+        return {}
+
+    archives = {}
+    for name in sorted(os.listdir(archive_dir)):
+        match = ARCHIVE_PATTERN.match(name)
+        if match is None:
+            continue
+        month = f"{match[1]}-{match[2]}"
+        if start_date is not None and month < str(start_date)[:7]:
+            continue
+        if end_date is not None and month > str(end_date)[:7]:
+            continue
+        archives[month] = os.path.join(archive_dir, name)
+    return archives
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def archive_npk_data(conn, archive_dir, before, n=5000):
+    """
+    Move rows of nutrient data older than a timestamp into the archive of
+    their month, oldest first. Only rows that are already in the rollups
+    are moved, so the rollups keep covering everything.
+
+    The rows are copied and committed to the archive before they're deleted
+    from npk_data, so a crash in between leaves them in both places instead
+    of in neither. Copying skips rows the archive has already, and readers
+    skip the rows of npk_data that are in the archive too.
 
     :param conn: the database connection
-    :param n: an integer higher than zero
+    :param archive_dir: the archive directory
+    :param before: move rows created before this timestamp
+    :param n: the most rows to move
+    :return: the number of rows moved
     """
 
     try:
+        cursor = conn.cursor()
         with conn:
-            """
-            some details here:
-             1. the column names for the nutrients need to come in uppercase
-             2. the crop IDs need to be decremented by 1
+            cursor.execute("SELECT last_id FROM job_checkpoints WHERE name = 'rollup';")
+            row = cursor.fetchone()
+            rolled_up = row[0] if row is not None else 0
 
-            explanation:
-             1. the ML models were simply trained with uppercase column names
-                so they won't classify unless that's the case
-             2. the ML models can't take strings so the crop names were
-                mapped to their respective index during training... since
-                IDs start at 1 in the DB we just decrement by 1
-            """
+            # the oldest month with rows to move, moved one month at a time
+            cursor.execute("""
+                SELECT strftime('%Y-%m', created_at) FROM npk_data
+                    WHERE created_at < ? AND id <= ?
+                    ORDER BY created_at
+                    LIMIT 1;
+            """, (before, rolled_up))
+            row = cursor.fetchone()
+            if row is None:
+                return 0
+            month = row[0]
 
-            return read_sql_query("""
-                SELECT 
-                    npk.n as N,
-                    npk.p as P,
-                    npk.k as K,
-                    npk.created_at,
-                    s.crop - 1 as label,
-                    c.name as crop_name
-                FROM npk_data npk
-                JOIN sensors s ON npk.sensor_id = s.id
-                JOIN crops c ON s.crop = c.id
-                WHERE s.name = ?
-                ORDER BY npk.created_at DESC
-                LIMIT ?;
-            """, conn, params=(sensor_name, n))
+            cursor.execute("""
+                SELECT id FROM npk_data
+                    WHERE created_at >= ? AND created_at < min(?, ?) AND id <= ?
+                    ORDER BY created_at
+                    LIMIT ?;
+            """, (f"{month}-01", f"{next_month(month)}-01", before, rolled_up, n))
+            ids = json.dumps([row[0] for row in cursor.fetchall()])
+
+        os.makedirs(archive_dir, exist_ok=True)
+        path = os.path.join(archive_dir, f"npk_data_{month.replace('-', '_')}.db")
+        cursor.execute("ATTACH DATABASE ? AS archive;", (path,))
+        try:
+            for statement in ARCHIVE_SCHEMA:
+                cursor.execute(statement)
+
+            with conn:
+                cursor.execute("""
+                    INSERT OR IGNORE INTO archive.npk_data
+                        SELECT id, n, p, k, sensor_id, created_at, clf_n, clf_p, clf_k, clf_version
+                        FROM main.npk_data
+                        WHERE id IN (SELECT value FROM json_each(?));
+                """, (ids,))
+
+            with conn:
+                cursor.execute(
+                    "DELETE FROM main.npk_data WHERE id IN (SELECT value FROM json_each(?));",
+                    (ids,)
+                )
+                rows = cursor.rowcount
+                cursor.execute("UPDATE cache_versions SET version = version + 1 WHERE name = 'npk_data';")
+        finally:
+            cursor.execute("DETACH DATABASE archive;")
+
+        current_app.logger.info("Archived %s row(s) of nutrient data to '%s'", rows, path)
+        return rows
     except sqlite3.Error:
-        current_app.logger.exception("Error getting nutrient data")
+        current_app.logger.exception("Error archiving nutrient data")
+        raise
 
 
-def get_npk_data_df(conn, start_date, end_date, sensor_name=None, crop_name=None):
-    query = """
+@metrics.timed(metrics.DB_SECONDS)
+def get_archived_npk_data_chunks(conn, archives, start_date, end_date, sensor_name=None, crop_name=None,
+                                 chunksize=10000):
+    """
+    Get the nutrient data in a date range from the database and its
+    archives, like get_npk_data_chunks. The range is read a month at a time
+    for the months that have an archive, each from a separate connection
+    with the month's archive attached read-only, and in one go between them.
+
+    :param archives: the archives of the months in the range, as
+                     returned by get_archives
+    :return: a generator of DataFrames, in created_at order
+    """
+
+    # the database file, to open it again with the archives attached
+    path = conn.execute("PRAGMA database_list;").fetchone()[2]
+
+    segments = []
+    after = None
+    for month, archive in archives.items():
+        start = f"{month}-01"
+        if after != start:
+            segments.append((after, start, None))
+        after = f"{next_month(month)}-01"
+        segments.append((start, after, archive))
+    segments.append((after, None, None))
+
+    for after, before, archive in segments:
+        query, params = npk_data_query(start_date, end_date, sensor_name, crop_name,
+                                       after=after, before=before, archived=archive is not None)
+        if archive is None:
+            segment_conn = conn
+        else:
+            segment_conn = sqlite3.connect(path, uri=True)
+            segment_conn.execute(
+                "ATTACH DATABASE ? AS archive;",
+                (f"file:{pathname2url(os.path.abspath(archive))}?mode=ro",)
+            )
+
+        try:
+            for chunk in read_sql_query(query, segment_conn, params=params, chunksize=chunksize):
+                if len(chunk) > 0:
+                    yield chunk
+        except sqlite3.Error:
+            current_app.logger.exception("Error getting archived nutrient data")
+            raise
+        finally:
+            if segment_conn is not conn:
+                segment_conn.close()
+
+
+def npk_rollup_query(granularity, start_date, end_date, sensor_name=None, crop_name=None):
+    """
+    Build the query for the rollups of the nutrient data in a date range,
+    like npk_data_query does for the data itself.
+
+    :param granularity: 'hourly' or 'daily'
+    :return: the query and its parameters
+    """
+
+    table, _ = ROLLUPS[granularity]
+    query = f"""
         SELECT
-            npk.n as N,
-            npk.p as P,
-            npk.k as K,
-            npk.created_at,
-            s.crop - 1 as label,
+            r.*,
+            s.name as sensor_name,
             c.name as crop_name
-        FROM npk_data npk
-        JOIN sensors s ON npk.sensor_id = s.id
+        FROM {table} r
+        JOIN sensors s ON r.sensor_id = s.id
         JOIN crops c ON s.crop = c.id
-        WHERE npk.created_at BETWEEN ? AND ?
+        WHERE r.bucket BETWEEN ? AND ?
     """
 
     params = [start_date, end_date]
-    if sensor_name != "any":
+    if sensor_name not in (None, "any"):
         query += " AND s.name = ?"
         params.append(sensor_name)
-    if crop_name != "any":
+    if crop_name not in (None, "any"):
         query += " AND c.name = ?"
         params.append(crop_name)
-    query += " ORDER BY npk.created_at ASC;"
-    
+    query += " ORDER BY r.bucket ASC, r.sensor_id ASC;"
+    return query, params
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_npk_rollup_chunks(conn, granularity, start_date, end_date, sensor_name=None, crop_name=None, chunksize=10000):
+    """
+    Get the rollups of the nutrient data in a date range, in DataFrames
+    of at most chunksize rows like get_npk_data_chunks.
+
+    :param granularity: 'hourly' or 'daily'
+    :param chunksize: the most rows per DataFrame
+    :return: a generator of DataFrames
+    """
+
+    query, params = npk_rollup_query(granularity, start_date, end_date, sensor_name, crop_name)
+
+    try:
+        yield from read_sql_query(query, conn, params=params, chunksize=chunksize)
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting nutrient data rollups")
+        raise
+
+
+# how created_at is stored, like sqlite's CURRENT_TIMESTAMP
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def rollup_bounds(start_date, end_date):
+    """
+    Find the whole hours and days of a date range, the part of it the
+    rollups can answer for. The bounds are compared to created_at as
+    text, like the range is, so a date-only end like '2024-12-31' ends
+    where it does for BETWEEN, at the start of that day.
+
+    :return: the first and last hour, and the first and last day, the
+             last ones exclusive, as bucket strings. None if the range
+             has no whole hour or can't be parsed
+    """
+
+    try:
+        start = datetime.fromisoformat(str(start_date))
+        end = datetime.fromisoformat(str(end_date))
+    except ValueError:
+        return None
+    if start.tzinfo is not None or end.tzinfo is not None:
+        return None
+
+    hour = timedelta(hours=1)
+    first = start.replace(minute=0, second=0, microsecond=0)
+    while first.strftime(TIMESTAMP_FORMAT) < str(start_date):
+        first += hour
+    # every timestamp before last, the latest being a second before it, is in the range
+    last = end.replace(minute=0, second=0, microsecond=0) + hour
+    while (last - timedelta(seconds=1)).strftime(TIMESTAMP_FORMAT) > str(end_date):
+        last -= hour
+    if first >= last:
+        return None
+
+    first_day = first.replace(hour=0)
+    if first_day < first:
+        first_day += timedelta(days=1)
+    last_day = last.replace(hour=0)
+    if first_day >= last_day:
+        first_day = last_day = last
+
+    return tuple(bound.strftime(TIMESTAMP_FORMAT) for bound in (first, last, first_day, last_day))
+
+
+# per nutrient: the sum, sum of squares, min and max, and the count of each class
+STATS_COLUMNS = ", ".join(
+    f"total(npk.{nutrient}), total(npk.{nutrient} * npk.{nutrient}), min(npk.{nutrient}), max(npk.{nutrient}), "
+    f"total(npk.clf_{nutrient} = 'Low'), total(npk.clf_{nutrient} = 'Okay'), total(npk.clf_{nutrient} = 'High')"
+    for nutrient in "npk"
+)
+ROLLUP_STATS_COLUMNS = ", ".join(
+    f"total(r.{nutrient}_sum), total(r.{nutrient}_sumsq), min(r.{nutrient}_min), max(r.{nutrient}_max), "
+    f"total(r.{nutrient}_low), total(r.{nutrient}_okay), total(r.{nutrient}_high)"
+    for nutrient in "npk"
+)
+
+
+def stats_filters(sensor_name, crop_name):
+    where = ""
+    params = []
+    if sensor_name not in (None, "any"):
+        where += " AND s.name = ?"
+        params.append(sensor_name)
+    if crop_name not in (None, "any"):
+        where += " AND c.name = ?"
+        params.append(crop_name)
+    return where, params
+
+
+# stands in for the rollup checkpoint in get_npk_data_stats' query parameters
+# until it's read, in the same transaction as the queries
+ROLLED_UP = object()
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_npk_data_stats(conn, start_date, end_date, sensor_name=None, crop_name=None,
+                       archive_dir=None, sample_size=1000):
+    """
+    Get the statistics of the nutrient data in a date range without reading
+    its rows: count, sum, sum of squares, min, max and the count of each
+    class of N, P and K, summed up by SQL. The whole hours and days of the
+    range come from the rollups, only the rows in the partial hours at its
+    ends and the ones not rolled up yet are read, and only by aggregates.
+    The classes are the stored classifications, like the rollups count them,
+    and readings without any aren't in a class.
+
+    The percentiles come from a sample of at most sample_size readings,
+    each the first one after a point in time, spread evenly over the
+    range, so each is an index lookup. That's an approximation for ranges
+    with more readings, which are all read otherwise.
+
+    :param conn: the database connection
+    :param archive_dir: the archive directory (optional)
+    :param sample_size: the most readings sampled for the percentiles
+    :return: a dict with the 'count', the 'sums', 'squares', 'min', 'max'
+             and 'classes' (Low, Okay and High counts) of each nutrient,
+             and the 'sample' as (N, P, K) rows, or None if the range
+             has archived months, which only get_npk_data_chunks reads
+    """
+
+    if get_archives(archive_dir, start_date, end_date):
+        return None
+
+    where, params = stats_filters(sensor_name, crop_name)
+    raw = f"""
+        SELECT count(*), {STATS_COLUMNS}
+        FROM npk_data npk
+        {{join}} sensors s ON npk.sensor_id = s.id
+        JOIN crops c ON s.crop = c.id
+        WHERE {{range}} {where};
+    """
+    rollup = f"""
+        SELECT total(r.count), {ROLLUP_STATS_COLUMNS}
+        FROM {{table}} r
+        JOIN sensors s ON r.sensor_id = s.id
+        JOIN crops c ON s.crop = c.id
+        WHERE r.bucket >= ? AND r.bucket < ? {where};
+    """
+
+    bounds = rollup_bounds(start_date, end_date)
+    parts = []
+    if bounds is None:
+        parts.append((raw.format(join="JOIN", range="npk.created_at BETWEEN ? AND ?"), [start_date, end_date]))
+    else:
+        first, last, first_day, last_day = bounds
+        parts += [
+            # the partial hours at both ends
+            (raw.format(join="JOIN", range="npk.created_at >= ? AND npk.created_at < ?"),
+             [start_date, first]),
+            (raw.format(join="JOIN", range="npk.created_at >= ? AND npk.created_at <= ?"),
+             [last, end_date]),
+            # the readings of the whole hours that aren't rolled up yet, found by
+            # id. CROSS JOIN and the unary + keep sqlite from reading the whole
+            # range, or the sensor's readings, off an index instead
+            (raw.format(join="CROSS JOIN", range="npk.id > ? AND +npk.created_at >= ? AND +npk.created_at < ?"),
+             [ROLLED_UP, first, last]),
+            (rollup.format(table=ROLLUPS["daily"][0]), [first_day, last_day]),
+            (rollup.format(table=ROLLUPS["hourly"][0]), [first, first_day]),
+            (rollup.format(table=ROLLUPS["hourly"][0]), [last_day, last]),
+        ]
+
+    totals = {
+        "count": 0,
+        "sums": [0.0] * 3,
+        "squares": [0.0] * 3,
+        "min": [None] * 3,
+        "max": [None] * 3,
+        "classes": [[0] * 3 for _ in range(3)],
+    }
+
     try:
         with conn:
-            return read_sql_query(query, conn, params=params)
+            # a read transaction, so the checkpoint, the rollups and the readings
+            # are all of the same snapshot, and readings rolled up meanwhile
+            # aren't counted in both the rollups and the raw readings
+            conn.execute("BEGIN;")
+            row = conn.execute("SELECT last_id FROM job_checkpoints WHERE name = 'rollup';").fetchone()
+            rolled_up = row[0] if row is not None else 0
+
+            for query, range_params in parts:
+                range_params = [rolled_up if value is ROLLED_UP else value for value in range_params]
+                row = conn.execute(query, range_params + params).fetchone()
+                if not row[0]:
+                    continue
+                totals["count"] += int(row[0])
+                for i in range(3):
+                    total, squares, minimum, maximum, low, okay, high = row[1 + 7 * i:8 + 7 * i]
+                    totals["sums"][i] += total
+                    totals["squares"][i] += squares
+                    totals["min"][i] = minimum if totals["min"][i] is None else min(totals["min"][i], minimum)
+                    totals["max"][i] = maximum if totals["max"][i] is None else max(totals["max"][i], maximum)
+                    for j, count in enumerate((low, okay, high)):
+                        totals["classes"][i][j] += int(count)
+
+            totals["sample"] = get_npk_data_sample(
+                conn, start_date, end_date, where, params, sample_size, totals["count"]
+            )
+        current_app.logger.info(
+            "Computed the statistics of %s row(s) of nutrient data", totals["count"]
+        )
+        return totals
     except sqlite3.Error:
-        current_app.logger.exception("Error getting nutrient data")
+        current_app.logger.exception("Error getting nutrient data statistics")
+        raise
+
+
+def get_npk_data_sample(conn, start_date, end_date, where, params, sample_size, count):
+    """
+    Sample the N, P and K of the readings in a date range, for
+    get_npk_data_stats, or read them all if there are no more
+    than sample_size of them.
+
+    :param where: the sensor and crop conditions, as from stats_filters
+    :param count: how many readings there are in the range
+    :return: a list of (N, P, K) rows
+    """
+
+    if count == 0:
+        return []
 
+    select = f"""
+        SELECT npk.n, npk.p, npk.k FROM npk_data npk
+        JOIN sensors s ON npk.sensor_id = s.id
+        JOIN crops c ON s.crop = c.id
+        WHERE npk.created_at BETWEEN ? AND ? {where}
+    """
+    if count <= sample_size:
+        return conn.execute(select + ";", [start_date, end_date] + params).fetchall()
 
+    # the first and last reading, so the sample spreads over the data
+    # rather than the range, which may go well past it
+    seek = f"""
+        SELECT npk.created_at FROM npk_data npk
+        JOIN sensors s ON npk.sensor_id = s.id
+        JOIN crops c ON s.crop = c.id
+        WHERE npk.created_at BETWEEN ? AND ? {where}
+        ORDER BY npk.created_at {{order}}
+        LIMIT 1;
+    """
+    first = conn.execute(seek.format(order="ASC"), [start_date, end_date] + params).fetchone()
+    last = conn.execute(seek.format(order="DESC"), [start_date, end_date] + params).fetchone()
+    if first is None:
+        return []
+
+    return conn.execute(f"""
+        WITH RECURSIVE seq(i) AS (
+            SELECT 0 UNION ALL SELECT i + 1 FROM seq WHERE i < ? - 1
+        )
+        SELECT picked.n, picked.p, picked.k
+        FROM seq
+        JOIN npk_data picked ON picked.id = (
+            SELECT npk.id FROM npk_data npk
+            JOIN sensors s ON npk.sensor_id = s.id
+            JOIN crops c ON s.crop = c.id
+            WHERE npk.created_at BETWEEN strftime(
+                '%Y-%m-%d %H:%M:%S',
+                julianday(?) + (julianday(?) - julianday(?)) * (seq.i + 0.5) / ?
+            ) AND ? {where}
+            ORDER BY npk.created_at
+            LIMIT 1
+        );
+    """, [sample_size, first[0], last[0], first[0], sample_size, end_date] + params).fetchall()
+
+
+@metrics.timed(metrics.DB_SECONDS)
 def add_sensor(conn, name, desc=None, label=None, status=1):
     """
     Add a sensor to the database.
@@ -241,6 +1970,7 @@ def add_sensor(conn, name, desc=None, label=None, status=1):
     :param desc: the sensor's purpose
     :param crop: the crop
     :param status: 1 if the sensor is active, 0 otherwise
+    :return: the new sensor's ID
     """
 
     try:
@@ -250,12 +1980,14 @@ def add_sensor(conn, name, desc=None, label=None, status=1):
                 INSERT INTO sensors (name, desc, crop, status)
                     VALUES (?, ?, ?, ?);
             """, (name, desc, label, status))
-            current_app.logger.info(f"Inserted sensor '{name}'")
+            current_app.logger.info("Inserted sensor '%s'", name)
+            return cursor.lastrowid
     except sqlite3.Error:
         current_app.logger.exception("Error inserting sensor")
         raise # catch integrity error
 
 
+@metrics.timed(metrics.DB_SECONDS)
 def get_sensor(conn, name):
     """
     Get the data for a given sensor.
@@ -270,14 +2002,15 @@ def get_sensor(conn, name):
             cursor.execute("SELECT * FROM sensors WHERE name=?;", (name,))
             row = cursor.fetchone()
             if row is not None:
-                current_app.logger.info(f"Fetched data for sensor with name '{name}'")
+                current_app.logger.info("Fetched data for sensor with name '%s'", name)
             else:
-                current_app.logger.info(f"Could not find sensor data with name '{name}'")
+                current_app.logger.info("Could not find sensor data with name '%s'", name)
             return row 
     except sqlite3.Error:
         current_app.logger.exception("Error getting sensor data")
 
 
+@metrics.timed(metrics.DB_SECONDS)
 def get_all_sensors(conn):
     """
     Get all sensors from the database.
@@ -298,7 +2031,7 @@ def get_all_sensors(conn):
             """)
             rows = cursor.fetchall()
             if len(rows) > 0:
-                current_app.logger.info(f"Fetched data for all sensors: {len(rows)} row(s)")
+                current_app.logger.info("Fetched data for all sensors: %s row(s)", len(rows))
             else:
                 current_app.logger.info("Could not find any sensors")
             return rows
@@ -306,6 +2039,7 @@ def get_all_sensors(conn):
         current_app.logger.exception("Error getting sensor data")
 
 
+@metrics.timed(metrics.DB_SECONDS)
 def get_active_sensors(conn):
     """
     Get all active sensors from the database.
@@ -327,32 +2061,161 @@ def get_active_sensors(conn):
         current_app.logger.exception("Error getting sensor data")
 
 
-def search_sensors(conn, arg):
+@metrics.timed(metrics.DB_SECONDS)
+def get_cache_version(conn, name):
     """
-    Search for sensors by name or id.
+    Get the version of a cached table, which changes
+    every time a row of the table changes.
 
     :param conn: the database connection
-    :param arg: the search term (id or name)
-    :return: a list of sensors that match the search term
+    :param name: the table's name
+    :return: the version
     """
 
     try:
         with conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT 
-                    s.*,
-                    c.name as crop_name
-                FROM sensors s
-                JOIN crops c ON s.crop = c.id
-                WHERE instr(s.name, ?) > 0 OR instr(c.name, ?) OR s.id LIKE ?
-                ORDER BY s.id;
-            """, (arg, arg, arg))
+            cursor.execute("SELECT version FROM cache_versions WHERE name = ?;", (name,))
+            row = cursor.fetchone()
+            return row["version"] if row is not None else 0
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting cache version")
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_last_npk_data_id(conn):
+    """
+    Get the id of the last reading stored, which goes up
+    with every new one.
+
+    :param conn: the database connection
+    :return: the id, 0 if there are no readings
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT max(id) FROM npk_data;")
+            return cursor.fetchone()[0] or 0
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting the last nutrient data id")
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_latest_reading_id(conn, sensor_id):
+    """
+    Get the id of a sensor's cached latest reading.
+
+    :param conn: the database connection
+    :param sensor_id: the sensor's id
+    :return: the reading's id, None if it isn't cached
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT npk_id FROM latest_readings WHERE sensor_id = ?;", (sensor_id,))
+            row = cursor.fetchone()
+            return row["npk_id"] if row is not None else None
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting latest reading id")
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def get_readings_version(conn, sensor_id):
+    """
+    Get the version of a sensor's readings, which changes every
+    time readings of it are stored.
+
+    :param conn: the database connection
+    :param sensor_id: the sensor's id
+    :return: the version, None if none of its readings are cached
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT version FROM latest_readings WHERE sensor_id = ?;", (sensor_id,))
+            row = cursor.fetchone()
+            return row["version"] if row is not None else None
+    except sqlite3.Error:
+        current_app.logger.exception("Error getting readings version")
+
+
+def fts_query(text):
+    """
+    Turn what was typed in a search box into a full text query that
+    matches rows with words starting with each of the typed words.
+
+    :param text: the search term
+    :return: the query, None if there are no words in the search term
+    """
+
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def search_sensors(conn, arg, after_id=0, n=50):
+    """
+    Search for sensors by name, crop name or id, one page at a time.
+    An empty search term matches every sensor.
+
+    :param conn: the database connection
+    :param arg: the search term (id or words the names start with)
+    :param after_id: the id of the last sensor of the previous page
+    :param n: the most sensors to return
+    :return: a list of sensors that match the search term, by id
+    """
+
+    query = fts_query(arg)
+    if query is None and arg.strip():
+        return []
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            if query is None:
+                cursor.execute("""
+                    SELECT
+                        s.*,
+                        c.name as crop_name
+                    FROM sensors s
+                    JOIN crops c ON s.crop = c.id
+                    WHERE s.id > ?
+                    ORDER BY s.id
+                    LIMIT ?;
+                """, (after_id, n))
+            else:
+                # the page's first n matches, plus the sensor with
+                # the search term as its id if there is one
+                cursor.execute("""
+                    WITH matches (id) AS (
+                        SELECT id FROM (
+                            SELECT rowid AS id FROM sensors_fts
+                                WHERE sensors_fts MATCH :query AND rowid > :after
+                                ORDER BY rowid
+                                LIMIT :n
+                        )
+                        UNION
+                        SELECT id FROM sensors WHERE id = :id AND id > :after
+                    )
+                    SELECT
+                        s.*,
+                        c.name as crop_name
+                    FROM matches m
+                    JOIN sensors s ON s.id = m.id
+                    JOIN crops c ON s.crop = c.id
+                    ORDER BY s.id
+                    LIMIT :n;
+                """, {"query": query, "after": after_id, "n": n, "id": arg.strip()})
             rows = cursor.fetchall()
             if len(rows) > 0:
-                current_app.logger.info(f"Searched for sensors with arg '{arg}': {len(rows)} row(s)")
+                current_app.logger.info("Searched for sensors with arg '%s': %s row(s)", arg, len(rows))
             else:
-                current_app.logger.info(f"Could not find any sensors: arg={arg}")
+                current_app.logger.info("Could not find any sensors: arg=%s", arg)
             return rows
     except sqlite3.Error:
         current_app.logger.exception("Error getting sensor data")
@@ -374,6 +2237,7 @@ class User(UserMixin):
         self.created_at = created_at
 
 
+@metrics.timed(metrics.DB_SECONDS)
 def add_user(conn, username, phash):
     """
     Add a user to the database.
@@ -390,11 +2254,12 @@ def add_user(conn, username, phash):
                INSERT INTO users (username, phash)
                     VALUES (?, ?);            
             """, (username, phash))
-            current_app.logger.info(f"Inserted user '{username}'")
+            current_app.logger.info("Inserted user '%s'", username)
     except sqlite3.Error:
         current_app.logger.exception("Error adding user")
 
 
+@metrics.timed(metrics.DB_SECONDS)
 def get_all_users(conn):
     try:
         with conn:
@@ -402,41 +2267,69 @@ def get_all_users(conn):
             cursor.execute("SELECT * FROM users ORDER BY id;")
             rows = cursor.fetchall()
             if len(rows) > 0:
-                current_app.logger.info(f"Fetched data for all users: {len(rows)} row(s)")
+                current_app.logger.info("Fetched data for all users: %s row(s)", len(rows))
             else:
-                current_app.logger.info(f"Could not find any users")
+                current_app.logger.info("Could not find any users")
             return rows
     except sqlite3.Error:
         current_app.logger.exception("Error getting users from arg")
 
 
-def search_users(conn, arg):
+@metrics.timed(metrics.DB_SECONDS)
+def search_users(conn, arg, after_id=0, n=50):
     """
-    Search for users by name or id.
+    Search for users by name or id, one page at a time.
+    An empty search term matches every user.
 
     :param conn: the database connection
-    :param arg: the search term (id or name)
-    :return: a list of users that match the search term
+    :param arg: the search term (id or words the name starts with)
+    :param after_id: the id of the last user of the previous page
+    :param n: the most users to return
+    :return: a list of users that match the search term, by id
     """
 
+    query = fts_query(arg)
+    if query is None and arg.strip():
+        return []
+
     try:
         with conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT * FROM users
-                    WHERE instr(username, ?) > 0 OR id LIKE ?
-                    ORDER BY id;
-            """, (arg, arg))
+            if query is None:
+                cursor.execute("""
+                    SELECT * FROM users
+                        WHERE id > ?
+                        ORDER BY id
+                        LIMIT ?;
+                """, (after_id, n))
+            else:
+                cursor.execute("""
+                    WITH matches (id) AS (
+                        SELECT id FROM (
+                            SELECT rowid AS id FROM users_fts
+                                WHERE users_fts MATCH :query AND rowid > :after
+                                ORDER BY rowid
+                                LIMIT :n
+                        )
+                        UNION
+                        SELECT id FROM users WHERE id = :id AND id > :after
+                    )
+                    SELECT u.* FROM matches m
+                        JOIN users u ON u.id = m.id
+                        ORDER BY u.id
+                        LIMIT :n;
+                """, {"query": query, "after": after_id, "n": n, "id": arg.strip()})
             rows = cursor.fetchall()
             if len(rows) > 0:
-                current_app.logger.info(f"Searched for users with arg '{arg}': {len(rows)} row(s)")
+                current_app.logger.info("Searched for users with arg '%s': %s row(s)", arg, len(rows))
             else:
-                current_app.logger.info(f"Could not find any users: arg={arg}")
+                current_app.logger.info("Could not find any users: arg=%s", arg)
             return rows
     except sqlite3.Error:
         current_app.logger.exception("Error getting users from arg")
 
 
+@metrics.timed(metrics.DB_SECONDS)
 def get_user(conn, user_id):
     """
     Get a user's data.
@@ -451,15 +2344,16 @@ def get_user(conn, user_id):
             cursor.execute("SELECT * FROM users WHERE id=?;", (user_id,))
             row = cursor.fetchone()
             if row is not None:
-                current_app.logger.info(f"Fetched data for user with id '{user_id}'")
+                current_app.logger.info("Fetched data for user with id '%s'", user_id)
                 return User(*row)
             else:
-                current_app.logger.info(f"Could not find data for user with id '{user_id}'")
+                current_app.logger.info("Could not find data for user with id '%s'", user_id)
                 return None
     except sqlite3.Error:
         current_app.logger.exception("Error getting user")
 
 
+@metrics.timed(metrics.DB_SECONDS)
 def get_user_by_name(conn, username):
     """
     Get a user's data.
@@ -473,15 +2367,16 @@ def get_user_by_name(conn, username):
             cursor.execute("SELECT * FROM users WHERE username=?;", (username,))
             row = cursor.fetchone()
             if row is not None:
-                current_app.logger.info(f"Fetched data for user '{username}'")
+                current_app.logger.info("Fetched data for user '%s'", username)
                 return User(*row)
             else:
-                current_app.logger.info(f"Could not find data for user '{username}'")
+                current_app.logger.info("Could not find data for user '%s'", username)
                 return row
     except sqlite3.Error:
         current_app.logger.exception("Error getting user")
 
 
+@metrics.timed(metrics.DB_SECONDS)
 def update_user(conn, user):
     """
     Update a user's data.
@@ -500,11 +2395,12 @@ def update_user(conn, user):
                     last_login=?
                 WHERE id=?;
             """, (user.username, user.phash, user.last_login, int(user.id)))
-            current_app.logger.info(f"Updated user '{user.username}'")
+            current_app.logger.info("Updated user '%s'", user.username)
     except sqlite3.Error:
         current_app.logger.exception("Error updating user")
 
 
+@metrics.timed(metrics.DB_SECONDS)
 def delete_user(conn, user_id):
     """
     Delete a user from the database.
@@ -516,7 +2412,7 @@ def delete_user(conn, user_id):
         with conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM users WHERE id=?;", (user_id,))
-            current_app.logger.info(f"Deleted user with id '{user_id}'")
+            current_app.logger.info("Deleted user with id '%s'", user_id)
     except sqlite3.Error:
         current_app.logger.exception("Error deleting user")
 
@@ -0,0 +1,174 @@
+import queue
+import threading
+
+from rootsage import db
+
+
+"""
+Live dashboard metrics over Server-Sent Events. Each process has one
+MetricsHub with one thread that renders a sensor's metrics once per new
+reading and hands the fragment to every client watching that sensor.
+Clients only wait on their subscription, they never query anything.
+
+The ingestion path tells the hub which sensors got new readings. Readings
+stored by other processes are caught by checking sqlite's data_version,
+which changes when another connection commits, so that costs one pragma
+per poll interval per process, no matter how many clients are connected.
+"""
+
+
+class Subscription:
+    """
+    A client watching a sensor. Only the latest fragment is kept,
+    a client that fell behind skips straight to it.
+    """
+
+    def __init__(self, sensor_id, sensor_name):
+        self.sensor_id = sensor_id
+        self.sensor_name = sensor_name
+        self.fragments = queue.Queue(maxsize=1)
+
+    def offer(self, fragment):
+        while True:
+            try:
+                self.fragments.put_nowait(fragment)
+                return
+            except queue.Full:
+                try:
+                    self.fragments.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """
+        Wait for the next fragment.
+
+        :param timeout: how long to wait, in seconds
+        :return: the fragment, None if there was none in time
+        """
+
+        try:
+            return self.fragments.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class MetricsHub:
+    def __init__(self, app, connect, render, poll_interval=1.0):
+        """
+        :param app: the Flask app, the hub's thread runs in its context
+        :param connect: a function that opens a database connection
+        :param render: a function that renders the metrics of the
+                       sensor with the name it takes
+        :param poll_interval: how often to check for readings stored
+                              by other processes, in seconds
+        """
+
+        self.app = app
+        self.connect = connect
+        self.render = render
+        self.poll_interval = poll_interval
+
+        self.subscriptions = {}  # sensor id -> subscriptions
+        self.sent = {}  # sensor id -> id of the last reading pushed
+        self.pending = set()
+        self.cond = threading.Condition()
+        self.stopping = False
+
+        self.thread = threading.Thread(target=self.run, name="metrics-hub", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+
+    def subscribe(self, sensor_id, sensor_name):
+        """
+        Start watching a sensor.
+
+        :return: the subscription to wait on
+        """
+
+        subscription = Subscription(sensor_id, sensor_name)
+        with self.cond:
+            self.subscriptions.setdefault(sensor_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.cond:
+            watchers = self.subscriptions.get(subscription.sensor_id, set())
+            watchers.discard(subscription)
+            if not watchers:
+                self.subscriptions.pop(subscription.sensor_id, None)
+                self.sent.pop(subscription.sensor_id, None)
+
+    def notify(self, sensor_ids):
+        """
+        Tell the hub that some sensors got new readings. This only wakes
+        the hub's thread, so it's cheap to call from the ingestion path.
+
+        :param sensor_ids: the sensors' ids
+        """
+
+        with self.cond:
+            watched = [sensor_id for sensor_id in sensor_ids if sensor_id in self.subscriptions]
+            if watched:
+                self.pending.update(watched)
+                self.cond.notify()
+
+    def run(self):
+        with self.app.app_context():
+            # sqlite connections can only be used by the thread that opened them
+            conn = self.connect()
+            data_version = None
+
+            while True:
+                with self.cond:
+                    if not self.pending and not self.stopping:
+                        self.cond.wait(self.poll_interval)
+                    if self.stopping:
+                        break
+                    sensor_ids = self.pending
+                    self.pending = set()
+                    watched = list(self.subscriptions)
+
+                try:
+                    if watched:
+                        version = conn.execute("PRAGMA data_version;").fetchone()[0]
+                        if version != data_version:
+                            # something was committed elsewhere, it may be a reading
+                            data_version = version
+                            sensor_ids = sensor_ids | set(watched)
+                    if sensor_ids:
+                        self.push(conn, sensor_ids)
+                except Exception:
+                    self.app.logger.exception("Error pushing dashboard metrics")
+
+            conn.close()
+
+    def push(self, conn, sensor_ids):
+        """
+        Send the metrics of the given sensors to their watchers,
+        if they have a reading the watchers weren't sent yet.
+        """
+
+        for sensor_id in sensor_ids:
+            with self.cond:
+                watchers = self.subscriptions.get(sensor_id)
+                if not watchers:
+                    continue
+                sensor_name = next(iter(watchers)).sensor_name
+
+            reading = db.get_latest_reading(conn, sensor_name)
+            if reading is None or reading["npk_id"] == self.sent.get(sensor_id):
+                continue
+
+            fragment = self.render(sensor_name)
+            with self.cond:
+                self.sent[sensor_id] = reading["npk_id"]
+                watchers = list(self.subscriptions.get(sensor_id, ()))
+            for subscription in watchers:
+                subscription.offer(fragment)
@@ -0,0 +1,411 @@
+import os
+import glob
+import json
+import time
+import uuid
+import fcntl
+import sqlite3
+import threading
+
+import pandas as pd
+
+from collections import deque
+from rootsage import db, clf, metrics
+
+
+"""
+Write-behind ingestion. Request handlers hand their readings to an
+IngestQueue and answer right away, and a single writer thread per process
+commits them in groups, so sqlite's write lock is taken once per group
+instead of once per request.
+
+Every reading is appended to a spool file before it's queued, and the
+spool's progress is committed in the same transaction as the readings.
+If the process dies, the next one to start replays whatever its spool has
+that the database doesn't, so accepted readings aren't lost or repeated.
+"""
+
+
+def classify_rows(conn, rows):
+    """
+    Classify readings before they're stored, so nothing has to
+    run the models on them again later.
+
+    :param conn: the database connection
+    :param rows: (n, p, k, sensor_id, created_at) tuples
+    :return: the rows with clf_n, clf_p, clf_k and clf_version added,
+             which are None for readings of unknown sensors
+    """
+
+    rows = [tuple(row) for row in rows]
+    labels = db.get_sensor_labels(conn, {row[3] for row in rows})
+    known = [i for i, row in enumerate(rows) if row[3] in labels]
+
+    result = [row + (None, None, None, None) for row in rows]
+    if known:
+        data = clf.classify_frame(pd.DataFrame({
+            "N": [rows[i][0] for i in known],
+            "P": [rows[i][1] for i in known],
+            "K": [rows[i][2] for i in known],
+            "label": [labels[rows[i][3]] for i in known],
+        }))
+        version = clf.model_version()
+        for i, clf_n, clf_p, clf_k in zip(known, data["clf_N"].tolist(),
+                                          data["clf_P"].tolist(), data["clf_K"].tolist()):
+            result[i] = rows[i] + (clf_n, clf_p, clf_k, version)
+    return result
+
+
+class QueueFull(Exception):
+    """
+    Raised when a queue can't take more readings right now.
+    """
+
+
+class IngestQueue:
+    def __init__(self, app, connect, spool_dir, max_rows=10000, batch_size=500,
+                 flush_interval=0.05, fsync=False, spool_max_size=16 * 2**20, on_commit=None):
+        """
+        :param app: the Flask app, the writer runs in its context
+        :param connect: a function that opens a database connection
+        :param spool_dir: the directory for the spool files
+        :param max_rows: the most readings waiting to be committed
+                         before new ones are turned away
+        :param batch_size: the most readings per commit
+        :param flush_interval: how long to wait for more readings before
+                               committing a group, in seconds
+        :param fsync: whether to fsync the spool on every write, so readings
+                      survive power loss too and not only a crash
+        :param spool_max_size: how large the spool can grow, in bytes, before
+                               the committed readings are dropped from it
+        :param on_commit: called with the sensor ids of every committed group
+        """
+
+        self.app = app
+        self.connect = connect
+        self.spool_dir = spool_dir
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.spool_max_size = spool_max_size
+        self.on_commit = on_commit
+
+        self.items = deque()
+        self.pending_rows = 0
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.stopping = False
+
+        self.metrics = {
+            "queue_depth": 0,
+            "accepted_rows": 0,
+            "rejected_rows": 0,
+            "committed_rows": 0,
+            "dropped_rows": 0,
+            "commits": 0,
+            "failed_commits": 0,
+            "commit_seconds_total": 0.0,
+            "commit_seconds_max": 0.0,
+            "commit_seconds_last": 0.0,
+        }
+
+        os.makedirs(spool_dir, exist_ok=True)
+        self.spool_name = f"{os.getpid()}-{uuid.uuid4().hex}.spool"
+        self.spool = open(os.path.join(spool_dir, self.spool_name), "a", encoding="utf-8")
+        # held while this process lives, so others know the spool isn't orphaned
+        fcntl.flock(self.spool, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        self.writer = threading.Thread(target=self.run, name="ingest-writer", daemon=True)
+
+    def start(self):
+        """
+        Start the writer thread.
+        """
+
+        self.writer.start()
+
+    def put(self, rows):
+        """
+        Queue readings to be committed.
+
+        :param rows: (n, p, k, sensor_id, created_at) tuples
+        :raises QueueFull: if there are too many readings waiting already
+        """
+
+        with self.cond:
+            # a writer that died can't commit them, don't acknowledge them
+            writer_dead = self.writer.ident is not None and not self.writer.is_alive()
+            if self.stopping or writer_dead or self.pending_rows + len(rows) > self.max_rows:
+                self.metrics["rejected_rows"] += len(rows)
+                metrics.INGEST_FAILURES.inc(len(rows), reason="queue_full")
+                raise QueueFull()
+
+            self.seq += 1
+            self.spool.write(json.dumps({"seq": self.seq, "rows": rows}) + "\n")
+            self.spool.flush()
+            if self.fsync:
+                os.fsync(self.spool.fileno())
+
+            self.items.append((self.seq, rows))
+            self.pending_rows += len(rows)
+            self.metrics["accepted_rows"] += len(rows)
+            self.metrics["queue_depth"] = self.pending_rows
+            self.cond.notify()
+
+    def stop(self, timeout=10):
+        """
+        Commit what's queued and stop the writer. Whatever it
+        couldn't commit stays in the spool for the next start.
+
+        :param timeout: how long to wait for the writer, in seconds
+        """
+
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        if self.writer.is_alive():
+            self.writer.join(timeout)
+
+    def take(self):
+        """
+        Wait for readings and take a group of them.
+
+        :return: the group's last spool sequence number and rows,
+                 or None once stopped and drained
+        """
+
+        with self.cond:
+            while not self.items and not self.stopping:
+                self.cond.wait()
+            if not self.items:
+                return None
+
+            # give a burst some time to come in so it's committed together
+            deadline = time.monotonic() + self.flush_interval
+            while self.pending_rows < self.batch_size and not self.stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            seq, rows = 0, []
+            while self.items and (not rows or len(rows) + len(self.items[0][1]) <= self.batch_size):
+                seq, item_rows = self.items.popleft()
+                rows.extend(item_rows)
+            return seq, rows
+
+    def run(self):
+        """
+        The writer thread: replay orphaned spools, then commit
+        groups of readings until stopped.
+        """
+
+        with self.app.app_context():
+            # sqlite connections can only be used by the thread that opened them
+            self.conn = self.connect()
+            try:
+                self.replay_orphans()
+            except Exception:
+                self.app.logger.exception("Error replaying ingestion spools")
+
+            failures = 0
+            while True:
+                group = self.take()
+                if group is None:
+                    break
+
+                seq, rows = group
+                try:
+                    committed = self.commit(self.spool_name, seq, rows)
+                except Exception:
+                    # not a database error, commit retries those itself. the
+                    # group goes back to the front of the queue to be tried
+                    # again, it stays in the spool until it's committed
+                    self.app.logger.exception("Error committing ingested readings")
+                    self.metrics["failed_commits"] += 1
+                    metrics.INGEST_FAILURES.inc(reason="commit")
+                    with self.cond:
+                        self.items.appendleft((seq, rows))
+                    if self.stopping:
+                        break
+                    time.sleep(min(0.1 * 2 ** failures, 5))
+                    failures += 1
+                    continue
+                failures = 0
+
+                if not committed:
+                    # stopping while the database is unavailable,
+                    # the spool keeps the rest for the next start
+                    break
+
+                with self.cond:
+                    self.pending_rows -= len(rows)
+                    self.metrics["queue_depth"] = self.pending_rows
+                    try:
+                        if not self.items:
+                            # everything in the spool is committed, start it over
+                            self.spool.truncate(0)
+                        elif self.spool.tell() > self.spool_max_size:
+                            # the queue never ran dry, keep only what isn't committed
+                            self.compact_spool()
+                    except OSError:
+                        # the spool only keeps some committed readings longer
+                        self.app.logger.exception("Error trimming ingestion spool")
+
+                self.notify({row[3] for row in rows})
+
+            self.conn.close()
+
+    def notify(self, sensor_ids):
+        """
+        Run the commit hook with the sensor ids of committed readings.
+        """
+
+        if self.on_commit is not None and sensor_ids:
+            try:
+                self.on_commit(sensor_ids)
+            except Exception:
+                self.app.logger.exception("Error running ingestion commit hook")
+
+    def compact_spool(self):
+        """
+        Replace the spool with one of only the readings still queued, the
+        rest are committed already. Called with the condition held, so
+        nothing is appended meanwhile.
+        """
+
+        path = os.path.join(self.spool_dir, self.spool_name)
+        # not named .spool, so other processes don't take it for an orphan
+        spool = open(f"{path}.tmp", "w", encoding="utf-8")
+        fcntl.flock(spool, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        for seq, rows in self.items:
+            spool.write(json.dumps({"seq": seq, "rows": rows}) + "\n")
+        spool.flush()
+        if self.fsync:
+            os.fsync(spool.fileno())
+
+        os.replace(f"{path}.tmp", path)
+        self.spool.close()
+        self.spool = spool
+
+    def commit(self, spool_name, seq, rows):
+        """
+        Classify a group of readings and commit them along with the spool's
+        progress, retrying while the database is locked or unavailable.
+
+        :return: True once committed, False if stopped before that
+        """
+
+        try:
+            rows = classify_rows(self.conn, rows)
+        except Exception:
+            # store them anyway, the reclassify job gets to them later
+            self.app.logger.exception("Error classifying nutrient data")
+            rows = [tuple(row) + (None, None, None, None) for row in rows]
+
+        attempt = 0
+        each = False
+        while True:
+            start = time.perf_counter()
+            try:
+                if each:
+                    skipped = db.add_spooled_npk_data_each(self.conn, rows, spool_name, seq)
+                    self.record_dropped(skipped)
+                    self.record_commit(len(rows) - len(skipped), time.perf_counter() - start)
+                else:
+                    db.add_spooled_npk_data(self.conn, rows, spool_name, seq)
+                    self.record_commit(len(rows), time.perf_counter() - start)
+                return True
+            except sqlite3.IntegrityError:
+                # a bad reading fails the whole group, store the rest without it
+                each = True
+            except sqlite3.Error:
+                # locked or unavailable, nothing was committed, try it again
+                self.metrics["failed_commits"] += 1
+                metrics.INGEST_FAILURES.inc(reason="commit")
+                if self.stopping and attempt >= 3:
+                    return False
+                time.sleep(min(0.1 * 2 ** attempt, 5))
+                attempt += 1
+
+    def record_dropped(self, rows):
+        if not rows:
+            return
+        self.metrics["dropped_rows"] += len(rows)
+        metrics.INGEST_FAILURES.inc(len(rows), reason="invalid")
+        # once per group, a bad batch would flood the log otherwise
+        self.app.logger.warning("Dropped %s row(s) of invalid nutrient data: %s", len(rows), rows)
+
+    def record_commit(self, rows, seconds):
+        self.metrics["commits"] += 1
+        self.metrics["committed_rows"] += rows
+        metrics.INGESTED_ROWS.inc(rows, path="queue")
+        self.metrics["commit_seconds_total"] += seconds
+        self.metrics["commit_seconds_last"] = seconds
+        self.metrics["commit_seconds_max"] = max(self.metrics["commit_seconds_max"], seconds)
+
+    def replay_orphans(self):
+        """
+        Commit what the spools of dead processes have that the
+        database doesn't, then remove them.
+        """
+
+        for path in glob.glob(os.path.join(self.spool_dir, "*.spool")):
+            name = os.path.basename(path)
+            if name == self.spool_name:
+                continue
+
+            try:
+                if not self.replay(path, name):
+                    # stopping while the database is unavailable, the
+                    # spools and their checkpoints stay for the next start
+                    return
+            except FileNotFoundError:
+                continue # another process replayed and removed it first
+            except Exception:
+                # it's kept, for the next start to try again
+                self.app.logger.exception("Error replaying spool '%s'", name)
+
+    def replay(self, path, name):
+        """
+        Commit what an orphaned spool has that the database doesn't,
+        then remove it, unless another process holds it.
+
+        :param path: the spool's path
+        :param name: the spool's name
+        :return: True once replayed or skipped, False if stopped before
+                 committing all of it, leaving it and its checkpoint
+        """
+
+        with open(path, "r+", encoding="utf-8") as spool:
+            try:
+                fcntl.flock(spool, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True # its process is still running
+            if os.fstat(spool.fileno()).st_ino != os.stat(path).st_ino:
+                return True # replaced by its process compacting it meanwhile
+
+            checkpoint = db.get_ingest_checkpoint(self.conn, name)
+            replayed = 0
+            sensor_ids = set()
+            try:
+                for line in spool:
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        # a write cut short by the crash, never acknowledged
+                        continue
+                    if item["seq"] > checkpoint:
+                        rows = [tuple(row) for row in item["rows"]]
+                        if not self.commit(name, item["seq"], rows):
+                            return False
+                        replayed += len(rows)
+                        sensor_ids.update(row[3] for row in rows)
+            finally:
+                self.notify(sensor_ids)
+
+            db.delete_ingest_checkpoint(self.conn, name)
+            os.remove(path)
+            self.app.logger.info("Replayed %s row(s) from spool '%s'", replayed, name)
+            return True
@@ -0,0 +1,167 @@
+import os
+import socket
+import threading
+import pandas as pd
+
+from datetime import datetime, timedelta, timezone
+
+from rootsage import db, clf
+
+
+class BackgroundJob(threading.Thread):
+    """
+    Runs a function every so often in a daemon thread, in the app's context
+    and with its own database connection. Every worker process starts the
+    same jobs, but a lease in the database makes sure only one of them runs
+    a given job at a time.
+    """
+
+    def __init__(self, app, connect, name, func, interval, lease=None):
+        """
+        :param app: the Flask app
+        :param connect: a function that opens a database connection
+        :param name: the job's name, also the name of its lease
+        :param func: the function to run, it takes the connection and
+                     the job (to call renew on while it works)
+        :param interval: how long to wait between runs, in seconds
+        :param lease: how long the lease lasts unless renewed, in seconds
+                      (three intervals by default)
+        """
+
+        super().__init__(name=f"job-{name}", daemon=True)
+        self.app = app
+        self.connect = connect
+        self.job_name = name
+        self.func = func
+        self.interval = interval
+        self.lease = lease if lease is not None else interval * 3
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{id(self)}"
+        self.stopped = threading.Event()
+
+    def renew(self, conn):
+        """
+        Renew the job's lease. Long runs should call this between
+        steps and stop when it returns False.
+
+        :param conn: the database connection
+        :return: True if the job should keep going, False otherwise
+        """
+
+        if self.stopped.is_set():
+            return False
+        return db.acquire_lease(conn, self.job_name, self.owner, self.lease)
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        with self.app.app_context():
+            # sqlite connections can only be used by the thread that opened them
+            conn = self.connect()
+            while True:
+                if self.renew(conn):
+                    try:
+                        self.func(conn, self)
+                    except Exception:
+                        self.app.logger.exception("Error running job '%s'", self.job_name)
+                if self.stopped.wait(self.interval):
+                    break
+            conn.close()
+
+
+def store_classifications(conn, rows, version):
+    """
+    Classify rows from get_stale_npk_data or get_unclassified_npk_data
+    and store the results.
+    """
+
+    data = clf.classify_frame(pd.DataFrame([dict(row) for row in rows]))
+    db.set_npk_data_classifications(conn, list(zip(
+        data["clf_N"].tolist(),
+        data["clf_P"].tolist(),
+        data["clf_K"].tolist(),
+        [version] * len(data),
+        data["id"].tolist()
+    )))
+
+
+def reclassify(conn, job, chunk_size=5000):
+    """
+    Classify the stored readings that weren't classified by the current
+    models, a chunk at a time so the write lock is never held for long.
+    This catches up after the models in rootsage/classifiers/ change, after
+    a sensor's crop does, and on readings that were stored unclassified.
+
+    :param conn: the database connection
+    :param job: the job running this
+    :param chunk_size: the most readings classified per transaction
+    """
+
+    version = clf.model_version()
+    total = 0
+
+    # readings marked unclassified can be anywhere, but there's an index of them
+    after_id = 0
+    while job.renew(conn):
+        rows = db.get_unclassified_npk_data(conn, after_id, chunk_size)
+        if not rows:
+            break
+        store_classifications(conn, rows, version)
+        after_id = rows[-1]["id"]
+        total += len(rows)
+
+    # readings classified by other models are only looked for past the ones
+    # checked with these models already, so the whole table is only read
+    # again once they change
+    after_id = db.get_job_checkpoint(conn, "reclassify", version)
+    last_id = db.get_last_npk_data_id(conn) or 0
+    while after_id < last_id and job.renew(conn):
+        rows = db.get_stale_npk_data(conn, version, after_id, last_id, chunk_size)
+        if rows:
+            store_classifications(conn, rows, version)
+            total += len(rows)
+        after_id = rows[-1]["id"] if len(rows) == chunk_size else last_id
+        db.set_job_checkpoint(conn, "reclassify", after_id, version)
+
+    if total > 0:
+        job.app.logger.info("Reclassified %s row(s) of nutrient data with models '%s'", total, version)
+
+
+def roll_up(conn, job, chunk_size=5000):
+    """
+    Add the readings stored since the last run to the hourly and daily
+    rollups, a chunk at a time.
+
+    :param conn: the database connection
+    :param job: the job running this
+    :param chunk_size: the most readings rolled up per transaction
+    """
+
+    while job.renew(conn):
+        if db.roll_up_npk_data(conn, chunk_size) == 0:
+            break
+
+
+def archive(conn, job, archive_dir, retention_days, chunk_size=5000):
+    """
+    Move the readings older than the retention period out of the database
+    and into the monthly archives, a chunk at a time.
+
+    :param conn: the database connection
+    :param job: the job running this
+    :param archive_dir: the archive directory
+    :param retention_days: how many days of readings the database keeps
+    :param chunk_size: the most readings moved per transaction
+    """
+
+    before = (datetime.now(timezone.utc) - timedelta(days=retention_days)).strftime("%Y-%m-%d %H:%M:%S")
+    total = 0
+
+    while job.renew(conn):
+        rows = db.archive_npk_data(conn, archive_dir, before, chunk_size)
+        if rows == 0:
+            break
+        total += rows
+
+    if total > 0:
+        job.app.logger.info("Archived %s row(s) of nutrient data older than %s", total, before)
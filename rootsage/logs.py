@@ -0,0 +1,118 @@
+import os
+import time
+import queue
+import random
+import logging
+import threading
+
+from logging.handlers import QueueHandler, QueueListener
+
+
+"""
+Logging that stays off the hot paths. Records are handed to a background
+thread that formats them and writes them out, so the threads logging never
+wait on the log file, and messages are only formatted if they're written.
+High frequency messages can be sampled or rate limited before they even
+get queued.
+"""
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Queues records for a thread that passes them on to the given handlers.
+    If the queue is full, because the handlers can't keep up, records are
+    dropped and counted instead of holding up the thread that logged them.
+    """
+
+    def __init__(self, handlers, maxsize=10000):
+        """
+        :param handlers: the handlers that do the actual work
+        :param maxsize: the most records waiting to be handled
+        """
+
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.listener = None
+        super().__init__(None)
+        self.start()
+        # threads don't survive a fork, each worker needs its own
+        os.register_at_fork(after_in_child=self.start)
+
+    def start(self):
+        self.queue = queue.Queue(self.maxsize)
+        self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def prepare(self, record):
+        # the record never leaves the process, so unlike QueueHandler
+        # this doesn't format it into something that can be pickled
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.listener is not None and self.listener._thread is not None:
+            # writes out what's still queued
+            self.listener.stop()
+        super().close()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Thins out high frequency messages below WARNING. Messages are told apart
+    by the function that logged them, e.g. 'add_npk_data', and each of those
+    events can be sampled, keeping a share of its records at random, or rate
+    limited, keeping at most some records per second. The first record kept
+    after a rate limited second says how many were dropped.
+    """
+
+    def __init__(self, sample_rates=None, rate_limits=None):
+        """
+        :param sample_rates: event -> the share of its records to keep
+        :param rate_limits: event -> the most records to keep per second
+        """
+
+        super().__init__()
+        self.sample_rates = dict(sample_rates or {})
+        self.rate_limits = dict(rate_limits or {})
+        self.windows = {}  # event -> [start of the second, kept, dropped]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        event = record.funcName
+        rate = self.sample_rates.get(event)
+        if rate is not None and random.random() >= rate:
+            return False
+
+        limit = self.rate_limits.get(event)
+        if limit is None:
+            return True
+
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(event)
+            dropped = 0
+            if window is None or now - window[0] >= 1:
+                dropped = window[2] if window is not None else 0
+                window = self.windows[event] = [now, 0, 0]
+            if window[1] >= limit:
+                window[2] += 1
+                return False
+            window[1] += 1
+
+        if dropped and isinstance(record.args, tuple):
+            msg = str(record.msg)
+            if not record.args:
+                # it's about to be %-formatted for the first time
+                msg = msg.replace("%", "%%")
+            record.msg = msg + " (%s similar message(s) dropped)"
+            record.args = record.args + (dropped,)
+        return True
@@ -0,0 +1,274 @@
+import time
+import inspect
+import threading
+
+from bisect import bisect_left
+from functools import wraps
+
+
+"""
+Prometheus metrics, kept in memory by each process and rendered in the
+text exposition format by the /metrics route. Nothing is recorded until
+configure() is called, and the timing decorator and context
+manager only check a flag while disabled, so they can stay on hot paths.
+
+With a pre-forking server every worker keeps and serves its own metrics,
+which Prometheus tells apart by the instance it scraped.
+"""
+
+enabled = False
+
+# in seconds, from a cached dashboard lookup to a report over months of data
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+registry = []
+
+
+def configure(enable=True):
+    """
+    Turn recording metrics on or off.
+    """
+
+    global enabled
+    enabled = enable
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        :param name: the metric's name
+        :param documentation: what the metric measures
+        :param labelnames: the names of the metric's labels
+        """
+
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self.render_sample(key, value))
+        return lines
+
+    def render_sample(self, key, value):
+        return [f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not enabled:
+            return
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        if not enabled:
+            return
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: the upper bounds of the buckets, in order
+        """
+
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        if not enabled:
+            return
+        self.observe_key(self.key(labels), value)
+
+    def observe_key(self, key, value):
+        """
+        Same as observe, with the label values already in a key.
+        """
+
+        with self.lock:
+            sample = self.values.get(key)
+            if sample is None:
+                # the count of each bucket (not cumulative), the sum
+                sample = self.values[key] = [[0] * len(self.buckets), 0.0]
+            sample[0][bisect_left(self.buckets, value)] += 1
+            sample[1] += value
+
+    def time(self, **labels):
+        """
+        Time a block of code:
+
+            with HISTOGRAM.time(label="value"):
+                ...
+        """
+
+        return Timer(self, labels)
+
+    def render_sample(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            le = f'le="{format_value(bound)}"'
+            lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {format_value(total)}")
+        lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Timer:
+    """
+    Observes how long its block took in a histogram. While metrics
+    are disabled it doesn't even read the clock.
+    """
+
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def timed(histogram, **labels):
+    """
+    Time every call of a function in a histogram. The 'function' label,
+    if the histogram has one, defaults to the function's name. Generator
+    functions are timed from the first item until they're exhausted or
+    closed, since that's when their work happens.
+
+    :param histogram: the histogram to observe the durations in
+    :param labels: the label values of the observations
+    """
+
+    def decorate(func):
+        if "function" in histogram.labelnames:
+            labels.setdefault("function", func.__name__)
+        key = histogram.key(labels)
+
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not enabled:
+                    return (yield from func(*args, **kwargs))
+                with Timer(histogram, labels):
+                    return (yield from func(*args, **kwargs))
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    histogram.observe_key(key, time.perf_counter() - start)
+
+        return wrapper
+    return decorate
+
+
+def render():
+    """
+    Render every metric in the Prometheus text exposition format.
+
+    :return: the text
+    """
+
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = Histogram(
+    "rootsage_request_duration_seconds",
+    "Time spent handling requests, until the response is returned.",
+    ["method", "route", "status"]
+)
+DB_SECONDS = Histogram(
+    "rootsage_db_duration_seconds",
+    "Time spent in each rootsage.db function.",
+    ["function"]
+)
+CLASSIFY_SECONDS = Histogram(
+    "rootsage_classify_duration_seconds",
+    "Time spent in each rootsage.clf classify function.",
+    ["function"]
+)
+REPORT_SECONDS = Histogram(
+    "rootsage_report_duration_seconds",
+    "Time spent writing reports and exports.",
+    ["function"]
+)
+REPORT_ROWS = Histogram(
+    "rootsage_report_rows",
+    "Rows in each report and export.",
+    ["function"],
+    buckets=(10, 100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+)
+INGESTED_ROWS = Counter(
+    "rootsage_ingested_rows_total",
+    "Readings stored, by how they were stored.",
+    ["path"]
+)
+INGEST_FAILURES = Counter(
+    "rootsage_ingest_failures_total",
+    "Readings that couldn't be stored or queued, and failed commits, by reason.",
+    ["reason"]
+)
+INGEST_QUEUE_DEPTH = Gauge(
+    "rootsage_ingest_queue_depth",
+    "Readings waiting in the write-behind queue to be committed."
+)
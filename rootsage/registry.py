@@ -0,0 +1,100 @@
+import time
+import threading
+
+from rootsage import db
+
+
+"""
+The active sensors, kept in memory by each process so pages and API calls
+can look sensors up by name or id without a query. A counter in the
+database goes up with every change to the sensors table (see the schema
+migrations), so a process finds out about sensors added or turned on or off
+by any other process, or straight in the database, with one lookup at most
+every check interval, and only reads the sensors again when it changed.
+"""
+
+
+class SensorRegistry:
+    def __init__(self, check_interval=1.0):
+        """
+        :param check_interval: how often to check for changes made
+                               elsewhere, in seconds
+        """
+
+        self.check_interval = check_interval
+        self.version = None
+        self.next_check = 0
+        self.lock = threading.Lock()
+        # replaced whole on every reload, so lookups need no lock
+        self.sensors = ({}, {})  # by name, by id
+
+    def invalidate(self):
+        """
+        Read the sensors again on the next lookup, after
+        changing them from this process.
+        """
+
+        self.next_check = 0
+
+    def check(self, conn):
+        """
+        Read the sensors again if they changed, unless
+        they were checked less than an interval ago.
+
+        :param conn: the database connection
+        """
+
+        if time.monotonic() < self.next_check:
+            return
+
+        with self.lock:
+            if time.monotonic() < self.next_check:
+                return
+
+            version = db.get_cache_version(conn, "sensors")
+            if version is not None and version != self.version:
+                rows = db.get_active_sensors(conn)
+                if rows is not None:
+                    self.sensors = (
+                        {row["name"]: row for row in rows},
+                        {row["id"]: row for row in rows}
+                    )
+                    self.version = version
+            self.next_check = time.monotonic() + self.check_interval
+
+    def get(self, conn, name):
+        """
+        Get an active sensor by name.
+
+        :return: the sensor, None if there's no such active sensor
+        """
+
+        self.check(conn)
+        return self.sensors[0].get(name)
+
+    def get_by_id(self, conn, sensor_id):
+        """
+        Get an active sensor by id.
+
+        :return: the sensor, None if there's no such active sensor
+        """
+
+        self.check(conn)
+        return self.sensors[1].get(sensor_id)
+
+    def names(self, conn):
+        """
+        :return: the names of the active sensors, oldest first
+        """
+
+        self.check(conn)
+        return list(self.sensors[0])
+
+    def default(self, conn):
+        """
+        :return: the sensor the dashboard shows first,
+                 None if there are no active sensors
+        """
+
+        self.check(conn)
+        return next(iter(self.sensors[0].values()), None)
@@ -0,0 +1,416 @@
+import io
+import csv
+import numpy as np
+import pandas as pd
+
+from openpyxl import Workbook
+from rootsage import clf, metrics
+
+
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+PARQUET_MIMETYPE = "application/vnd.apache.parquet"
+
+# the columns of the report's data sheet, in order
+DATA_COLUMNS = ["N", "P", "K", "created_at", "crop_name", "clf_N", "clf_P", "clf_K"]
+NUTRIENTS = ["N", "P", "K"]
+# the classes the models put readings in, as the rollups count them
+CLASSES = ["Low", "Okay", "High"]
+# the columns of the rollup report's data sheet, in order
+ROLLUP_COLUMNS = ["bucket", "sensor_name", "crop_name", "count"] + [
+    f"{nutrient}_{column}"
+    for nutrient in NUTRIENTS
+    for column in ["mean", "min", "max"] + CLASSES
+]
+# the columns of the CSV and Parquet exports, in order
+EXPORT_COLUMNS = ["sensor_id", "sensor_name", "crop_name", "N", "P", "K", "created_at"]
+
+
+class NutrientStats:
+    """
+    The same statistics DataFrame.describe() gives for the N, P and K
+    columns, computed one chunk of data at a time so memory stays the same
+    no matter how many rows there are.
+
+    Count, mean, standard deviation, min and max are exact. The percentiles
+    come from a fixed size random sample of the rows, so they're exact up
+    to sample_size rows and an approximation after that. Rows only known
+    through their sums (see update_totals) leave the percentiles empty.
+    """
+
+    def __init__(self, sample_size=100_000, seed=0):
+        """
+        :param sample_size: the most rows kept for the percentiles
+        :param seed: the seed of the sampling
+        """
+
+        self.count = 0
+        self.mean = np.zeros(len(NUTRIENTS))
+        self.m2 = np.zeros(len(NUTRIENTS))
+        self.min = np.full(len(NUTRIENTS), np.inf)
+        self.max = np.full(len(NUTRIENTS), -np.inf)
+
+        self.sample = np.empty((sample_size, len(NUTRIENTS)))
+        self.sampled = 0
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, values):
+        """
+        Add a chunk of rows to the statistics.
+
+        :param values: an array with one row per reading and
+                       the N, P and K columns
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+        count = len(values)
+        if count == 0:
+            return
+
+        mean = values.mean(axis=0)
+        self.merge(count, mean, ((values - mean) ** 2).sum(axis=0), values.min(axis=0), values.max(axis=0))
+
+        # reservoir sampling: row i (counting from 0) replaces a random
+        # sample slot with probability sample_size / (i + 1)
+        size = len(self.sample)
+        filled = max(0, min(size - self.sampled, count))
+        self.sample[self.sampled:self.sampled + filled] = values[:filled]
+        if filled < count:
+            seen = np.arange(self.sampled + filled, self.sampled + count)
+            slots = self.rng.integers(0, seen + 1)
+            keep = slots < size
+            self.sample[slots[keep]] = values[filled:][keep]
+
+        self.sampled += count
+
+    def update_totals(self, count, sums, squares, minimum, maximum):
+        """
+        Add rows to the statistics that are only known through their
+        totals, like the nutrient data rollups keep them.
+
+        :param count: the number of rows
+        :param sums: the sums of N, P and K
+        :param squares: the sums of the squares of N, P and K
+        :param minimum: the smallest N, P and K
+        :param maximum: the largest N, P and K
+        """
+
+        if count == 0:
+            return
+
+        sums = np.asarray(sums, dtype=np.float64)
+        mean = sums / count
+        # rounding can take the difference just below zero
+        m2 = np.maximum(np.asarray(squares, dtype=np.float64) - sums * mean, 0)
+        self.merge(count, mean, m2, np.asarray(minimum), np.asarray(maximum))
+
+    def set_sample(self, values):
+        """
+        Take the percentiles from a sample of the rows drawn elsewhere,
+        like db.get_npk_data_stats does, instead of keeping one here.
+
+        :param values: the sample, with the N, P and K columns
+        """
+
+        self.sample = np.asarray(values, dtype=np.float64).reshape(-1, len(NUTRIENTS))
+        self.sampled = self.count
+
+    def merge(self, count, mean, m2, minimum, maximum):
+        """
+        Merge the count, mean, sum of squared differences, min and max
+        of some rows into the running ones (Chan et al.), which stays
+        accurate for long runs.
+        """
+
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+
+        self.min = np.minimum(self.min, minimum)
+        self.max = np.maximum(self.max, maximum)
+        self.count = total
+
+    def to_frame(self):
+        """
+        Get the statistics like DataFrame.describe() shows them,
+        plus the N:P, N:K and P:K ratios of the means.
+
+        :return: a DataFrame with one column per nutrient
+        """
+
+        stats = pd.DataFrame(
+            np.nan,
+            index=["count", "mean", "std", "min", "25%", "50%", "75%", "max"],
+            columns=NUTRIENTS
+        )
+        stats.loc["count"] = self.count
+
+        if self.count > 0:
+            stats.loc["mean"] = self.mean
+            stats.loc["std"] = np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.nan
+            stats.loc["min"] = self.min
+            sample = self.sample[:min(self.count, len(self.sample))]
+            if self.sampled == self.count and len(sample) > 0:
+                stats.loc[["25%", "50%", "75%"]] = np.percentile(sample, [25, 50, 75], axis=0)
+            stats.loc["max"] = self.max
+
+        mean_N, mean_P, mean_K = stats.loc["mean", NUTRIENTS]
+
+        stats.loc["N:P ratio"] = [mean_N / mean_P if mean_P else np.nan, np.nan, np.nan]
+        stats.loc["N:K ratio"] = [mean_N / mean_K if mean_K else np.nan, np.nan, np.nan]
+        stats.loc["P:K ratio"] = [np.nan, mean_P / mean_K if mean_K else np.nan, np.nan]
+        return stats
+
+
+def cell(value):
+    """
+    Excel has no NaN, leave those cells empty like pandas does.
+    """
+
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+@metrics.timed(metrics.REPORT_SECONDS)
+def write_xlsx(chunks, file):
+    """
+    Write a report with the classified data and its statistics. The
+    workbook is written in openpyxl's write-only mode, so rows go to disk
+    as they come instead of piling up in memory.
+
+    :param chunks: DataFrames with the data to report, as returned
+                   by db.get_npk_data_chunks
+    :param file: a file name or a binary file object to write to
+    :return: the number of rows in the report
+    """
+
+    workbook = Workbook(write_only=True)
+    data_sheet = workbook.create_sheet("Data")
+    stats_sheet = workbook.create_sheet("Stats")
+
+    data_sheet.append(DATA_COLUMNS)
+    stats = NutrientStats()
+    for chunk in chunks:
+        # readings are classified when stored, so this is a no-op unless
+        # the models changed and the reclassify job hasn't caught up yet
+        chunk = clf.classify_stale(chunk)
+        stats.update(chunk[NUTRIENTS].to_numpy())
+        for row in chunk[DATA_COLUMNS].itertuples(index=False, name=None):
+            data_sheet.append(row)
+
+    stats_sheet.append([None] + NUTRIENTS)
+    for name, row in stats.to_frame().iterrows():
+        stats_sheet.append([name] + [cell(value) for value in row.tolist()])
+
+    workbook.save(file)
+    metrics.REPORT_ROWS.observe(stats.count, function="write_xlsx")
+    return stats.count
+
+
+@metrics.timed(metrics.REPORT_SECONDS)
+def write_rollup_xlsx(chunks, file):
+    """
+    Write a report from the nutrient data rollups instead of the data
+    itself, with one row per sensor and hour or day. The statistics are
+    the same as write_xlsx's but the percentiles, which can't be told
+    from the rollups, plus how many readings fell in each class.
+
+    :param chunks: DataFrames with the rollups to report, as
+                   returned by db.get_npk_rollup_chunks
+    :param file: a file name or a binary file object to write to
+    :return: the number of readings the report covers
+    """
+
+    workbook = Workbook(write_only=True)
+    data_sheet = workbook.create_sheet("Data")
+    stats_sheet = workbook.create_sheet("Stats")
+
+    data_sheet.append(ROLLUP_COLUMNS)
+    stats = NutrientStats()
+    classes = pd.DataFrame(0, index=CLASSES, columns=NUTRIENTS)
+    for chunk in chunks:
+        columns = {}
+        for nutrient in NUTRIENTS:
+            prefix = nutrient.lower()
+            columns[f"{nutrient}_mean"] = chunk[f"{prefix}_sum"] / chunk["count"]
+            columns[f"{nutrient}_min"] = chunk[f"{prefix}_min"]
+            columns[f"{nutrient}_max"] = chunk[f"{prefix}_max"]
+            for name in CLASSES:
+                columns[f"{nutrient}_{name}"] = chunk[f"{prefix}_{name.lower()}"]
+                classes.loc[name, nutrient] += int(chunk[f"{prefix}_{name.lower()}"].sum())
+
+        stats.update_totals(
+            int(chunk["count"].sum()),
+            [chunk[f"{nutrient.lower()}_sum"].sum() for nutrient in NUTRIENTS],
+            [chunk[f"{nutrient.lower()}_sumsq"].sum() for nutrient in NUTRIENTS],
+            [chunk[f"{nutrient.lower()}_min"].min() for nutrient in NUTRIENTS],
+            [chunk[f"{nutrient.lower()}_max"].max() for nutrient in NUTRIENTS]
+        )
+
+        chunk = chunk.assign(**columns)
+        for row in chunk[ROLLUP_COLUMNS].itertuples(index=False, name=None):
+            data_sheet.append(row)
+
+    stats_sheet.append([None] + NUTRIENTS)
+    for name, row in pd.concat([stats.to_frame(), classes]).iterrows():
+        stats_sheet.append([name] + [cell(value) for value in row.tolist()])
+
+    workbook.save(file)
+    metrics.REPORT_ROWS.observe(stats.count, function="write_rollup_xlsx")
+    return stats.count
+
+
+def stats_from_totals(totals):
+    """
+    Turn the totals db.get_npk_data_stats sums up in SQL into statistics.
+
+    :param totals: the totals
+    :return: the NutrientStats, and a DataFrame with how many readings
+             fell in each class by their stored classifications. Readings
+             the reclassify job hasn't classified yet are in none of them
+    """
+
+    stats = NutrientStats(sample_size=0)
+    stats.update_totals(totals["count"], totals["sums"], totals["squares"], totals["min"], totals["max"])
+    stats.set_sample(totals["sample"])
+    classes = pd.DataFrame(np.array(totals["classes"]).T, index=CLASSES, columns=NUTRIENTS)
+    return stats, classes
+
+
+def stats_from_chunks(chunks):
+    """
+    Same as stats_from_totals, from the data itself, in one
+    pass over it, for ranges the database can't sum up. The
+    classes are counted from the stored classifications too,
+    so both give the same counts for the same data.
+
+    :param chunks: DataFrames with the data, as returned
+                   by db.get_npk_data_chunks
+    """
+
+    stats = NutrientStats()
+    classes = pd.DataFrame(0, index=CLASSES, columns=NUTRIENTS)
+    for chunk in chunks:
+        stats.update(chunk[NUTRIENTS].to_numpy())
+        for nutrient in NUTRIENTS:
+            counts = chunk[f"clf_{nutrient}"].value_counts()
+            classes[nutrient] += counts.reindex(CLASSES, fill_value=0).to_numpy()
+    return stats, classes
+
+
+@metrics.timed(metrics.REPORT_SECONDS)
+def write_stats_xlsx(stats, classes, file):
+    """
+    Write a report with only the statistics, as from stats_from_totals
+    or stats_from_chunks, and how many readings fell in each class.
+
+    :param file: a file name or a binary file object to write to
+    :return: the number of readings the report covers
+    """
+
+    workbook = Workbook(write_only=True)
+    stats_sheet = workbook.create_sheet("Stats")
+
+    stats_sheet.append([None] + NUTRIENTS)
+    for name, row in pd.concat([stats.to_frame(), classes]).iterrows():
+        stats_sheet.append([name] + [cell(value) for value in row.tolist()])
+
+    workbook.save(file)
+    metrics.REPORT_ROWS.observe(stats.count, function="write_stats_xlsx")
+    return stats.count
+
+
+def stats_to_dict(stats, classes):
+    """
+    Get the statistics, as from stats_from_totals or
+    stats_from_chunks, in a form that can be sent as JSON.
+
+    :return: the count, whether the percentiles are approximate, each
+             nutrient's statistics and class counts, and the ratios
+    """
+
+    frame = stats.to_frame()
+    ratios = ["N:P ratio", "N:K ratio", "P:K ratio"]
+    return {
+        "count": int(stats.count),
+        "approximate_percentiles": bool(stats.count > len(stats.sample)),
+        "stats": {
+            nutrient: {
+                name: cell(float(value)) for name, value in frame[nutrient].drop(ratios).items()
+            }
+            for nutrient in NUTRIENTS
+        },
+        "classes": {
+            nutrient: {name: int(count) for name, count in classes[nutrient].items()}
+            for nutrient in NUTRIENTS
+        },
+        # each ratio is in the column of its first nutrient, NaN elsewhere
+        "ratios": {name.removesuffix(" ratio"): cell(float(frame.loc[name].max())) for name in ratios},
+    }
+
+
+@metrics.timed(metrics.REPORT_SECONDS)
+def iter_csv(chunks):
+    """
+    Turn the data into CSV text, one chunk at a time, so it can be
+    streamed as the response body while it's read from the database.
+
+    :param chunks: DataFrames with the data to export, as returned
+                   by db.get_npk_data_chunks
+    :return: a generator of CSV text pieces, starting with the header
+    """
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    rows = 0
+    writer.writerow(EXPORT_COLUMNS)
+    for chunk in chunks:
+        writer.writerows(chunk[EXPORT_COLUMNS].itertuples(index=False, name=None))
+        rows += len(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    metrics.REPORT_ROWS.observe(rows, function="iter_csv")
+
+    # the header, if there was no data at all
+    yield buffer.getvalue()
+
+
+@metrics.timed(metrics.REPORT_SECONDS)
+def write_parquet(chunks, file):
+    """
+    Write the data as a Parquet file, with one row group per chunk.
+
+    :param chunks: DataFrames with the data to export, as returned
+                   by db.get_npk_data_chunks
+    :param file: a file name or a binary file object to write to
+    :return: the number of exported rows
+    """
+
+    # optional, only needed for this kind of export
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # the nutrient columns are NUMERIC, so a chunk could come back as
+    # integers and the next one as floats. fix the types up front
+    schema = pa.schema([
+        ("sensor_id", pa.int64()),
+        ("sensor_name", pa.string()),
+        ("crop_name", pa.string()),
+        ("N", pa.float64()),
+        ("P", pa.float64()),
+        ("K", pa.float64()),
+        ("created_at", pa.timestamp("s")),
+    ])
+
+    rows = 0
+    with pq.ParquetWriter(file, schema) as writer:
+        for chunk in chunks:
+            chunk = chunk[EXPORT_COLUMNS].assign(created_at=pd.to_datetime(chunk["created_at"]))
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            rows += len(chunk)
+    metrics.REPORT_ROWS.observe(rows, function="write_parquet")
+    return rows